@@ -0,0 +1,235 @@
+import datetime
+import hashlib
+import logging
+import orjson
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from . import semantic_cache
+from .availability import DoctorSchedule, availability_index
+from .context import refresh_patient_context
+from .graph_utils import format_datetime
+from .models import ActionRequest, Patient
+from .neo4j_driver import Neo4jDriver
+from .notifications import notify_patient
+from .resolvers import split_patient_field
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Move each patient's next appointment to the requested date. The previous next appointment
+# becomes the last one. Appointment nodes are shared by (type, date), so only the patient's
+# own relationships change, and every step is a MERGE or a guarded DELETE, so replaying
+# the same rows leaves the graph as it is.
+APPOINTMENT_WRITE_QUERY = """
+    UNWIND $rows AS row
+    MATCH (p:Patient {id: row.patient_id})
+    OPTIONAL MATCH (p)-[stale:HAS_APPOINTMENT]->(old:Appointment {type: 'next'})
+    WHERE old.date <> datetime(row.start)
+    DELETE stale
+    WITH DISTINCT p, row
+    OPTIONAL MATCH (p)-[stale_last:HAD_APPOINTMENT]->(old_last:Appointment {type: 'last'})
+    WHERE row.previous IS NOT NULL AND old_last.date <> datetime(row.previous)
+    DELETE stale_last
+    WITH DISTINCT p, row
+    FOREACH (previous IN CASE WHEN row.previous IS NULL THEN [] ELSE [row.previous] END |
+        MERGE (last:Appointment {type: 'last', date: datetime(previous)})
+        MERGE (p)-[:HAD_APPOINTMENT]->(last)
+    )
+    MERGE (next:Appointment {type: 'next', date: datetime(row.start)})
+    MERGE (p)-[r:HAS_APPOINTMENT]->(next)
+    SET r.action_key = row.action_key
+"""
+
+# Add or update a medication of each patient, keeping the dosage on the relationship
+MEDICATION_WRITE_QUERY = """
+    UNWIND $rows AS row
+    MATCH (p:Patient {id: row.patient_id})
+    MERGE (m:MedicationRegime {name: row.medication})
+    MERGE (p)-[r:TAKES_MEDICATION]->(m)
+    SET r.dosage = row.dosage, r.action_key = row.action_key
+"""
+
+# Key identifying a request against the current state of the record it changes, so asking
+# again before it is applied is a no-op, but asking again after it was applied is not.
+# The dosage isn't on the Patient row, so the last applied request for the same medication
+# (or appointment) is part of the state: dosage A, then B, then A again is a new request.
+def idempotency_key(patient, kind, payload, last_applied_id=None):
+    if kind == ActionRequest.SCHEDULE_APPOINTMENT:
+        requested = [payload['start']]
+        base = format_datetime(patient.next_appointment)
+    else:
+        requested = [payload['medication'].strip().lower(), payload['dosage'].strip().lower()]
+        base = patient.medication_regime
+    raw = orjson.dumps([patient.id, kind, requested, base, last_applied_id])
+    return hashlib.sha256(raw).hexdigest()
+
+# Id of the latest applied request of a patient changing the same appointment or medication
+async def last_applied_id(patient, kind, payload):
+    applied = ActionRequest.objects.filter(patient_id=patient.id, kind=kind, status=ActionRequest.APPLIED)
+    if kind == ActionRequest.UPDATE_MEDICATION:
+        applied = applied.filter(payload__medication__iexact=payload['medication'].strip())
+    return await applied.order_by('-applied_at', '-id').values_list('id', flat=True).afirst()
+
+# Record a request awaiting approval, returning the existing one for a repeated request
+async def request_action(patient, kind, payload):
+    key = idempotency_key(patient, kind, payload, await last_applied_id(patient, kind, payload))
+    action_request, created = await ActionRequest.objects.aget_or_create(
+        idempotency_key=key,
+        defaults={'patient': patient, 'kind': kind, 'payload': payload},
+    )
+    if created:
+        logger.info(f"Recorded {kind} request {action_request.id} for patient_id: {patient.id}")
+    else:
+        logger.info(f"Reusing {kind} request {action_request.id} for patient_id: {patient.id} ({action_request.status})")
+    return action_request, created
+
+# Mark pending requests as approved; already approved or applied requests are left as they are
+def approve_actions(ids):
+    return ActionRequest.objects.filter(pk__in=ids, status=ActionRequest.PENDING).update(
+        status=ActionRequest.APPROVED, updated_at=timezone.now()
+    )
+
+def reject_actions(ids):
+    return ActionRequest.objects.filter(pk__in=ids, status=ActionRequest.PENDING).update(
+        status=ActionRequest.REJECTED, updated_at=timezone.now()
+    )
+
+# Update the Patient row for one request and return the graph write row for it
+def apply_to_patient(action_request):
+    patient = action_request.patient
+    payload = action_request.payload
+    if action_request.kind == ActionRequest.SCHEDULE_APPOINTMENT:
+        start = datetime.datetime.fromisoformat(payload['start'])
+        previous = patient.next_appointment
+        # Queryset updates, so post_save doesn't rewrite the whole graph neighbourhood
+        Patient.objects.filter(pk=patient.pk).update(last_appointment=previous, next_appointment=start)
+        patient.last_appointment, patient.next_appointment = previous, start
+        return {
+            'patient_id': patient.id,
+            'start': format_datetime(start),
+            'previous': format_datetime(previous),
+            'action_key': action_request.idempotency_key,
+        }
+    medications = split_patient_field(patient.medication_regime)
+    if payload['medication'].lower() not in {medication.lower() for medication in medications}:
+        medications.append(payload['medication'])
+        patient.medication_regime = ", ".join(medications)
+        Patient.objects.filter(pk=patient.pk).update(medication_regime=patient.medication_regime)
+    return {
+        'patient_id': patient.id,
+        'medication': payload['medication'],
+        'dosage': payload['dosage'],
+        'action_key': action_request.idempotency_key,
+    }
+
+# Whether the slot of an appointment request was taken since it was requested: by a booking
+# the availability index knows of, or by a request earlier in the same batch (booked_in_batch)
+def slot_taken(action_request, booked_in_batch):
+    patient = action_request.patient
+    if not settings.AVAILABILITY_CHECK_ENABLED or not patient.doctor_name:
+        return False
+    start = datetime.datetime.fromisoformat(action_request.payload['start'])
+    schedule = availability_index.get_schedule(patient.doctor_name)
+    if schedule is not None and schedule.conflicts(start, exclude=patient.next_appointment):
+        return True
+    batch_schedule = booked_in_batch.setdefault(patient.doctor_name, DoctorSchedule(patient.doctor_name))
+    if batch_schedule.conflicts(start):
+        return True
+    batch_schedule.book(start)
+    return False
+
+# Apply one batch of approved requests: the Patient rows and the graph are updated in one
+# Postgres transaction that wraps a single graph transaction, so a failed graph write
+# rolls the rows back and the batch is retried as a whole later. Appointment requests whose
+# slot is no longer free are rejected instead. Returns the requests of the batch, with
+# their new status.
+def apply_batch(driver):
+    with transaction.atomic():
+        pending = (
+            ActionRequest.objects.select_for_update(skip_locked=True)
+            .select_related('patient')
+            .filter(status=ActionRequest.APPROVED)
+            .order_by('id')[:settings.ACTION_BATCH_SIZE]
+        )
+        # At most one request per patient and kind, so rows of one UNWIND don't depend on each other
+        batch, seen = [], set()
+        for action_request in pending:
+            if (action_request.patient_id, action_request.kind) not in seen:
+                seen.add((action_request.patient_id, action_request.kind))
+                batch.append(action_request)
+        if not batch:
+            return []
+
+        rows = {ActionRequest.SCHEDULE_APPOINTMENT: [], ActionRequest.UPDATE_MEDICATION: []}
+        applied, rejected, booked_in_batch = [], [], {}
+        for action_request in batch:
+            if action_request.kind == ActionRequest.SCHEDULE_APPOINTMENT and slot_taken(action_request, booked_in_batch):
+                logger.info(f"Rejecting {action_request}, the slot {action_request.payload['start']} was taken since it was requested")
+                rejected.append(action_request)
+                continue
+            rows[action_request.kind].append(apply_to_patient(action_request))
+            applied.append(action_request)
+        statements = []
+        if rows[ActionRequest.SCHEDULE_APPOINTMENT]:
+            statements.append((APPOINTMENT_WRITE_QUERY, {'rows': rows[ActionRequest.SCHEDULE_APPOINTMENT]}))
+        if rows[ActionRequest.UPDATE_MEDICATION]:
+            statements.append((MEDICATION_WRITE_QUERY, {'rows': rows[ActionRequest.UPDATE_MEDICATION]}))
+        if statements:
+            driver.execute_write_transaction(statements)
+
+        now = timezone.now()
+        ActionRequest.objects.filter(pk__in=[action_request.pk for action_request in applied]).update(
+            status=ActionRequest.APPLIED, applied_at=now, updated_at=now
+        )
+        ActionRequest.objects.filter(pk__in=[action_request.pk for action_request in rejected]).update(
+            status=ActionRequest.REJECTED, updated_at=now
+        )
+    for action_request in applied:
+        action_request.status, action_request.applied_at = ActionRequest.APPLIED, now
+    for action_request in rejected:
+        action_request.status = ActionRequest.REJECTED
+    logger.info(f"Applied {len(applied)} approved actions in one graph transaction, rejected {len(rejected)}")
+    return batch
+
+# Caches, availability and open sockets of the patients an applied batch changed
+def after_apply(batch):
+    for action_request in batch:
+        patient = action_request.patient
+        if action_request.status == ActionRequest.REJECTED:
+            start = datetime.datetime.fromisoformat(action_request.payload['start'])
+            message = (
+                f"I'm sorry, the appointment on {timezone.localtime(start):%Y-%m-%d at %I:%M %p} with "
+                f"Dr. {patient.doctor_name} was booked by someone else. Please ask for another time."
+            )
+            async_to_sync(notify_patient)(patient.id, message)
+            continue
+        semantic_cache.invalidate(patient.id)
+        refresh_patient_context(patient)
+        if action_request.kind == ActionRequest.SCHEDULE_APPOINTMENT:
+            availability_index.book(patient.doctor_name, patient.next_appointment, previous=patient.last_appointment)
+            message = f"Dr. {patient.doctor_name} approved your appointment on {timezone.localtime(patient.next_appointment):%Y-%m-%d at %I:%M %p}."
+        else:
+            payload = action_request.payload
+            message = f"Dr. {patient.doctor_name} approved your medication update to {payload['medication']} at a dosage of {payload['dosage']}."
+        async_to_sync(notify_patient)(patient.id, message)
+
+# Apply all approved requests in batches of ACTION_BATCH_SIZE, returning the applied requests
+def apply_approved_actions():
+    applied = []
+    driver = Neo4jDriver()
+    try:
+        while True:
+            try:
+                batch = apply_batch(driver)
+            except Exception as e:
+                logger.error(f"Failed to apply approved actions, they will be retried: {e}")
+                break
+            if not batch:
+                break
+            after_apply(batch)
+            applied.extend(action_request for action_request in batch if action_request.status == ActionRequest.APPLIED)
+    finally:
+        driver.close()
+    return applied
@@ -1,5 +1,24 @@
 from django.contrib import admin
-from .models import Patient
+from .action_executor import apply_approved_actions, approve_actions, reject_actions
+from .models import ActionRequest, Patient
 
 # Register your models here.
-admin.site.register(Patient)
\ No newline at end of file
+admin.site.register(Patient)
+
+@admin.register(ActionRequest)
+class ActionRequestAdmin(admin.ModelAdmin):
+    list_display = ('id', 'patient', 'kind', 'payload', 'status', 'created_at', 'applied_at')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('idempotency_key', 'applied_at')
+    actions = ['approve', 'reject']
+
+    @admin.action(description="Approve and apply selected requests")
+    def approve(self, request, queryset):
+        approved = approve_actions(list(queryset.values_list('id', flat=True)))
+        applied = apply_approved_actions()
+        self.message_user(request, f"Approved {approved} and applied {len(applied)} requests.")
+
+    @admin.action(description="Reject selected requests")
+    def reject(self, request, queryset):
+        rejected = reject_actions(list(queryset.values_list('id', flat=True)))
+        self.message_user(request, f"Rejected {rejected} requests.")
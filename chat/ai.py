@@ -1,40 +1,61 @@
 import os
+import asyncio
 import json
 import datetime
 import re
+import numpy as np
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.schema import SystemMessage, HumanMessage, AIMessage
 from langchain_community.graphs import Neo4jGraph
-from langchain_community.chains.graph_qa.cypher import GraphCypherQAChain
 from langchain.prompts import PromptTemplate
 from .models import Patient
 from asgiref.sync import sync_to_async
 import logging
 from .ai_action_helpers import schedule_appointment_helper, update_medication_helper
 from .neo4j_helper import execute_cypher_query_helper
+from . import semantic_cache
+from .prefetch import start_prefetch, get_prefetched_context
+from .resolvers import resolve_from_patient, sql_resolvers
+from .cypher_fallback import CypherFallback
+from .db import aget_patient
+from .context import get_patient_context
+from . import turnlog
+from . import quotas
+from .stubs import StubChatModel
+from .structured_output import (
+    ScheduleAppointmentAction,
+    action_adapter,
+    astream_json_array,
+    information_intent_adapter,
+    parse_json_array,
+    prompt_intent_adapter,
+)
 from django.conf import settings
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize AI model
-llm = ChatGoogleGenerativeAI(
-    model='gemini-1.5-pro', # 'gemini-1.5-pro' or 'gemini-1.5'
-    api_key=settings.GEMINI_API_KEY, # Your API key
-    temperature=0.3,
-    max_tokens=None, # None for unlimited
-    timeout=None,
-    max_retries=2, # Number of retries if the request fails
-)
+# Initialize AI model, or the offline stub when load testing with CHAT_STUB_BACKENDS
+if settings.CHAT_STUB_BACKENDS:
+    llm = StubChatModel(
+        latency=settings.CHAT_STUB_MODEL_LATENCY_MS / 1000,
+        concurrency=settings.CHAT_STUB_MODEL_CONCURRENCY,
+    )
+else:
+    llm = ChatGoogleGenerativeAI(
+        model='gemini-1.5-pro', # 'gemini-1.5-pro' or 'gemini-1.5'
+        api_key=settings.GEMINI_API_KEY, # Your API key
+        temperature=0.3,
+        max_tokens=None, # None for unlimited
+        timeout=None,
+        max_retries=2, # Number of retries if the request fails
+    )
 logger.info("Initialized AI model")
 
+# The root prompt is the patient's materialised context document
 def get_root_prompt(patient):
-    return f"""You are an assistant providing health advice to {patient.first_name} {patient.last_name}, a patient under Dr. {patient.doctor_name}. 
-    You are currently talking to this patient.
-    Always be empathetic and assist based on their medical condition: {patient.medical_condition}.
-    Ignore unrelated topics such as politics or personal matters.
-    """
+    return get_patient_context(patient)
 
 # Define the schema for LangGraph
 schema = """
@@ -42,16 +63,19 @@ Nodes:
     - Patient(id, first_name, last_name, date_of_birth, phone_number, email)
     - Doctor(name)
     - MedicalCondition(name)
-    - Medication(name)
+    - MedicationRegime(name)
     - Appointment(date, type) # type: 'last' or 'next'
 Relationships:
     - (Patient)-[:ASSIGNED_TO]->(Doctor)
     - (Patient)-[:HAS_CONDITION]->(MedicalCondition)
-    - (Patient)-[:TAKES_MEDICATION]->(Medication)
+    - (Patient)-[:TAKES_MEDICATION]->(MedicationRegime)
     - (Patient)-[:HAD_APPOINTMENT]->(Appointment {type: 'last'})
     - (Patient)-[:HAS_APPOINTMENT]->(Appointment {type: 'next'})
 """
 
+# Text-to-Cypher fallback for questions outside intent_query_map
+cypher_fallback = CypherFallback(llm, schema)
+
 # Define intent query map
 intent_query_map = {
     "get_next_appointment": {
@@ -59,113 +83,214 @@ intent_query_map = {
             MATCH (p:Patient {id: $patient_id})-[:HAS_APPOINTMENT]->(a:Appointment {type: 'next'})
             RETURN a.date AS next_appointment
         """,
-        "process_result": lambda result: f"Your next appointment is on {result['next_appointment'].date()} at {result['next_appointment'].time()}."
+        "process_result": lambda result: f"Your next appointment is on {result['next_appointment'].date()} at {result['next_appointment'].time()}.",
+        "from_context": lambda context: [{"next_appointment": date} for date in context["next_appointments"]],
     },
     "get_last_appointment": {
         "query": """
             MATCH (p:Patient {id: $patient_id})-[:HAD_APPOINTMENT]->(a:Appointment {type: 'last'})
             RETURN a.date AS last_appointment
         """,
-        "process_result": lambda result: f"Your last appointment was on {result['last_appointment'].date()} at {result['last_appointment'].time()}."
+        "process_result": lambda result: f"Your last appointment was on {result['last_appointment'].date()} at {result['last_appointment'].time()}.",
+        "from_context": lambda context: [{"last_appointment": date} for date in context["last_appointments"]],
     },
     "get_medications": {
         "query": """
             MATCH (p:Patient {id: $patient_id})-[:TAKES_MEDICATION]->(m:MedicationRegime)
             RETURN m.name AS medication
         """,
-        "process_result": lambda results: f"You are currently taking: {', '.join([r['medication'] for r in results])}."
+        "process_result": lambda results: f"You are currently taking: {', '.join([r['medication'] for r in results])}.",
+        "from_context": lambda context: [{"medication": name} for name in context["medications"]],
     },
     "get_medical_conditions": {
         "query": """
             MATCH (p:Patient {id: $patient_id})-[:HAS_CONDITION]->(c:MedicalCondition)
             RETURN c.name AS condition
         """,
-        "process_result": lambda results: f"Your medical conditions are: {', '.join([r['condition'] for r in results])}."
+        "process_result": lambda results: f"Your medical conditions are: {', '.join([r['condition'] for r in results])}.",
+        "from_context": lambda context: [{"condition": name} for name in context["conditions"]],
     },
     "get_doctor_info": {
         "query": """
             MATCH (p:Patient {id: $patient_id})-[:ASSIGNED_TO]->(d:Doctor)
             RETURN d.name AS doctor_name
         """,
-        "process_result": lambda result: f"Your assigned doctor is Dr. {result['doctor_name']}."
+        "process_result": lambda result: f"Your assigned doctor is Dr. {result['doctor_name']}.",
+        "from_context": lambda context: [{"doctor_name": name} for name in context["doctors"]],
     },
 }
 
+# Typical questions of each intent, matched locally when the model can't be used
+intent_examples = {
+    "get_next_appointment": ["When is my next appointment?", "When do I see the doctor next?"],
+    "get_last_appointment": ["When was my last appointment?", "When did I last see the doctor?"],
+    "get_medications": ["What medications am I taking?", "What medicine do I take?"],
+    "get_medical_conditions": ["What conditions do I have?", "What is my diagnosis?"],
+    "get_doctor_info": ["Who is my doctor?", "Which doctor am I assigned to?"],
+}
+intent_example_labels = [intent for intent, examples in intent_examples.items() for _ in examples]
+intent_example_vectors = np.stack([
+    semantic_cache.embed_prompt(example, settings.SEMANTIC_CACHE_DIM)
+    for examples in intent_examples.values() for example in examples
+])
+
+# The information intent whose example questions are most similar to the prompt, if any is similar enough
+def match_information_intent(prompt):
+    similarities = intent_example_vectors @ semantic_cache.embed_prompt(prompt, settings.SEMANTIC_CACHE_DIM)
+    best = int(np.argmax(similarities))
+    if similarities[best] < settings.QUOTA_DEGRADED_MATCH_THRESHOLD:
+        return None
+    return intent_example_labels[best]
+
+# Intents the Patient row can't answer, which read the prefetched graph context
+graph_intents = {intent for intent in intent_query_map if intent not in sql_resolvers}
+
+# Whether a turn might need the graph context. Only prompts that clearly ask for what
+# sql_resolvers answer skip the prefetch; anything unclear might be a graph-backed intent.
+def may_need_graph(prompt):
+    similarities = intent_example_vectors @ semantic_cache.embed_prompt(prompt, settings.SEMANTIC_CACHE_DIM)
+    matched = {
+        label for label, similarity in zip(intent_example_labels, similarities)
+        if similarity >= settings.QUOTA_DEGRADED_MATCH_THRESHOLD
+    }
+    return not matched or bool(matched & graph_intents)
+
 # Generate response from AI
-async def generate_response(patient_id, prompt, conversation_history):
+@turnlog.record_turn
+async def generate_response(patient_id, prompt, conversation, patient=None, client_ip=None):
     logger.info(f"Generating response for patient_id: {patient_id} with prompt: {prompt}")
 
-    # Get the patient from the database
+    # Get the patient from the database, unless the caller already loaded it
     try:
-        patient = await sync_to_async(Patient.objects.get)(id=patient_id)
+        if patient is None:
+            with turnlog.stage("patient"):
+                patient = await aget_patient(patient_id)
     except Patient.DoesNotExist:    
         logger.error(f"Patient with id {patient_id} not found")
         return "Error: Patient not found"
 
-    # Summarize conversation histories if conversation is too long
-    if len(conversation_history) > 10:
-        context_summary = await summarize_conversation(patient, conversation_history)
-        conversation_history = []
-        conversation_history.append(SystemMessage(content=f'Summary: {context_summary}'))
-
-    # Create a context-aware prompt
-    context_conversation = '\n'.join(
-        [msg['message'] if isinstance(msg, dict) else msg.content for msg in conversation_history]
+    # Reuse the answer to a near-duplicate question of this patient, asked after the same messages
+    with turnlog.stage("cache"):
+        cached_response = semantic_cache.lookup(patient, prompt, semantic_cache.conversation_key(conversation))
+    if cached_response is not None:
+        turnlog.mark("cache_hit")
+        conversation.add('user', prompt)
+        conversation.add('bot', cached_response)
+        return cached_response
+
+    # Charge the turn to the patient's and the client's model quotas; over quota it is answered without the model
+    admission = await quotas.admit(
+        patient.id, client_ip, quotas.estimate_tokens(get_root_prompt(patient) + conversation.context + prompt)
     )
+    if not admission.allowed:
+        turnlog.mark("degraded")
+        return await answer_over_quota(patient, prompt, conversation, admission)
+    try:
+        return await answer_with_model(patient_id, patient, prompt, conversation)
+    finally:
+        await quotas.settle(admission)
+
+# Answer a turn through the model: classify the prompt and handle each intent
+async def answer_with_model(patient_id, patient, prompt, conversation):
+    # The messages the prompt follows, taken before a summary replaces them, as lookup saw them
+    context_key = semantic_cache.conversation_key(conversation)
+
+    # Summarize conversation histories if conversation is too long
+    if len(conversation) > 10:
+        with turnlog.stage("summary"):
+            context_summary = await summarize_conversation(patient, conversation)
+        conversation.replace_with_summary(context_summary)
+        turnlog.mark("summarized")
+
+    # Create a context-aware prompt from the incrementally maintained context
+    context_conversation = conversation.context
     latest_prompt = prompt
 
     contextual_prompt = f"Context: {context_conversation}\n\nUser's latest prompt: {latest_prompt}\n\Always focus on answering the latest prompt while considering the context provided."
 
 
     # Add user input to conversation history
-    conversation_history.append(HumanMessage(content=prompt))
-    logger.info(f"Conversation history for patient_id: {patient_id}: {conversation_history}")
+    conversation.add('user', prompt)
+    logger.info(f"Conversation history for patient_id: {patient_id} has {len(conversation)} messages")
+
+    # Warm the patient's graph context while the prompt is being classified, unless the
+    # Patient row answers what the prompt asks for; a lookup still needed then queries the graph
+    prefetch = start_prefetch(patient.id, patient.context_version) if may_need_graph(prompt) else None
 
     # Classify the prompt into intents
-    intents = classify_prompt(patient, contextual_prompt)
+    with turnlog.stage("classify"):
+        intents = await classify_prompt(patient, contextual_prompt)
     logger.info(f"Classified intents for patient_id: {patient_id}: {intents}")
+    turnlog.record_prompt_intents(intents)
 
     responses = []
+    # Whether every information intent was answered from the record or the graph
+    resolved = True
 
     if not intents:
         logger.info(f"No intents detected for patient_id: {patient_id}")
         # No intents detected, generate general response
-        response = generate_general_response(patient, contextual_prompt)
+        with turnlog.stage("general"):
+            response = generate_general_response(patient, contextual_prompt)
         responses.append(response)
     else:
         # Handle each intent
         for intent in intents:
             if intent == "get information":
-                response = await get_information_helper(patient, contextual_prompt)
+                with turnlog.stage("information"):
+                    response, resolved = await get_information_helper(patient, contextual_prompt, prefetch, question=prompt)
                 responses.append(response)
             elif intent == "do some action":
-                response = await do_some_action_helper(patient, contextual_prompt)
+                with turnlog.stage("action"):
+                    response = await do_some_action_helper(patient, contextual_prompt)
                 responses.append(response)
             else:
                 logger.warning(f"Unknown intent detected for patient_id: {patient_id}: {intent}")
-                responses.append("I'm sorry, I couldn't understand your request. Please provide more information or try again.")
+                responses.append(NOT_UNDERSTOOD)
 
     final_response = "\n".join(responses)
+
+    # Only read-only answers are cached, actions must always reach the model. Apologies for
+    # a failed lookup aren't, or a short Neo4j or model outage would be served for the TTL.
+    if intents == ["get information"] and resolved:
+        semantic_cache.store(patient, prompt, context_key, final_response)
     
     # Add AI response to conversation history
-    conversation_history.append(AIMessage(content=final_response))
+    conversation.add('bot', final_response)
 
     return final_response
 
+# Answer without any model call: the known question closest to the prompt, resolved from
+# the patient record or the prefetched graph context, or a notice to try again later
+async def answer_over_quota(patient, prompt, conversation, admission):
+    intent = match_information_intent(prompt)
+    if intent is not None:
+        prefetch = start_prefetch(patient.id, patient.context_version) if intent in graph_intents else None
+        with turnlog.stage("information"):
+            response = await resolve_information_intent(patient, intent, prompt, context_getter(prefetch))
+    else:
+        response = (
+            "You've sent a lot of messages in a short time. "
+            f"Please try again in {admission.retry_after_seconds} seconds."
+        )
+    conversation.add('user', prompt)
+    conversation.add('bot', response)
+    return response
+
 # Summarize conversation histories of a patient
-async def summarize_conversation(patient, conversation_history):
+async def summarize_conversation(patient, conversation):
     logger.info(f"Summarizing conversation history")
     root_prompt = get_root_prompt(patient)
     summary_response = llm.invoke([
         SystemMessage(content=f"{root_prompt} Summarize the following conversation history:"),
-        HumanMessage(content='\n'.join(
-            [msg['message'] if isinstance(msg, dict) else msg.content for msg in conversation_history])
-        )
+        HumanMessage(content=conversation.context)
     ])
+    turnlog.record_usage(summary_response)
+    quotas.record_usage(summary_response)
     return summary_response.content
 
 # Classify prompt into intents
-def classify_prompt(patient, prompt):
+async def classify_prompt(patient, prompt):
     logger.info(f"Classifying prompt: {prompt}")
     root_prompt = get_root_prompt(patient)
     classification_prompt = f"""
@@ -183,23 +308,11 @@ def classify_prompt(patient, prompt):
 
     Example: ["get information", "do some action"]
     """
-    response = llm.invoke(classification_prompt)
+    response = await llm.ainvoke(classification_prompt)
+    turnlog.record_usage(response)
+    quotas.record_usage(response)
     logger.info(f"Classified prompt: {prompt} into intents: {response.content}")
-    response = response.content.strip()
-    # Remove code fences if present
-    # Use regex to remove ```json ... ``` or ``` ... ```
-    response = re.sub(r'^```(?:json)?\s*([\s\S]*?)\s*```$', r'\1', response, flags=re.MULTILINE)
-
-    # Trim any leading/trailing whitespace
-    response = response.strip()
-    
-    # Parse the response as JSON
-    try:
-        intents = json.loads(response)
-        return intents
-    except json.JSONDecodeError:
-        logger.error(f"Failed to parse intents from response: {response.content}")
-        return []
+    return parse_json_array(response.content, prompt_intent_adapter) or []
 
 def generate_general_response(patient, prompt):
     logger.info(f"Generating general response")
@@ -212,48 +325,38 @@ def generate_general_response(patient, prompt):
     Please respond to the user in a clear and empathetic manner, as their patient assistant.
     """
     response = llm.invoke(general_prompt)
+    turnlog.record_usage(response)
+    quotas.record_usage(response)
     response_text = response.content.strip()
     logger.info(f"Generated general response: {response_text}")
     return response_text
     
-# Helper function to get information
-async def get_information_helper(patient, prompt):        
-    # Classify the prompt into intents
-    intents = await classify_intent(patient, prompt)
+# Helper function to get information. Returns the answer and whether every intent was
+# resolved, rather than answered with an apology or a general response.
+async def get_information_helper(patient, prompt, prefetch=None, question=None):
+    get_context = context_getter(prefetch)
+
+    # Classify the prompt into intents and start resolving each one.
+    # With early dispatch each intent is resolved as soon as its array element is streamed.
+    if settings.STRUCTURED_OUTPUT_EARLY_DISPATCH:
+        tasks = [
+            asyncio.ensure_future(resolve_information_intent(patient, intent, prompt, get_context, question))
+            async for intent in stream_intents(patient, prompt)
+        ]
+    else:
+        intents = await classify_intent(patient, prompt)
+        tasks = [
+            asyncio.ensure_future(resolve_information_intent(patient, intent, prompt, get_context, question))
+            for intent in intents
+        ]
 
     # No intents detected, generate general response
-    if not intents:
+    if not tasks:
         logger.info(f"No intents detected, generating general response")    
-        return await generate_general_response(patient, prompt)
-        
-    graph_data = {}
-    responses = []
-    tasks = []
-
-    # Handle each intent
-    for intent in intents:
-        if intent in intent_query_map:
-            query = intent_query_map[intent]["query"]
-            params = { "patient_id": patient.id }
-            try:
-                logger.info(f"Executing cypher query {query} with params {params} for intent: {intent}")
-                results = execute_cypher_query_helper(query, params)                
-                logger.info(f"Results for intent: {intent}: {results}")
-                if not results:
-                    responses.append("I'm sorry, I couldn't retrieve the information. Please try again.")
-                    continue
-                else:
-                    # Process the result(s)
-                    logger.info(f"Processing results for intent: {intent}")
-                    process_result = intent_query_map[intent]["process_result"](results[0] if intent in ["get_next_appointment", "get_last_appointment", "get_doctor_info"] else results)                
-                    logger.info(f"Processed result for intent: {intent}: {process_result}")
-                responses.append(process_result)
-            except Exception as e:
-                logger.error(f"Failed to get information: {e}")
-                responses.append("I'm sorry, I couldn't retrieve the information. Please try again.")
-        else:
-            logger.warning(f"Unknown intent detected: {intent}")
-            responses.append("I'm sorry, I couldn't understand your request. Please provide more information or try again.")    
+        return generate_general_response(patient, prompt), False
+
+    responses = await asyncio.gather(*tasks)
+    resolved = not any(response in UNRESOLVED_RESPONSES for response in responses)
 
     # Aggregate graph data for LLM
     # Optionally, if you need raw data, you can collect it here
@@ -265,15 +368,7 @@ async def get_information_helper(patient, prompt):
     # Generate a response from LLM
     llm_prompt = f"""
     {get_root_prompt(patient)}
-    Based on the following information, respond to the user in a clear and empathetic manner.
-
-    SQL Data:
-    - Name: {patient.first_name} {patient.last_name}
-    - Date of Birth: {patient.date_of_birth}
-    - Phone Number: {patient.phone_number}
-    - Email: {patient.email}
-    - Medical Condition: {patient.medical_condition}
-    - Doctor: {patient.doctor_name}
+    Based on the patient record above and the following information, respond to the user in a clear and empathetic manner.
 
     Graph Data:
     {aggregated_responses}
@@ -284,12 +379,86 @@ async def get_information_helper(patient, prompt):
     """
 
     response = await llm.ainvoke(llm_prompt)
+    turnlog.record_usage(response)
+    quotas.record_usage(response)
     final_response = response.content.strip()
-    return final_response
+    return final_response, resolved
+
+# The prefetched graph context, awaited at most once by the first intent that needs it
+def context_getter(prefetch):
+    context_task = None
+    def get_context():
+        nonlocal context_task
+        if context_task is None:
+            context_task = asyncio.ensure_future(get_prefetched_context(prefetch))
+        return context_task
+    return get_context
+
+# Replies of an intent that couldn't be resolved
+RETRIEVAL_FAILED = "I'm sorry, I couldn't retrieve the information. Please try again."
+NOT_UNDERSTOOD = "I'm sorry, I couldn't understand your request. Please provide more information or try again."
+UNRESOLVED_RESPONSES = (RETRIEVAL_FAILED, NOT_UNDERSTOOD)
+
+# Resolve a single information intent into the text handed to the final LLM prompt
+async def resolve_information_intent(patient, intent, prompt, get_context, question=None):
+    turnlog.record_information_intent(intent)
+    if intent in intent_query_map:
+        query = intent_query_map[intent]["query"]
+        params = { "patient_id": patient.id }
+        try:
+            # Serve intents the Patient row can answer without a graph round trip
+            results = resolve_from_patient(patient, intent)
+            if results is not None:
+                turnlog.mark("sql_resolved")
+            else:
+                # The graph context was prefetched in parallel with classification
+                context = await get_context()
+                if context is not None:
+                    turnlog.mark("prefetched")
+                    results = intent_query_map[intent]["from_context"](context)
+            if results is None:
+                logger.info(f"Executing cypher query {query} with params {params} for intent: {intent}")
+                results = execute_cypher_query_helper(query, params)                
+            logger.info(f"Results for intent: {intent}: {results}")
+            if not results:
+                return RETRIEVAL_FAILED
+            # Process the result(s)
+            logger.info(f"Processing results for intent: {intent}")
+            process_result = intent_query_map[intent]["process_result"](results[0] if intent in ["get_next_appointment", "get_last_appointment", "get_doctor_info"] else results)                
+            logger.info(f"Processed result for intent: {intent}: {process_result}")
+            return process_result
+        except Exception as e:
+            logger.error(f"Failed to get information: {e}")
+            return RETRIEVAL_FAILED
+    elif intent == "unknown_intent" and settings.CYPHER_FALLBACK_ENABLED:
+        # Answer questions outside intent_query_map with a generated read-only query
+        fallback_response = await cypher_fallback.answer(patient, question or prompt)
+        if fallback_response:
+            turnlog.mark("cypher_fallback")
+            return fallback_response
+        return NOT_UNDERSTOOD
+    else:
+        logger.warning(f"Unknown intent detected: {intent}")
+        return NOT_UNDERSTOOD
 
 # Classify Intent
 async def classify_intent(patient, prompt):
     logger.info(f"Classifying intent for prompt: {prompt}")
+    response = await llm.ainvoke(intent_classification_prompt(patient, prompt))
+    turnlog.record_usage(response)
+    quotas.record_usage(response)
+    intents = parse_json_array(response.content, information_intent_adapter) or []
+    logger.info(f"Classified intents : {intents}")
+    return intents
+
+# Stream the intent classification, yielding each intent as soon as the model has produced it
+async def stream_intents(patient, prompt):
+    logger.info(f"Streaming intents for prompt: {prompt}")
+    async for intent in astream_json_array(llm, intent_classification_prompt(patient, prompt), information_intent_adapter):
+        logger.info(f"Streamed intent: {intent}")
+        yield intent
+
+def intent_classification_prompt(patient, prompt):
     root_prompt = get_root_prompt(patient)
     classification_prompt = f"""
     {root_prompt}
@@ -314,28 +483,7 @@ async def classify_intent(patient, prompt):
     - ["get_next_appointment", "get_medications"]
     - ["unknown_intent"]
     """
-    response = await llm.ainvoke(classification_prompt)
-    intents = response.content.strip()
-
-    # Remove code fences if present
-    intents = re.sub(r'^```(?:json)?\s*([\s\S]*?)\s*```$', r'\1', intents, flags=re.MULTILINE).strip()
-    
-    # Parse the response as JSON
-    try:
-        intents = json.loads(intents)
-        # Ensure its a list
-        if isinstance(intents, str):
-            intents = [intents]
-        elif not isinstance(intents, list):
-            intents = []
-        #Validate against predefined intents
-        valid_intents = {"get_next_appointment", "get_last_appointment", "get_medications", "get_medical_conditions", "get_doctor_info", "unknown_intent"}
-        intents_list = [intent for intent in intents if intent in valid_intents]
-        logger.info(f"Classified intents : {intents_list}")
-        return intents_list
-    except json.JSONDecodeError:
-        logger.error(f"Failed to parse intents from response: {response.content}")
-        return []
+    return classification_prompt
 
 # Helper function to do some action
 async def do_some_action_helper(patient, prompt):
@@ -367,32 +515,35 @@ async def do_some_action_helper(patient, prompt):
     - update medication: medication, dosage
     """
 
-    response = await llm.ainvoke(action_extraction_prompt)
-    llm_response = response.content.strip()
-    # Remove code fences if present
-    llm_response = re.sub(r'^```(?:json)?\s*([\s\S]*?)\s*```$', r'\1', llm_response, flags=re.MULTILINE).strip()
-
-    logger.info(f"Extracted actions for patient_id: {patient.id} with prompt: {prompt}: {llm_response}")
+    # Start each action handler as soon as its element is streamed, or parse the full answer
+    if settings.STRUCTURED_OUTPUT_EARLY_DISPATCH:
+        tasks = [
+            asyncio.ensure_future(handle_action(patient, action))
+            async for action in astream_json_array(llm, action_extraction_prompt, action_adapter)
+        ]
+    else:
+        response = await llm.ainvoke(action_extraction_prompt)
+        turnlog.record_usage(response)
+        quotas.record_usage(response)
+        logger.info(f"Extracted actions for patient_id: {patient.id} with prompt: {prompt}: {response.content}")
+        actions = parse_json_array(response.content, action_adapter)
+        if actions is None:
+            return "I'm sorry, I couldn't understand the actions you want to perform. Please try again."
+        tasks = [asyncio.ensure_future(handle_action(patient, action)) for action in actions]
+
+    if not tasks:
+        logger.warning(f"No valid actions detected for patient_id: {patient.id}")
+        return "I'm sorry, I couldn't understand the action you want to perform. Please try again."
 
-    # Parse the response as JSON
-    try:
-        actions = json.loads(llm_response)
-    except json.JSONDecodeError:
-        logger.error(f"Failed to parse actions from response: {llm_response}")
-        return "I'm sorry, I couldn't understand the actions you want to perform. Please try again."
-    
     # Process the actions
-    action_responses = []
-    for action in actions:
-        action_type = action.get('action')
-        if action_type == 'schedule appointment':
-            action_response = await schedule_appointment_helper(patient, action)
-            action_responses.append(action_response['message'])
-        elif action_type == 'update medication':
-            action_response = await update_medication_helper(patient, action)
-            action_responses.append(action_response['message'])
-        else:
-            logger.warning(f"Unknown action detected for patient_id: {patient.id}: {action['action']}")
-            action_responses.append("I'm sorry, I couldn't understand the action you want to perform. Please try again.")
-
-    return "\n".join(action_responses)
\ No newline at end of file
+    action_responses = await asyncio.gather(*tasks)
+    return "\n".join(action_responses)
+
+# Run the handler for one validated action
+async def handle_action(patient, action):
+    logger.info(f"Handling action for patient_id: {patient.id}: {action.action}")
+    if isinstance(action, ScheduleAppointmentAction):
+        action_response = await schedule_appointment_helper(patient, action.model_dump())
+    else:
+        action_response = await update_medication_helper(patient, action.model_dump())
+    return action_response['message']
@@ -1,7 +1,10 @@
 import datetime
 import logging
-from asgiref.sync import sync_to_async
-from .neo4j_helper import execute_cypher_query_helper
+from django.conf import settings
+from django.utils import timezone
+from .availability import availability_index
+from .action_executor import request_action
+from .models import ActionRequest
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -16,24 +19,25 @@ def create_action_response(priority, requires_approval, message, notification=No
         'notification': notification
     }
 
+# Response to a request that was already made, e.g. resent after a reconnect
+def repeated_action_response(patient, action_request):
+    if action_request.status == ActionRequest.REJECTED:
+        message = f"Dr. {patient.doctor_name} has already declined this request."
+    elif action_request.status == ActionRequest.APPLIED:
+        message = f"Dr. {patient.doctor_name} has already approved this request."
+    else:
+        message = f"I have already conveyed this request to Dr. {patient.doctor_name}. You will be notified once it is approved."
+    return create_action_response(priority=2, requires_approval=False, message=message)
+
 # Helper function to schedule an appointment
 async def schedule_appointment_helper(patient, action):
     new_date = action.get('new_date')
     new_time = action.get('new_time')
     
     if new_date and new_time:
-        # Assuming the doctor is available at the requested date and time
-
         # Check if the date and time are valid
         try:
             next_appointment_datetime = datetime.datetime.strptime(f"{new_date} {new_time}", "%Y-%m-%d %I:%M %p")
-            logger.info(f"Scheduling appointment for patient_id: {patient.id} on {new_date} at {new_time}")
-            return create_action_response(
-                priority=1, 
-                requires_approval=True, 
-                message=f"I will convey your request to Dr. {patient.doctor_name}. Appointment is requested for {new_date} at {new_time}.",
-                notification=f"Patient {patient.first_name} {patient.last_name} has requested an appointment for {new_date} at {new_time}."
-            )
         except ValueError:
             logger.warning(f"Invalid date and time format provided for patient_id: {patient.id}")
             return create_action_response(
@@ -42,49 +46,47 @@ async def schedule_appointment_helper(patient, action):
                 message="Please provide a valid date and time for the appointment."
             )
 
-        
-        #try:
-            # Update the patient model
-            # next_appointment_datetime = datetime.datetime.strptime(f"{new_date} {new_time}", "%Y-%m-%d %I:%M %p")
-            # patient.next_appointment = next_appointment_datetime
-            # await sync_to_async(patient.save)()
+        requested = timezone.make_aware(next_appointment_datetime)
+        if requested == patient.next_appointment:
+            return create_action_response(
+                priority=2, 
+                requires_approval=False, 
+                message=f"Your next appointment with Dr. {patient.doctor_name} is already on {new_date} at {new_time}."
+            )
 
-            # Update the graph database
-            # Set the previous appointment of type 'next' to 'last'
-            # execute_cypher_query_helper(
-            #     """
-            #     MATCH (p:Patient {id: $patient_id})-[:HAS_APPOINTMENT]->(a:Appointment {type: 'next'})
-            #     SET a.type = 'last'
-            #     """,
-            #     {'patient_id': patient.id}
-            # )
-            
-            # Create a new appointment node and connect the patient to it
-            # execute_cypher_query_helper(
-            #     """
-            #     MATCH (p:Patient {id: $patient_id})
-            #     CREATE (a:Appointment {date: $next_appointment, type: 'next'})
-            #     CREATE (p)-[:HAS_APPOINTMENT]->(a)
-            #     """,
-            #     {
-            #         'patient_id': patient.id,
-            #         'next_appointment': format_datetime(next_appointment_datetime)
-            #     }
-            # )            
+        # Check the doctor is available, and propose alternatives in the same turn if not
+        if settings.AVAILABILITY_CHECK_ENABLED and patient.doctor_name:
+            schedule = await availability_index.aget_schedule(patient.doctor_name)
+            if schedule is None:
+                logger.warning(f"Availability of Dr. {patient.doctor_name} unknown, skipping the conflict check")
+            elif not schedule.is_free(requested, exclude=patient.next_appointment):
+                alternatives = schedule.next_free_slots(requested, settings.APPOINTMENT_ALTERNATIVES, exclude=patient.next_appointment)
+                logger.info(f"Dr. {patient.doctor_name} is not available on {new_date} at {new_time} for patient_id: {patient.id}")
+                if not alternatives:
+                    return create_action_response(
+                        priority=2, 
+                        requires_approval=False, 
+                        message=f"I'm sorry, Dr. {patient.doctor_name} is not available on {new_date} at {new_time} and has no free slots in the coming weeks."
+                    )
+                slots = "\n".join(f"- {format_slot(slot)}" for slot in alternatives)
+                return create_action_response(
+                    priority=2, 
+                    requires_approval=False, 
+                    message=f"I'm sorry, Dr. {patient.doctor_name} is not available on {new_date} at {new_time}. The next available slots are:\n{slots}\nWould you like to book one of these instead?"
+                )
 
-            # return create_action_response(
-            #     priority=1, 
-            #     requires_approval=True, 
-            #     message=f"I will convey your request to Dr. {patient.doctor_name}. Appointment is requested for {new_date} at {new_time}.",
-            #     notification=f"Patient {patient.first_name} {patient.last_name} has requested an appointment for {new_date} at {new_time}."
-            # )
-        #except Exception as e:
-            # logger.error(f"Failed to schedule appointment for patient_id: {patient.id}: {e}")
-            # return create_action_response(
-            #     priority=2, 
-            #     requires_approval=False, 
-            #     message="I'm sorry, I couldn't schedule the appointment. Please try again."
-            # )
+        logger.info(f"Scheduling appointment for patient_id: {patient.id} on {new_date} at {new_time}")
+        action_request, created = await request_action(
+            patient, ActionRequest.SCHEDULE_APPOINTMENT, {'start': format_datetime(requested)}
+        )
+        if not created:
+            return repeated_action_response(patient, action_request)
+        return create_action_response(
+            priority=1, 
+            requires_approval=True, 
+            message=f"I will convey your request to Dr. {patient.doctor_name}. Appointment is requested for {new_date} at {new_time}.",
+            notification=f"Patient {patient.first_name} {patient.last_name} has requested an appointment for {new_date} at {new_time}."
+        )
     else:
         logger.warning(f"Invalid appointment details provided for patient_id: {patient.id}")
         return create_action_response(
@@ -107,6 +109,11 @@ async def update_medication_helper(patient, intent):
                 message=f"I will convey your concerns to Dr. {patient.doctor_name}"
             )
         logger.info(f"Updating medication for patient_id: {patient.id} to {medication} at a dosage of {dosage}")
+        action_request, created = await request_action(
+            patient, ActionRequest.UPDATE_MEDICATION, {'medication': medication, 'dosage': dosage}
+        )
+        if not created:
+            return repeated_action_response(patient, action_request)
 
         return create_action_response(
             priority=1, 
@@ -128,4 +135,7 @@ def format_datetime(dt):
             if dt.tzinfo is None:
                 dt = dt.replace(tzinfo=datetime.timezone.utc)
             return dt.isoformat()
-        return None    
\ No newline at end of file
+        return None
+
+def format_slot(slot):
+    return timezone.localtime(slot).strftime("%Y-%m-%d at %I:%M %p")
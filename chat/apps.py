@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 # Configuration for the chat application.
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    # Register the system checks, and map the patient snapshot once per process so a fresh
+    # worker answers its first turns like a warm one. The mapping is read-only and shared
+    # with the other workers.
+    def ready(self):
+        from . import checks  # noqa: F401
+        if settings.PATIENT_SNAPSHOT_ENABLED:
+            from .snapshot import load_snapshot
+            load_snapshot(settings.PATIENT_SNAPSHOT_PATH)
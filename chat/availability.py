@@ -0,0 +1,177 @@
+import asyncio
+import bisect
+import datetime
+import logging
+import threading
+import time
+from zoneinfo import ZoneInfo
+from django.conf import settings
+from .neo4j_helper import execute_cypher_query_helper
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Upcoming appointments of all patients assigned to a doctor
+BOOKED_SLOTS_QUERY = """
+    MATCH (d:Doctor {name: $doctor_name})<-[:ASSIGNED_TO]-(:Patient)-[:HAS_APPOINTMENT]->(a:Appointment {type: 'next'})
+    WHERE a.date >= datetime($since)
+    RETURN DISTINCT a.date AS date
+"""
+
+def to_timestamp(value):
+    if hasattr(value, 'to_native'):
+        value = value.to_native()
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return int(value.timestamp())
+
+# Booked appointment start times of one doctor, kept as a sorted array of epoch seconds.
+# Every appointment lasts APPOINTMENT_SLOT_MINUTES, so a slot conflicts with a booking
+# exactly when a booked start lies within one slot length of it, which is a single bisect.
+# run_ends[i] is the end of the run of back-to-back bookings starting at starts[i]: no slot
+# fits before it, so a search for free slots jumps there in one step.
+class DoctorSchedule:
+    def __init__(self, doctor_name, starts=()):
+        self.doctor_name = doctor_name
+        self.starts = sorted(set(starts))
+        self.slot_seconds = settings.APPOINTMENT_SLOT_MINUTES * 60
+        self.timezone = ZoneInfo(settings.TIME_ZONE)
+        self.loaded_at = time.monotonic()
+        self.index_runs()
+
+    # Bookings are in one run while the gap between them is shorter than a slot
+    def index_runs(self):
+        self.run_ends = [start + self.slot_seconds for start in self.starts]
+        for index in range(len(self.starts) - 2, -1, -1):
+            if self.starts[index + 1] < self.run_ends[index] + self.slot_seconds:
+                self.run_ends[index] = max(self.run_ends[index], self.run_ends[index + 1])
+
+    def book(self, start):
+        timestamp = to_timestamp(start)
+        index = bisect.bisect_left(self.starts, timestamp)
+        if index == len(self.starts) or self.starts[index] != timestamp:
+            self.starts.insert(index, timestamp)
+            self.index_runs()
+
+    def cancel(self, start):
+        timestamp = to_timestamp(start)
+        index = bisect.bisect_left(self.starts, timestamp)
+        if index < len(self.starts) and self.starts[index] == timestamp:
+            del self.starts[index]
+            self.index_runs()
+
+    # Index of the first booking overlapping the slot starting at `timestamp`, ignoring the
+    # booking at `excluded` (the patient's own appointment when they are moving it), or None
+    def first_conflict(self, timestamp, excluded=None):
+        index = bisect.bisect_right(self.starts, timestamp - self.slot_seconds)
+        while index < len(self.starts) and self.starts[index] < timestamp + self.slot_seconds:
+            if self.starts[index] != excluded:
+                return index
+            index += 1
+        return None
+
+    def conflicts(self, start, exclude=None):
+        return self.first_conflict(to_timestamp(start), to_timestamp(exclude) if exclude else None) is not None
+
+    # Whether the slot lies within working hours on a working day
+    def within_working_hours(self, start):
+        local = start.astimezone(self.timezone)
+        opening = local.replace(hour=settings.CLINIC_OPENING_HOUR, minute=0, second=0, microsecond=0)
+        closing = local.replace(hour=settings.CLINIC_CLOSING_HOUR, minute=0, second=0, microsecond=0)
+        return (
+            local.weekday() in settings.CLINIC_WORKING_DAYS
+            and opening <= local
+            and local + datetime.timedelta(seconds=self.slot_seconds) <= closing
+        )
+
+    def is_free(self, start, exclude=None):
+        return (
+            start > datetime.datetime.now(datetime.timezone.utc)
+            and self.within_working_hours(start)
+            and not self.conflicts(start, exclude)
+        )
+
+    # First slot boundary within working hours at or after `after`
+    def first_working_slot(self, after):
+        local = after.astimezone(self.timezone)
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = (local - midnight).total_seconds()
+        slots = -(-elapsed // self.slot_seconds)
+        candidate = midnight + datetime.timedelta(seconds=slots * self.slot_seconds)
+        for _ in range(8):
+            opening = candidate.replace(hour=settings.CLINIC_OPENING_HOUR, minute=0, second=0, microsecond=0)
+            if candidate < opening:
+                candidate = opening
+            if self.within_working_hours(candidate):
+                return candidate
+            candidate = (candidate + datetime.timedelta(days=1)).replace(
+                hour=settings.CLINIC_OPENING_HOUR, minute=0, second=0, microsecond=0
+            )
+        return None
+
+    # Up to n free slots at or after `after`, within APPOINTMENT_SEARCH_DAYS. A taken slot
+    # jumps to the end of its run of bookings, and first_working_slot jumps over closed
+    # hours, so the search costs a bisect per run and day passed, not per slot.
+    def next_free_slots(self, after, n, exclude=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        after = max(after, now)
+        limit = after + datetime.timedelta(days=settings.APPOINTMENT_SEARCH_DAYS)
+        excluded = to_timestamp(exclude) if exclude else None
+        slots = []
+        candidate = self.first_working_slot(after)
+        while candidate is not None and candidate < limit and len(slots) < n:
+            index = self.first_conflict(to_timestamp(candidate), excluded)
+            if index is None:
+                slots.append(candidate)
+                resume = to_timestamp(candidate) + self.slot_seconds
+            elif excluded is not None and self.starts[index] < excluded < self.run_ends[index]:
+                # The excluded booking frees room inside this run, so only step past the conflict
+                resume = self.starts[index] + self.slot_seconds
+            else:
+                resume = self.run_ends[index]
+            candidate = self.first_working_slot(datetime.datetime.fromtimestamp(resume, tz=datetime.timezone.utc))
+        return slots
+
+
+# Per-doctor schedules, loaded from the Appointment nodes on first use and
+# reloaded after AVAILABILITY_REFRESH_SECONDS to pick up changes made elsewhere
+class AvailabilityIndex:
+    def __init__(self):
+        self.schedules = {}
+        self.lock = threading.Lock()
+
+    def load(self, doctor_name):
+        since = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        results = execute_cypher_query_helper(BOOKED_SLOTS_QUERY, {"doctor_name": doctor_name, "since": since})
+        if results is None:
+            return None
+        schedule = DoctorSchedule(doctor_name, [to_timestamp(row["date"]) for row in results])
+        logger.info(f"Loaded {len(schedule.starts)} booked slots for Dr. {doctor_name}")
+        return schedule
+
+    def get_schedule(self, doctor_name):
+        with self.lock:
+            schedule = self.schedules.get(doctor_name)
+            if schedule is not None and time.monotonic() - schedule.loaded_at < settings.AVAILABILITY_REFRESH_SECONDS:
+                return schedule
+        schedule = self.load(doctor_name)
+        if schedule is not None:
+            with self.lock:
+                self.schedules[doctor_name] = schedule
+        return schedule
+
+    async def aget_schedule(self, doctor_name):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_schedule, doctor_name)
+
+    # Record a booking made by this process without waiting for the next reload
+    def book(self, doctor_name, start, previous=None):
+        with self.lock:
+            schedule = self.schedules.get(doctor_name)
+            if schedule is None:
+                return
+            if previous:
+                schedule.cancel(previous)
+            schedule.book(start)
+
+
+availability_index = AvailabilityIndex()
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.checks import Tags, Warning, register
+
+# With DEBUG off the chat page links the hashed names in the staticfiles manifest, which only
+# collectstatic writes. Without it the page falls back to unhashed, uncached names.
+@register(Tags.staticfiles)
+def check_staticfiles_manifest(app_configs, **kwargs):
+    if settings.DEBUG or not hasattr(staticfiles_storage, 'manifest_name'):
+        return []
+    if staticfiles_storage.exists(staticfiles_storage.manifest_name):
+        return []
+    return [
+        Warning(
+            f"No staticfiles manifest at {staticfiles_storage.path(staticfiles_storage.manifest_name)}",
+            hint="Run 'python manage.py collectstatic --noinput' before starting the server with DEBUG=False.",
+            id='chat.W001',
+        )
+    ]
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Close codes sent to evicted sockets
+CLOSE_IDLE = 4001
+CLOSE_HEARTBEAT_TIMEOUT = 4002
+CLOSE_SERVICE_RESTART = 4012
+
+# Process-local registry of open chat sockets. A single sweeper task closes sockets whose
+# client stopped sending heartbeats or that have been idle for too long, instead of
+# keeping a timer per connection.
+class ConnectionRegistry:
+    def __init__(self):
+        self.connections = {}
+        self.sweeper = None
+
+    def __len__(self):
+        return len(self.connections)
+
+    def register(self, consumer):
+        self.connections[consumer.channel_name] = consumer
+        if self.sweeper is None or self.sweeper.done():
+            self.sweeper = asyncio.ensure_future(self.sweep())
+
+    def unregister(self, consumer):
+        self.connections.pop(consumer.channel_name, None)
+
+    async def sweep(self):
+        while self.connections:
+            await asyncio.sleep(settings.CHAT_SWEEP_INTERVAL)
+            now = time.monotonic()
+            for consumer in list(self.connections.values()):
+                if consumer.last_ping is not None and now - consumer.last_ping > settings.CHAT_HEARTBEAT_TIMEOUT:
+                    await self.evict(consumer, CLOSE_HEARTBEAT_TIMEOUT)
+                elif now - consumer.last_active > settings.CHAT_IDLE_TIMEOUT:
+                    await self.evict(consumer, CLOSE_IDLE)
+
+    async def evict(self, consumer, code):
+        logger.info(f"Evicting WebSocket connection of patient_id: {consumer.patient_id} with code: {code}")
+        self.unregister(consumer)
+        try:
+            await consumer.close(code=code)
+        except Exception as e:
+            logger.error(f"Failed to close WebSocket connection: {e}")
+
+    # Ask every client to reconnect, to another worker, and close its socket. Turns being
+    # answered are finished first, for at most `timeout` seconds.
+    async def drain(self, timeout):
+        logger.info(f"Draining {len(self.connections)} WebSocket connections")
+        deadline = time.monotonic() + timeout
+        while self.connections:
+            expired = time.monotonic() >= deadline
+            for consumer in list(self.connections.values()):
+                if expired or not consumer.answering:
+                    await self.reconnect(consumer)
+            if self.connections:
+                await asyncio.sleep(0.1)
+
+    async def reconnect(self, consumer):
+        self.unregister(consumer)
+        try:
+            await consumer.send_frame({'type': 'reconnect'})
+            await consumer.close(code=CLOSE_SERVICE_RESTART)
+        except Exception as e:
+            logger.error(f"Failed to close WebSocket connection: {e}")
+
+
+connection_registry = ConnectionRegistry()
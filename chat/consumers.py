@@ -1,8 +1,15 @@
 import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 import json
 from .ai import generate_response
 from .models import Patient
+from .db import aget_patient
+from .notifications import patient_group_name
+from .conversation import ConversationState
+from .connections import connection_registry
+from .profiling import profiling_enabled, should_profile, profile_turn
+from .wire import MSGPACK_SUBPROTOCOL, select_subprotocol, echo_requested, encode_frame, decode_frame
 from asgiref.sync import sync_to_async
 
 logger = logging.getLogger(__name__)
@@ -11,51 +18,103 @@ class ChatConsumer(AsyncWebsocketConsumer):
     # This method is called when the connection is established
     async def connect(self):
         logger.info("ChatConsumer.connect called")
-        await self.accept()
+        self.patient_id = int(self.scope['url_route']['kwargs']['patient_id'])
+        self.group_name = patient_group_name(self.patient_id)
+        # Join the patient's group so any worker can push messages to this socket
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # Negotiate the frame encoding and whether the client wants its messages echoed
+        subprotocol = select_subprotocol(self.scope.get('subprotocols', []))
+        self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+        self.echo = echo_requested(self.scope)
+        # Address the socket's model quota is charged to, set from proxy headers when daphne runs with --proxy-headers
+        self.client_ip = (self.scope.get('client') or [None])[0]
+        await self.accept(subprotocol=subprotocol)
         logger.info("WebSocket connection established")
-        self.conversation_history = [] # Initialize conversation history
+        self.init_connection_state()
+        connection_registry.register(self)
 
-    # This method is called when the connection is closed
+    # Per-connection state, kept small so a worker can hold many mostly idle sockets
+    def init_connection_state(self):
+        self.conversation = ConversationState() # Initialize conversation history
+        self.last_active = time.monotonic() # Last chat message
+        self.last_ping = None # Last heartbeat, None until the client sends one
+        self.answering = False # A turn is being answered, draining waits for it
+
+    # This method is called when the connection is closed, also when connect didn't get far
+    # enough to join the group or set up the connection state
     async def disconnect(self, close_code):
         logger.info(f"WebSocket connection closed with code: {close_code}")
-        self.conversation_history = [] # Clear conversation history
+        connection_registry.unregister(self)
+        if getattr(self, 'group_name', None) is not None:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if getattr(self, 'conversation', None) is not None:
+            self.conversation.clear() # Clear conversation history
+
+    # Send a frame in the encoding negotiated in connect
+    async def send_frame(self, payload):
+        if self.binary:
+            await self.send(bytes_data=encode_frame(payload, True))
+        else:
+            await self.send(text_data=encode_frame(payload, False))
 
     # This method is called whe6n the patient sends a message
-    async def receive(self, text_data):
-        logger.info(f"Received message: {text_data}")
-        data = json.loads(text_data) # Parse the JSON data
+    async def receive(self, text_data=None, bytes_data=None):
+        data = decode_frame(text_data, bytes_data) # Parse the JSON or msgpack data
+
+        # Answer heartbeats without touching the idle timer
+        if data.get('type') == 'ping':
+            self.last_ping = time.monotonic()
+            await self.send_frame({'type': 'pong'})
+            return
+
+        logger.info(f"Received message: {data}")
+        self.last_active = time.monotonic()
+        if self.last_ping is not None:
+            self.last_ping = self.last_active
         message = data['message'] # Get the message from the data
-        patient_id = data.get('patient_id') # Get the patient ID from the message
+        patient_id = self.patient_id # The socket is bound to the patient in the URL
 
         # Get the patient from the database
         try:
-            patient = await sync_to_async(Patient.objects.get)(id=patient_id)
+            patient = await aget_patient(patient_id)
             logger.info(f"Patient found: {patient_id}")
         except Patient.DoesNotExist:
             logger.error(f"Patient not found: {patient_id}")
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'message': "Error: Patient not found"
-            }))
+            })
             return
-        
-        # Add the patient's message to the conversation history
-        self.conversation_history.append({
-            'sender': 'user',
-            'message': message
-        })        
 
         # Send the patient's message back to the client (echo)
-        await self.send(text_data=json.dumps({
-            'sender': 'user',
-            'message': message
-        }))
-
-        # Generate a response from the AI
-        bot_response = await generate_response(patient_id, message, self.conversation_history)
-        
-        # Send the bot's response back to the client
-        await self.send(text_data=json.dumps({
-            'sender': 'bot',
-            'message': bot_response,
-            'format': 'markdown'
-        }))
\ No newline at end of file
+        if self.echo:
+            await self.send_frame({
+                'sender': 'user',
+                'message': message
+            })
+
+        self.answering = True
+        try:
+            # Generate a response from the AI, profiling a sampled fraction of turns
+            if profiling_enabled and should_profile(data):
+                bot_response = await profile_turn(
+                    generate_response(patient_id, message, self.conversation, patient=patient, client_ip=self.client_ip), patient_id
+                )
+            else:
+                bot_response = await generate_response(patient_id, message, self.conversation, patient=patient, client_ip=self.client_ip)
+
+            # Send the bot's response back to the client
+            await self.send_frame({
+                'sender': 'bot',
+                'message': bot_response,
+                'format': 'markdown'
+            })
+        finally:
+            self.answering = False
+
+    # This method is called for group messages sent with notify_patient
+    async def patient_message(self, event):
+        await self.send_frame({
+            'sender': event['sender'],
+            'message': event['message'],
+            'format': event.get('format', 'markdown')
+        })
@@ -0,0 +1,44 @@
+import logging
+from django.db.models import F
+from .resolvers import split_patient_field
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Build the patient context document every prompt of this patient starts with.
+# It only changes when the patient record changes, which keeps prompt prefixes stable.
+# Contact details and the date of birth are left out, no prompt needs them.
+def build_patient_context(patient):
+    return f"""You are an assistant providing health advice to {patient.first_name} {patient.last_name}, a patient under Dr. {patient.doctor_name}.
+You are currently talking to this patient.
+Always be empathetic and assist based on their medical condition: {patient.medical_condition}.
+Ignore unrelated topics such as politics or personal matters.
+
+Patient record:
+- Name: {patient.first_name} {patient.last_name}
+- Medical Conditions: {', '.join(split_patient_field(patient.medical_condition))}
+- Medications: {', '.join(split_patient_field(patient.medication_regime))}
+- Doctor: {patient.doctor_name}
+- Last Appointment: {patient.last_appointment}
+- Next Appointment: {patient.next_appointment}
+"""
+
+# Rebuild the stored context document of a patient, bumping its version if it changed
+def refresh_patient_context(patient):
+    document = build_patient_context(patient)
+    if document == patient.context_document:
+        return
+    # A queryset update, so post_save doesn't fire again
+    type(patient).objects.filter(pk=patient.pk).update(
+        context_document=document,
+        context_version=F('context_version') + 1,
+    )
+    patient.context_document = document
+    patient.context_version += 1
+    logger.info(f"Refreshed context document for patient_id: {patient.id} to version {patient.context_version}")
+
+# The context document of a patient, built on the fly for rows saved without signals
+def get_patient_context(patient):
+    if patient.context_document:
+        return patient.context_document
+    return build_patient_context(patient)
@@ -0,0 +1,36 @@
+# One message of a conversation
+class Turn:
+    __slots__ = ('sender', 'text')
+
+    def __init__(self, sender, text):
+        self.sender = sender
+        self.text = text
+
+# Conversation state of one socket. The context string the prompts need is
+# maintained incrementally instead of being re-joined from the history every turn,
+# and an idle connection holds no turn list at all.
+class ConversationState:
+    __slots__ = ('turns', 'context')
+
+    def __init__(self):
+        self.turns = None
+        self.context = ''
+
+    def __len__(self):
+        return len(self.turns) if self.turns else 0
+
+    def add(self, sender, text):
+        if self.turns is None:
+            self.turns = []
+        self.turns.append(Turn(sender, text))
+        self.context = f"{self.context}\n{text}" if self.context else text
+
+    # Replace the history with a summary of it
+    def replace_with_summary(self, summary):
+        self.turns = None
+        self.context = ''
+        self.add('system', f"Summary: {summary}")
+
+    def clear(self):
+        self.turns = None
+        self.context = ''
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import re
+from cachetools import LRUCache
+from django.conf import settings
+from langchain.prompts import PromptTemplate
+from .neo4j_helper import execute_read_only_query_helper
+from .resolvers import split_patient_field
+from . import quotas, turnlog
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Clauses and procedures that could modify the graph or reach outside the schema
+FORBIDDEN_CYPHER = re.compile(
+    r"\b(CREATE|MERGE|DELETE|DETACH|SET|REMOVE|DROP|LOAD|FOREACH|CALL|USE|GRANT|DENY|REVOKE|apoc|db|dbms|gds)\b",
+    re.IGNORECASE,
+)
+STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+NODE_LABEL = re.compile(r"\(\s*\w*\s*((?::\s*`?\w+`?\s*)+)")
+RELATIONSHIP_TYPE = re.compile(r"\[\s*\w*\s*:\s*([\w|`:\s]+?)\s*[\]{*]")
+PARAMETER = re.compile(r"\$(\w+)")
+PATIENT_ANCHOR = re.compile(r"\(\s*(\w+)\s*:\s*Patient\s*\{\s*id\s*:\s*\$patient_id\s*\}\s*\)")
+# A node pattern that starts a path, i.e. one not preceded by a relationship arrow
+PATH_START = re.compile(r"(?<![\w>\-])\(\s*(\w*)\s*(?=[:){])")
+
+# Literal values that are lifted out of a question and passed as query parameters
+QUESTION_LITERALS = [
+    ("date", re.compile(r"\b\d{4}-\d{2}-\d{2}\b")),
+    ("number", re.compile(r"\b\d+(?:\.\d+)?\b")),
+    ("text", re.compile(r"\"([^\"]+)\"|'([^']+)'")),
+]
+
+CYPHER_GENERATION_PROMPT = PromptTemplate.from_template("""
+You translate patient questions into Cypher queries for a Neo4j graph with this schema:
+{schema}
+
+Rules:
+- Only read data: use MATCH, OPTIONAL MATCH, WHERE, WITH, RETURN, ORDER BY and LIMIT.
+- Only use the node labels, relationship types and properties listed in the schema.
+- Always anchor the query on the patient: MATCH (p:Patient {{id: $patient_id}}).
+- Use the parameters {parameters} for the literal values in the question, never inline them.
+- Return readable columns with aliases and add LIMIT {limit}.
+
+Question: "{question}"
+
+Provide only the Cypher query, without code fences, explanations, or additional text.
+If the question cannot be answered from this schema, respond with NONE.
+""")
+
+# Question shape and parameters: literals and the patient's own entities become placeholders,
+# so "Do I take Aspirin?" and "Do I take Metformin?" share one template
+def question_shape(patient, question):
+    entities = [
+        ("medication", name) for name in split_patient_field(patient.medication_regime)
+    ] + [
+        ("condition", name) for name in split_patient_field(patient.medical_condition)
+    ]
+    if patient.doctor_name:
+        entities.append(("doctor", patient.doctor_name))
+
+    matches = []
+    for kind, pattern in QUESTION_LITERALS:
+        for match in pattern.finditer(question):
+            value = next((group for group in match.groups() if group), match.group(0))
+            matches.append((match.start(), match.end(), kind, value))
+    for kind, name in entities:
+        for match in re.finditer(rf"\b{re.escape(name)}\b", question, re.IGNORECASE):
+            matches.append((match.start(), match.end(), kind, name))
+
+    # Keep the earliest, longest of any overlapping matches
+    shape, params, position = [], {}, 0
+    for start, end, kind, value in sorted(matches, key=lambda match: (match[0], -match[1])):
+        if start < position:
+            continue
+        name = f"p{len(params)}"
+        shape.append(question[position:start].lower())
+        shape.append(f"${name}:{kind}")
+        params[name] = float(value) if kind == "number" else value
+        position = end
+    shape.append(question[position:].lower())
+    normalized = re.sub(r"[^\w$:]+", " ", "".join(shape)).strip()
+    return normalized, params
+
+# Text-to-Cypher for questions outside intent_query_map. Generated queries are validated
+# against the schema and cached as parameterised templates keyed by question shape.
+class CypherFallback:
+    def __init__(self, llm, schema):
+        self.llm = llm
+        self.schema = schema
+        self.labels = set(re.findall(r"-\s*(\w+)\(", schema))
+        self.relationship_types = set(re.findall(r"\[:(\w+)\]", schema))
+        self.templates = LRUCache(maxsize=settings.CYPHER_TEMPLATE_CACHE_SIZE)
+        self.pending = {}
+
+    # Check a generated query is read-only, anchored on the patient and within the schema
+    def validate(self, query, allowed_params):
+        stripped = STRING_LITERAL.sub("''", query)
+        if FORBIDDEN_CYPHER.search(stripped):
+            return "query is not read-only"
+        # Every path has to start at the patient and only follow outgoing relationships,
+        # which in this schema never lead to another patient's data
+        anchor = PATIENT_ANCHOR.search(stripped)
+        if anchor is None:
+            return "query is not anchored on the patient"
+        if len(re.findall(r":\s*Patient\b", stripped)) != len(PATIENT_ANCHOR.findall(stripped)):
+            return "query matches patients other than the current one"
+        if any(variable != anchor.group(1) for variable in PATH_START.findall(stripped)):
+            return "query has a path that does not start at the patient"
+        if "<-" in stripped or re.search(r"\]-(?!>)|--(?!>)", stripped):
+            return "query follows relationships backwards or undirected"
+        for group in NODE_LABEL.findall(stripped):
+            for label in re.findall(r"\w+", group):
+                if label not in self.labels:
+                    return f"unknown label {label}"
+        for group in RELATIONSHIP_TYPE.findall(stripped):
+            for relationship_type in re.findall(r"\w+", group):
+                if relationship_type not in self.relationship_types:
+                    return f"unknown relationship type {relationship_type}"
+        unknown_params = set(PARAMETER.findall(stripped)) - set(allowed_params) - {"patient_id"}
+        if unknown_params:
+            return f"unknown parameters {sorted(unknown_params)}"
+        return None
+
+    async def generate_template(self, shape, params):
+        parameters = ", ".join(["$patient_id"] + [f"${name}" for name in params])
+        prompt = CYPHER_GENERATION_PROMPT.format(
+            schema=self.schema,
+            parameters=parameters,
+            limit=settings.CYPHER_FALLBACK_ROW_LIMIT,
+            question=shape,
+        )
+        response = await self.llm.ainvoke(prompt)
+        turnlog.record_usage(response)
+        quotas.record_usage(response)
+        query = response.content.strip()
+        query = re.sub(r'^```(?:cypher)?\s*([\s\S]*?)\s*```$', r'\1', query, flags=re.MULTILINE).strip()
+        if not query or query.upper() == "NONE":
+            logger.info(f"No Cypher template for question shape: {shape}")
+            return None
+        error = self.validate(query, params)
+        if error:
+            logger.warning(f"Rejected generated Cypher for question shape: {shape}: {error}: {query}")
+            return None
+        logger.info(f"Cached Cypher template for question shape: {shape}: {query}")
+        return query
+
+    # Return the template for a question shape, generating it once per shape.
+    # Concurrent questions with the same shape share a single generation call, which stays
+    # pending until it finishes, so a new question of the shape never starts a second one.
+    async def get_template(self, shape, params):
+        if shape in self.templates:
+            logger.info(f"Cypher template cache hit for question shape: {shape}")
+            return self.templates[shape]
+        generation = self.pending.get(shape)
+        if generation is None:
+            generation = asyncio.ensure_future(self.generate_template(shape, params))
+            self.pending[shape] = generation
+            generation.add_done_callback(lambda done: self.finish_generation(shape, done))
+        # Shielded, so a waiter cancelled when its socket closes doesn't cancel the others' generation
+        return await asyncio.shield(generation)
+
+    # Runs before the waiters resume, so the template is cached by the time they return
+    def finish_generation(self, shape, generation):
+        self.pending.pop(shape, None)
+        if generation.cancelled() or generation.exception() is not None:
+            return
+        # Unanswerable and rejected shapes are cached too, so they don't hit the model again
+        self.templates[shape] = generation.result()
+
+    # Answer a question with a generated read-only query, or return None
+    async def answer(self, patient, question):
+        shape, params = question_shape(patient, question)
+        try:
+            template = await self.get_template(shape, params)
+        except Exception as e:
+            logger.error(f"Failed to generate Cypher for question shape: {shape}: {e}")
+            return None
+        if template is None:
+            return None
+        results = await asyncio.get_running_loop().run_in_executor(
+            None, execute_read_only_query_helper, template, {"patient_id": patient.id, **params}
+        )
+        if not results:
+            return None
+        rows = results[:settings.CYPHER_FALLBACK_ROW_LIMIT]
+        return "\n".join(
+            "- " + ", ".join(f"{key}: {value}" for key, value in row.items()) for row in rows
+        )
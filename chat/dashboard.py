@@ -0,0 +1,144 @@
+import base64
+import datetime
+import logging
+import orjson
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from django.utils import timezone
+from .models import Patient
+from .neo4j_helper import execute_cypher_query_helper
+from .resolvers import split_patient_field
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Patients of a doctor ordered by id, one page after the cursor.
+# Backed by the Doctor(name) and Patient(id) indexes created by ensure_graph_indexes.
+GRAPH_PATIENTS_QUERY = """
+    MATCH (d:Doctor {name: $doctor_name})<-[:ASSIGNED_TO]-(p:Patient)
+    WHERE p.id > $after_id
+    WITH p ORDER BY p.id LIMIT $limit
+    RETURN p.id AS id, p.first_name AS first_name, p.last_name AS last_name,
+           toString(p.date_of_birth) AS date_of_birth,
+           [(p)-[:HAS_CONDITION]->(c:MedicalCondition) | c.name] AS medical_conditions,
+           [(p)-[:HAS_APPOINTMENT]->(a:Appointment {type: 'next'}) | toString(a.date)][0] AS next_appointment
+"""
+
+# Upcoming appointments of a doctor's patients ordered by (date, patient id), one page after the cursor
+GRAPH_APPOINTMENTS_QUERY = """
+    MATCH (d:Doctor {name: $doctor_name})<-[:ASSIGNED_TO]-(p:Patient)-[:HAS_APPOINTMENT]->(a:Appointment {type: 'next'})
+    WHERE a.date >= datetime($since)
+      AND (a.date > datetime($after_date) OR (a.date = datetime($after_date) AND p.id > $after_id))
+    WITH p, a ORDER BY a.date, p.id LIMIT $limit
+    RETURN p.id AS patient_id, p.first_name AS first_name, p.last_name AS last_name,
+           toString(a.date) AS next_appointment,
+           [(p)-[:HAS_CONDITION]->(c:MedicalCondition) | c.name] AS medical_conditions
+"""
+
+# Opaque keyset cursors: the sort key of the last row of the previous page
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode()
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, orjson.JSONDecodeError):
+        raise ValueError("Invalid cursor")
+
+def sql_patients_page(doctor_name, cursor, limit):
+    after_id = cursor[0] if cursor else 0
+    # Only the columns the roster shows, so the large context document isn't read
+    rows = list(
+        Patient.objects.filter(doctor_name=doctor_name, id__gt=after_id)
+        .order_by('id')
+        .values('id', 'first_name', 'last_name', 'date_of_birth', 'medical_condition', 'next_appointment')[:limit]
+    )
+    for row in rows:
+        row['medical_conditions'] = split_patient_field(row.pop('medical_condition'))
+    next_cursor = encode_cursor([rows[-1]['id']]) if len(rows) == limit else None
+    return rows, next_cursor
+
+def sql_appointments_page(doctor_name, cursor, limit):
+    queryset = Patient.objects.filter(doctor_name=doctor_name, next_appointment__gte=timezone.now())
+    if cursor:
+        after_date = datetime.datetime.fromisoformat(cursor[0])
+        # (date, id) > cursor, with a plain range on the date so the index scan starts at the cursor
+        queryset = queryset.filter(next_appointment__gte=after_date).filter(
+            Q(next_appointment__gt=after_date) | Q(id__gt=cursor[1])
+        )
+    rows = list(
+        queryset.order_by('next_appointment', 'id')
+        .values('id', 'first_name', 'last_name', 'next_appointment', 'medical_condition')[:limit]
+    )
+    for row in rows:
+        row['patient_id'] = row.pop('id')
+        row['medical_conditions'] = split_patient_field(row.pop('medical_condition'))
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor([rows[-1]['next_appointment'].isoformat(), rows[-1]['patient_id']])
+    return rows, next_cursor
+
+def graph_patients_page(doctor_name, cursor, limit):
+    rows = execute_cypher_query_helper(GRAPH_PATIENTS_QUERY, {
+        "doctor_name": doctor_name,
+        "after_id": cursor[0] if cursor else 0,
+        "limit": limit,
+    })
+    if rows is None:
+        raise ConnectionError("Graph query failed")
+    next_cursor = encode_cursor([rows[-1]['id']]) if len(rows) == limit else None
+    return rows, next_cursor
+
+def graph_appointments_page(doctor_name, cursor, limit):
+    since = timezone.now().isoformat()
+    rows = execute_cypher_query_helper(GRAPH_APPOINTMENTS_QUERY, {
+        "doctor_name": doctor_name,
+        "since": since,
+        "after_date": cursor[0] if cursor else since,
+        "after_id": cursor[1] if cursor else -1,
+        "limit": limit,
+    })
+    if rows is None:
+        raise ConnectionError("Graph query failed")
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor([rows[-1]['next_appointment'], rows[-1]['patient_id']])
+    return rows, next_cursor
+
+page_functions = {
+    ("patients", "sql"): sql_patients_page,
+    ("patients", "graph"): graph_patients_page,
+    ("appointments", "sql"): sql_appointments_page,
+    ("appointments", "graph"): graph_appointments_page,
+}
+
+# Every row for a doctor, fetched page by page so memory stays flat for large rosters
+def iterate_rows(page_function, doctor_name, page_size):
+    cursor = None
+    while True:
+        rows, next_cursor = page_function(doctor_name, cursor, page_size)
+        yield from rows
+        if next_cursor is None:
+            return
+        cursor = decode_cursor(next_cursor)
+
+# One NDJSON line per row
+def ndjson_lines(rows):
+    for row in rows:
+        yield orjson.dumps(row, default=str) + b"\n"
+
+# NDJSON lines of every row for a doctor, for StreamingHttpResponse under ASGI. Django only
+# streams async iterators there (a sync one is collected into a list first), so each page is
+# read in a worker thread and sent before the next one is fetched, keeping one page in memory.
+async def ndjson_stream(page_function, doctor_name, page_size):
+    fetch_page = sync_to_async(page_function)
+    cursor = None
+    while True:
+        rows, next_cursor = await fetch_page(doctor_name, cursor, page_size)
+        for line in ndjson_lines(rows):
+            yield line
+        if next_cursor is None:
+            return
+        cursor = decode_cursor(next_cursor)
@@ -0,0 +1,26 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from .models import Patient
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Pool of threads that each hold one persistent database connection (CONN_MAX_AGE),
+# so patient lookups run in parallel instead of queueing on the single thread
+# behind sync_to_async's thread-sensitive executor
+_executor = ThreadPoolExecutor(max_workers=max(settings.PATIENT_DB_POOL_SIZE, 1), thread_name_prefix='patient-db')
+
+def _get_patient(patient_id):
+    # Recycle connections older than CONN_MAX_AGE and re-check their health (CONN_HEALTH_CHECKS)
+    close_old_connections()
+    return Patient.objects.get(id=patient_id)
+
+# Load a patient on the chat hot path. With PATIENT_DB_POOL_SIZE set to 0 this uses
+# Django's async ORM directly, which in Django 4.2 still runs on the thread-sensitive executor.
+async def aget_patient(patient_id):
+    if settings.PATIENT_DB_POOL_SIZE <= 0:
+        return await Patient.objects.aget(id=patient_id)
+    return await asyncio.get_running_loop().run_in_executor(_executor, _get_patient, patient_id)
@@ -1,10 +1,32 @@
 import logging
 import datetime
+import hashlib
+import orjson
+from django.conf import settings
 from .neo4j_driver import Neo4jDriver
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Indexes backing the MERGEs of populate_patient_data and the dashboard and availability lookups
+GRAPH_INDEXES = [
+    "CREATE INDEX patient_id IF NOT EXISTS FOR (p:Patient) ON (p.id)",
+    "CREATE INDEX doctor_name IF NOT EXISTS FOR (d:Doctor) ON (d.name)",
+    "CREATE INDEX medical_condition_name IF NOT EXISTS FOR (c:MedicalCondition) ON (c.name)",
+    "CREATE INDEX medication_regime_name IF NOT EXISTS FOR (m:MedicationRegime) ON (m.name)",
+    "CREATE INDEX appointment_type_date IF NOT EXISTS FOR (a:Appointment) ON (a.type, a.date)",
+]
+
+# Create the graph indexes that don't exist yet
+def ensure_graph_indexes():
+    driver = Neo4jDriver()
+    try:
+        for statement in GRAPH_INDEXES:
+            logging.info("Ensuring graph index: %s", statement)
+            driver.execute_write_query(statement)
+    finally:
+        driver.close()
+
 # Populate patient data
 def populate_patient_data(patient):    
     logging.info("Starting to populate patient data for patient ID: %s", patient.id)
@@ -118,3 +140,147 @@ def format_datetime(dt):
                 dt = dt.replace(tzinfo=datetime.timezone.utc)
             return dt.isoformat()
         return None
+
+
+# What the graph currently holds for a patient: node properties and outgoing relationships
+GRAPH_STATE_QUERY = """
+    MATCH (p:Patient {id: $patient_id})
+    RETURN p.first_name AS first_name, p.last_name AS last_name, toString(p.date_of_birth) AS date_of_birth,
+           p.phone_number AS phone_number, p.email AS email,
+           [(p)-[:ASSIGNED_TO]->(d:Doctor) | d.name] AS doctors,
+           [(p)-[:HAS_CONDITION]->(c:MedicalCondition) | c.name] AS conditions,
+           [(p)-[:TAKES_MEDICATION]->(m:MedicationRegime) | m.name] AS medications,
+           [(p)-[:HAD_APPOINTMENT]->(a:Appointment {type: 'last'}) | a.date] AS last_appointments,
+           [(p)-[:HAS_APPOINTMENT]->(a:Appointment {type: 'next'}) | a.date] AS next_appointments
+"""
+
+PATIENT_PROPERTIES = ["first_name", "last_name", "date_of_birth", "phone_number", "email"]
+
+# Outgoing relationships kept in sync: state key, relationship type, node to MERGE for
+# a value, node label and the expression a value is compared with when removing
+GRAPH_RELATIONSHIPS = [
+    ("doctors", "ASSIGNED_TO", "Doctor {name: value}", "Doctor", "n.name", "value"),
+    ("conditions", "HAS_CONDITION", "MedicalCondition {name: value}", "MedicalCondition", "n.name", "value"),
+    ("medications", "TAKES_MEDICATION", "MedicationRegime {name: value}", "MedicationRegime", "n.name", "value"),
+    ("last_appointments", "HAD_APPOINTMENT", "Appointment {type: 'last', date: datetime(value)}", "Appointment", "n.date", "datetime(value)"),
+    ("next_appointments", "HAS_APPOINTMENT", "Appointment {type: 'next', date: datetime(value)}", "Appointment", "n.date", "datetime(value)"),
+]
+
+# Running totals of the graph writes made by diff sync, against what a full sync would have issued
+sync_stats = {
+    "saves": 0,
+    "skipped": 0,
+    "statements": 0,
+    "full_statements": 0,
+    "relationships_added": 0,
+    "relationships_removed": 0,
+}
+
+def split_field(value):
+    return sorted({item.strip() for item in (value or "").split(",") if item.strip()})
+
+# The graph-relevant part of a patient record, in the same shape as GRAPH_STATE_QUERY returns
+def patient_graph_state(patient):
+    return {
+        "first_name": patient.first_name,
+        "last_name": patient.last_name,
+        "date_of_birth": str(patient.date_of_birth),
+        "phone_number": patient.phone_number,
+        "email": patient.email,
+        "doctors": [patient.doctor_name] if patient.doctor_name else [],
+        "conditions": split_field(patient.medical_condition),
+        "medications": split_field(patient.medication_regime),
+        "last_appointments": [format_datetime(patient.last_appointment)] if patient.last_appointment else [],
+        "next_appointments": [format_datetime(patient.next_appointment)] if patient.next_appointment else [],
+    }
+
+def graph_state_hash(state):
+    return hashlib.blake2b(orjson.dumps(state, option=orjson.OPT_SORT_KEYS), digest_size=32).hexdigest()
+
+def read_graph_state(driver, patient_id):
+    results = driver.execute_read_query(GRAPH_STATE_QUERY, {"patient_id": patient_id})
+    if not results:
+        return None
+    state = results[0]
+    for key in ("last_appointments", "next_appointments"):
+        state[key] = [format_datetime(value.to_native()) for value in state[key]]
+    return state
+
+# Write statements turning the current graph state into the desired one
+def graph_sync_statements(patient_id, current, desired):
+    statements = []
+    if current is None or any(current[key] != desired[key] for key in PATIENT_PROPERTIES):
+        statements.append(("""
+        MERGE (p:Patient {id: $patient_id})
+        SET p.first_name = $first_name,
+            p.last_name = $last_name,
+            p.date_of_birth = date($date_of_birth),
+            p.phone_number = $phone_number,
+            p.email = $email
+        """, {"patient_id": patient_id, **{key: desired[key] for key in PATIENT_PROPERTIES}}))
+    added = removed = 0
+    for key, relationship, node, label, match, convert in GRAPH_RELATIONSHIPS:
+        existing = set(current[key]) if current else set()
+        wanted = set(desired[key])
+        if existing - wanted:
+            statements.append((f"""
+            MATCH (p:Patient {{id: $patient_id}})-[r:{relationship}]->(n:{label})
+            WHERE {match} IN [value IN $values | {convert}]
+            DELETE r
+            """, {"patient_id": patient_id, "values": sorted(existing - wanted)}))
+            removed += len(existing - wanted)
+        if wanted - existing:
+            statements.append((f"""
+            MATCH (p:Patient {{id: $patient_id}})
+            UNWIND $values AS value
+            MERGE (n:{node})
+            MERGE (p)-[:{relationship}]->(n)
+            """, {"patient_id": patient_id, "values": sorted(wanted - existing)}))
+            added += len(wanted - existing)
+    return statements, added, removed
+
+# Sync a patient to the graph. In diff mode a save that doesn't change the graph-relevant
+# fields is skipped by comparing content hashes; otherwise only the difference between the
+# graph and the record is written, in one transaction, and stale relationships are removed.
+def sync_patient_graph(patient, force=False):
+    if settings.GRAPH_SYNC_MODE == 'full':
+        populate_patient_data(patient)
+        return
+    desired = patient_graph_state(patient)
+    state_hash = graph_state_hash(desired)
+    # What populate_patient_data would have written for this save
+    full_statements = 1 + sum(len(desired[key]) for key, *_ in GRAPH_RELATIONSHIPS)
+    sync_stats["saves"] += 1
+    sync_stats["full_statements"] += full_statements
+    if state_hash == patient.graph_sync_hash and not force:
+        sync_stats["skipped"] += 1
+        logging.info("Graph sync skipped for patient ID: %s, nothing graph-relevant changed", patient.id)
+        return
+
+    driver = Neo4jDriver()
+    try:
+        current = read_graph_state(driver, patient.id)
+        statements, added, removed = graph_sync_statements(patient.id, current, desired)
+        if statements:
+            driver.execute_write_transaction(statements)
+    except Exception as e:
+        # The hash is left as it was, so the next save retries
+        logging.error("Graph sync failed for patient ID: %s: %s", patient.id, e)
+        return
+    finally:
+        driver.close()
+
+    # A queryset update, so post_save doesn't fire again
+    type(patient).objects.filter(pk=patient.pk).update(graph_sync_hash=state_hash)
+    patient.graph_sync_hash = state_hash
+    sync_stats["statements"] += len(statements)
+    sync_stats["relationships_added"] += added
+    sync_stats["relationships_removed"] += removed
+    saved = 1 - sync_stats["statements"] / sync_stats["full_statements"]
+    logging.info(
+        "Graph sync for patient ID: %s wrote %d statements (full sync: %d), +%d/-%d relationships; "
+        "%d of %d saves skipped, %.0f%% of write statements saved overall",
+        patient.id, len(statements), full_statements, added, removed,
+        sync_stats["skipped"], sync_stats["saves"], saved * 100,
+    )
+
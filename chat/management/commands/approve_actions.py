@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat.action_executor import apply_approved_actions, approve_actions, reject_actions
+from chat.models import ActionRequest
+
+
+class Command(BaseCommand):
+    help = "Approve or reject pending patient action requests and apply approved ones to Postgres and Neo4j"
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="Action request ids")
+        parser.add_argument('--all-pending', action='store_true', help="Approve every pending request")
+        parser.add_argument('--reject', action='store_true', help="Reject the given requests instead of approving them")
+        parser.add_argument('--list', action='store_true', help="List pending requests and exit")
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for action_request in ActionRequest.objects.filter(status=ActionRequest.PENDING).select_related('patient').order_by('id'):
+                self.stdout.write(f"{action_request.id:>6} {action_request} {action_request.payload}")
+            return
+
+        ids = options['ids']
+        if options['all_pending']:
+            ids = list(ActionRequest.objects.filter(status=ActionRequest.PENDING).values_list('id', flat=True))
+        elif not ids:
+            raise CommandError("Provide action request ids or --all-pending.")
+
+        if options['reject']:
+            self.stdout.write(f"Rejected {reject_actions(ids)} requests")
+            return
+
+        self.stdout.write(f"Approved {approve_actions(ids)} requests")
+        # Also picks up requests approved earlier whose write-back failed
+        applied = apply_approved_actions()
+        self.stdout.write(self.style.SUCCESS(f"Applied {len(applied)} requests"))
+        remaining = ActionRequest.objects.filter(status=ActionRequest.APPROVED).count()
+        if remaining:
+            self.stdout.write(self.style.WARNING(f"{remaining} approved requests are not applied yet, run again to retry"))
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.notifications import patient_group_name
+
+# Group used by the benchmark so it never reaches real patient sockets
+BENCH_PATIENT_ID = 'bench'
+
+# Receive messages on a set of channels until the expected count arrives or the timeout passes
+async def receive_messages(channel_layer, channels, expected, timeout):
+    async def drain(channel):
+        received = 0
+        last_received_at = None
+        while received < expected:
+            try:
+                await asyncio.wait_for(channel_layer.receive(channel), timeout)
+            except asyncio.TimeoutError:
+                break
+            received += 1
+            last_received_at = time.time()
+        return received, last_received_at
+
+    results = await asyncio.gather(*[drain(channel) for channel in channels])
+    received = sum(count for count, _ in results)
+    finished_at = max((at for _, at in results if at), default=None)
+    return received, finished_at
+
+# Join a number of fresh channels to the benchmark group
+async def join_group(channel_layer, sockets):
+    group = patient_group_name(BENCH_PATIENT_ID)
+    channels = []
+    for _ in range(sockets):
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(group, channel)
+        channels.append(channel)
+    return channels
+
+# Remove the benchmark channels from the group again
+async def leave_group(channel_layer, channels):
+    group = patient_group_name(BENCH_PATIENT_ID)
+    for channel in channels:
+        await channel_layer.group_discard(group, channel)
+
+# Send the benchmark messages to the group
+async def send_messages(channel_layer, messages, payload_bytes):
+    group = patient_group_name(BENCH_PATIENT_ID)
+    started_at = time.time()
+    for i in range(messages):
+        await channel_layer.group_send(group, {
+            'type': 'patient.message',
+            'sender': 'bot',
+            'message': 'x' * payload_bytes,
+            'seq': i,
+        })
+    return started_at
+
+
+class Command(BaseCommand):
+    help = "Benchmark broadcast throughput of the channel layer across worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Number of receiving worker processes")
+        parser.add_argument('--sockets', type=int, default=25, help="Sockets (channels) per worker")
+        parser.add_argument('--messages', type=int, default=50, help="Messages broadcast to the group")
+        parser.add_argument('--payload-bytes', type=int, default=200, help="Size of each message body")
+        parser.add_argument('--timeout', type=float, default=5.0, help="Seconds a receiver waits for the next message")
+        # Internal: run as one of the receiving workers
+        parser.add_argument('--receiver', action='store_true', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['receiver']:
+            asyncio.run(self.run_receiver(options))
+            return
+
+        channel_layer = get_channel_layer()
+        in_memory = settings.CHANNEL_LAYER_BACKEND != 'redis'
+        if in_memory:
+            self.stdout.write("In-memory channel layer: simulating workers inside a single process")
+            result = asyncio.run(self.run_in_process(channel_layer, options))
+        else:
+            result = self.run_across_processes(channel_layer, options)
+
+        expected, received, elapsed = result
+        self.stdout.write(
+            f"backend={settings.CHANNEL_LAYER_BACKEND} workers={options['workers']} "
+            f"sockets/worker={options['sockets']} messages={options['messages']}"
+        )
+        self.stdout.write(f"deliveries: {received}/{expected} ({expected - received} dropped)")
+        if elapsed and elapsed > 0:
+            self.stdout.write(f"elapsed: {elapsed:.3f}s")
+            self.stdout.write(f"broadcasts/s: {options['messages'] / elapsed:.1f}")
+            self.stdout.write(f"deliveries/s: {received / elapsed:.1f}")
+
+    async def run_in_process(self, channel_layer, options):
+        workers = [await join_group(channel_layer, options['sockets']) for _ in range(options['workers'])]
+        receivers = [
+            asyncio.ensure_future(receive_messages(channel_layer, channels, options['messages'], options['timeout']))
+            for channels in workers
+        ]
+        started_at = await send_messages(channel_layer, options['messages'], options['payload_bytes'])
+        results = await asyncio.gather(*receivers)
+        for channels in workers:
+            await leave_group(channel_layer, channels)
+        return self.summarise(options, started_at, results)
+
+    def run_across_processes(self, channel_layer, options):
+        command = [
+            sys.executable, sys.argv[0], 'bench_broadcast', '--receiver',
+            '--sockets', str(options['sockets']),
+            '--messages', str(options['messages']),
+            '--timeout', str(options['timeout']),
+        ]
+        processes = [
+            subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+            for _ in range(options['workers'])
+        ]
+        # Wait until every worker has joined the group
+        for process in processes:
+            process.stdout.readline()
+
+        started_at = asyncio.run(send_messages(channel_layer, options['messages'], options['payload_bytes']))
+        results = []
+        for process in processes:
+            output, _ = process.communicate()
+            report = json.loads(output.strip().splitlines()[-1])
+            results.append((report['received'], report['finished_at']))
+        return self.summarise(options, started_at, results)
+
+    async def run_receiver(self, options):
+        channel_layer = get_channel_layer()
+        channels = await join_group(channel_layer, options['sockets'])
+        self.stdout.write('ready')
+        self.stdout.flush()
+        received, finished_at = await receive_messages(channel_layer, channels, options['messages'], options['timeout'])
+        await leave_group(channel_layer, channels)
+        self.stdout.write(json.dumps({'received': received, 'finished_at': finished_at}))
+
+    def summarise(self, options, started_at, results):
+        expected = options['workers'] * options['sockets'] * options['messages']
+        received = sum(count for count, _ in results)
+        finished_at = max((at for _, at in results if at), default=None)
+        elapsed = finished_at - started_at if finished_at else None
+        return expected, received, elapsed
@@ -0,0 +1,78 @@
+import gc
+import tracemalloc
+from django.core.management.base import BaseCommand
+from langchain.schema import HumanMessage, AIMessage
+from chat.consumers import ChatConsumer
+from chat.conversation import ConversationState
+from chat.notifications import patient_group_name
+
+USER_MESSAGE = "When is my next appointment and do I need to bring anything?"
+BOT_MESSAGE = (
+    "Your next appointment is with Dr. Smith. Please bring your current medication list, "
+    "any recent test results and a list of questions you would like to discuss. "
+) * 3
+
+# Bytes allocated while building the objects returned by factory, per object
+def measure(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [factory(i) for i in range(count)]
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / count, objects
+
+
+class Command(BaseCommand):
+    help = "Report memory used per idle and per active chat connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=10000, help="Connections to simulate")
+        parser.add_argument('--turns', type=int, default=5, help="Turns held by an active connection")
+
+    def handle(self, *args, **options):
+        count, turns = options['connections'], options['turns']
+
+        def idle_connection(i):
+            consumer = ChatConsumer()
+            consumer.scope = {'type': 'websocket', 'url_route': {'kwargs': {'patient_id': str(i)}}}
+            consumer.channel_name = f"specific.bench!{i}"
+            consumer.patient_id = i
+            consumer.group_name = patient_group_name(i)
+            consumer.init_connection_state()
+            return consumer
+
+        def conversation_state(i, conversation=None):
+            if conversation is None:
+                conversation = ConversationState()
+            for turn in range(turns):
+                conversation.add('user', f"{USER_MESSAGE} {i}-{turn}")
+                conversation.add('bot', f"{BOT_MESSAGE} {i}-{turn}")
+            return conversation
+
+        def active_connection(i):
+            consumer = idle_connection(i)
+            conversation_state(i, consumer.conversation)
+            return consumer
+
+        # The previous representation: a dict per user message plus langchain messages
+        def legacy_history(i):
+            history = []
+            for turn in range(turns):
+                history.append({'sender': 'user', 'message': f"{USER_MESSAGE} {i}-{turn}"})
+                history.append(HumanMessage(content=f"{USER_MESSAGE} {i}-{turn}"))
+                history.append(AIMessage(content=f"{BOT_MESSAGE} {i}-{turn}"))
+            return history
+
+        idle, _ = measure(idle_connection, count)
+        active, _ = measure(active_connection, count)
+        state, _ = measure(conversation_state, count)
+        legacy, _ = measure(legacy_history, count)
+
+        self.stdout.write(f"connections: {count}, turns per active connection: {turns}")
+        self.stdout.write(f"bytes per idle connection:   {idle:>10.0f}")
+        self.stdout.write(f"bytes per active connection: {active:>10.0f}")
+        self.stdout.write(f"conversation state per active connection:    {state:>10.0f} bytes")
+        self.stdout.write(f"previous history list per active connection: {legacy:>10.0f} bytes")
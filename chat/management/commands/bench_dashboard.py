@@ -0,0 +1,110 @@
+import datetime
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from chat.dashboard import decode_cursor, iterate_rows, ndjson_lines, page_functions
+from chat.graph_utils import sync_patient_graph
+from chat.models import Patient
+from chat.neo4j_driver import Neo4jDriver
+
+CONDITIONS = ["Diabetes", "Asthma", "Hypertension", "Arthritis", "Migraine", "COPD"]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = "Benchmark doctor dashboard queries for a doctor with many patients"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=10000, help="Patients assigned to the benchmark doctor")
+        parser.add_argument('--doctor', default='Bench Doctor', help="Doctor name to create patients for")
+        parser.add_argument('--page-size', type=int, default=100, help="Rows per page")
+        parser.add_argument('--repeat', type=int, default=20, help="Measurements per query")
+        parser.add_argument('--source', default='sql', choices=['sql', 'graph'], help="Backend to query")
+        parser.add_argument('--keep', action='store_true', help="Keep the generated patients")
+
+    def handle(self, *args, **options):
+        doctor = options['doctor']
+        # Only the patients created here are deleted afterwards, never existing ones of the doctor
+        created_ids = []
+        if not Patient.objects.filter(doctor_name=doctor).exists():
+            created_ids = self.create_patients(doctor, options['patients'], options['source'] == 'graph')
+        total = Patient.objects.filter(doctor_name=doctor).count()
+        self.stdout.write(f"Dr. {doctor} has {total} patients, source: {options['source']}")
+        try:
+            self.stdout.write(f"{'query':<34} {'p50 ms':>8} {'p95 ms':>8} {'rows':>7}")
+            for listing in ('patients', 'appointments'):
+                page_function = page_functions[(listing, options['source'])]
+                self.measure(f"{listing} first page", options, lambda: page_function(doctor, None, options['page_size'])[0])
+                cursor = self.middle_cursor(page_function, doctor, options['page_size'])
+                self.measure(f"{listing} keyset page (middle)", options, lambda: page_function(doctor, cursor, options['page_size'])[0])
+                self.measure(f"{listing} full ndjson stream", options, lambda: list(ndjson_lines(iterate_rows(page_function, doctor, options['page_size']))), repeat=3)
+            # OFFSET pagination for comparison: the database still walks every skipped row
+            offset = total // 2
+            self.measure("patients offset page (middle)", options, lambda: list(
+                Patient.objects.filter(doctor_name=doctor).order_by('id')
+                .values('id', 'first_name', 'last_name', 'date_of_birth', 'medical_condition', 'next_appointment')[offset:offset + options['page_size']]
+            ))
+        finally:
+            if created_ids and not options['keep']:
+                self.delete_patients(created_ids, options['source'] == 'graph')
+
+    # bulk_create skips post_save, so the patients are synced to the graph explicitly when it is benchmarked
+    def create_patients(self, doctor, count, sync_graph):
+        rng = random.Random(0)
+        now = timezone.now()
+        patients = [
+            Patient(
+                first_name=f"Bench{i}", last_name="Patient", date_of_birth=datetime.date(1950 + i % 50, 1 + i % 12, 1 + i % 28),
+                phone_number="555-0100", email=f"bench{i}@example.com",
+                medical_condition=", ".join(rng.sample(CONDITIONS, 2)), medication_regime="Aspirin",
+                last_appointment=now - datetime.timedelta(days=rng.randint(1, 365)),
+                next_appointment=now + datetime.timedelta(minutes=30 * rng.randint(1, 5000)),
+                doctor_name=doctor,
+            )
+            for i in range(count)
+        ]
+        started_at = time.perf_counter()
+        with transaction.atomic():
+            Patient.objects.bulk_create(patients, batch_size=1000)
+        self.stdout.write(f"Created {count} patients in {time.perf_counter() - started_at:.2f}s")
+        if sync_graph:
+            started_at = time.perf_counter()
+            for patient in patients:
+                sync_patient_graph(patient, force=True)
+            self.stdout.write(f"Synced them to the graph in {time.perf_counter() - started_at:.2f}s")
+        return [patient.id for patient in patients]
+
+    def delete_patients(self, ids, from_graph):
+        for start in range(0, len(ids), 1000):
+            Patient.objects.filter(id__in=ids[start:start + 1000]).delete()
+        if from_graph:
+            driver = Neo4jDriver()
+            try:
+                driver.execute_write_query("MATCH (p:Patient) WHERE p.id IN $ids DETACH DELETE p", {"ids": ids})
+            finally:
+                driver.close()
+        self.stdout.write(f"Deleted the {len(ids)} generated patients")
+
+    def middle_cursor(self, page_function, doctor, page_size):
+        cursor = None
+        for _ in range(Patient.objects.filter(doctor_name=doctor).count() // page_size // 2):
+            _, next_cursor = page_function(doctor, decode_cursor(cursor), page_size)
+            if next_cursor is None:
+                break
+            cursor = next_cursor
+        return decode_cursor(cursor)
+
+    def measure(self, name, options, query, repeat=None):
+        timings, rows = [], 0
+        for _ in range(repeat or options['repeat']):
+            started_at = time.perf_counter()
+            rows = len(query())
+            timings.append(time.perf_counter() - started_at)
+        self.stdout.write(
+            f"{name:<34} {percentile(timings, 0.5) * 1000:>8.2f} {percentile(timings, 0.95) * 1000:>8.2f} {rows:>7}"
+        )
@@ -0,0 +1,110 @@
+import json
+import random
+import time
+import zlib
+import msgpack
+from django.core.management.base import BaseCommand
+
+# Sample turns shaped like real chat traffic: a short patient message and a markdown answer
+USER_MESSAGES = [
+    "When is my next appointment?",
+    "What medications am I taking right now?",
+    "Can you move my appointment to next Tuesday at 10 AM?",
+    "Who is my doctor and how can I reach them?",
+    "I have been feeling dizzy after taking Metformin, is that normal?",
+]
+BOT_SENTENCES = [
+    "Your next appointment with Dr. Smith is on **2024-12-01 at 10:00 AM**.",
+    "You are currently taking: Aspirin, Metformin.",
+    "I will convey your request to Dr. Smith to update your medication regime.",
+    "Dizziness can be a side effect of some medications, especially when starting a new dose.",
+    "Please make sure to stay hydrated and avoid standing up too quickly.",
+    "If the symptoms persist or get worse, contact your doctor or seek urgent care.",
+    "- Take your medication with food\n- Monitor your blood sugar daily\n- Keep a symptom diary",
+]
+
+# Size of a WebSocket frame header; client frames carry a 4 byte masking key
+def frame_overhead(length, masked):
+    header = 2 if length < 126 else 4 if length < 65536 else 10
+    return header + (4 if masked else 0)
+
+# Emulates the permessage-deflate compression of one direction of a connection with zlib
+class Deflater:
+    def __init__(self, context_takeover):
+        self.context_takeover = context_takeover
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if not self.context_takeover:
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        # The trailing empty block is implied by the extension
+        return compressed[:-4]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the encoded frame sizes of the JSON and msgpack chat subprotocols, with and without echo "
+        "and a zlib emulation of permessage-deflate. Frames are encoded in-process, no connection is opened."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--turns', type=int, default=2000, help="Chat turns per connection")
+        parser.add_argument('--pings-per-turn', type=float, default=1.0, help="Heartbeats sent per turn")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        turns = []
+        for _ in range(options['turns']):
+            message = rng.choice(USER_MESSAGES)
+            answer = " ".join(rng.sample(BOT_SENTENCES, rng.randint(2, len(BOT_SENTENCES))))
+            turns.append((message, answer))
+
+        encodings = [
+            ("json", lambda payload: json.dumps(payload).encode()),
+            ("msgpack", msgpack.packb),
+        ]
+        compressions = [("none", None), ("deflate", True), ("deflate-nct", False)]
+        self.stdout.write(
+            f"{'encoding':<8} {'echo':<4} {'compression':<12} {'frames/turn':>11} {'bytes/turn':>10} {'vs json':>8} {'encoded/s':>10}"
+        )
+        baseline = None
+        for encoding, encode in encodings:
+            for echo in (True, False):
+                for compression, context_takeover in compressions:
+                    frames, wire_bytes, elapsed = self.run(turns, encode, echo, context_takeover, options['pings_per_turn'])
+                    per_turn = wire_bytes / len(turns)
+                    if baseline is None:
+                        baseline = per_turn
+                    self.stdout.write(
+                        f"{encoding:<8} {'yes' if echo else 'no':<4} {compression:<12} {frames / len(turns):>11.2f} "
+                        f"{per_turn:>10.1f} {per_turn / baseline:>7.0%} {frames / elapsed:>10.0f}"
+                    )
+
+    # Encode (and compress) every frame of the conversation, counting the bytes its header and
+    # payload would take in a WebSocket frame
+    def run(self, turns, encode, echo, context_takeover, pings_per_turn):
+        server = Deflater(context_takeover) if context_takeover is not None else None
+        client = Deflater(context_takeover) if context_takeover is not None else None
+        frames, wire_bytes, pings = 0, 0, 0.0
+        started_at = time.perf_counter()
+        for message, answer in turns:
+            outgoing = [(True, {'message': message, 'patient_id': '1'})]
+            incoming = []
+            pings += pings_per_turn
+            while pings >= 1:
+                pings -= 1
+                outgoing.append((True, {'type': 'ping'}))
+                incoming.append({'type': 'pong'})
+            if echo:
+                incoming.append({'sender': 'user', 'message': message})
+            incoming.append({'sender': 'bot', 'message': answer, 'format': 'markdown'})
+
+            for masked, payload in outgoing + [(False, payload) for payload in incoming]:
+                data = encode(payload)
+                deflater = client if masked else server
+                if deflater is not None:
+                    data = deflater.compress(data)
+                wire_bytes += len(data) + frame_overhead(len(data), masked)
+                frames += 1
+        return frames, wire_bytes, time.perf_counter() - started_at
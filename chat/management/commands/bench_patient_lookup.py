@@ -0,0 +1,54 @@
+import asyncio
+import time
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from chat.db import aget_patient
+from chat.models import Patient
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = "Benchmark patient lookup throughput with many concurrent sockets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=100, help="Concurrent sockets")
+        parser.add_argument('--lookups', type=int, default=20, help="Lookups per socket")
+        parser.add_argument('--patient-id', type=int, help="Patient to look up (defaults to the first patient)")
+
+    def handle(self, *args, **options):
+        patient_id = options['patient_id']
+        if patient_id is None:
+            patient = Patient.objects.order_by('id').first()
+            if patient is None:
+                raise CommandError("No patients found. Please create sample data.")
+            patient_id = patient.id
+
+        strategies = [
+            ("sync_to_async(get)", lambda patient_id: sync_to_async(Patient.objects.get)(id=patient_id)),
+            ("Patient.objects.aget", lambda patient_id: Patient.objects.aget(id=patient_id)),
+            ("aget_patient (pooled)", aget_patient),
+        ]
+        self.stdout.write(f"{'strategy':<24} {'lookups/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, lookup in strategies:
+            throughput, latencies = asyncio.run(self.run(lookup, patient_id, options))
+            self.stdout.write(
+                f"{name:<24} {throughput:>10.1f} "
+                f"{percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f}"
+            )
+
+    async def run(self, lookup, patient_id, options):
+        latencies = []
+
+        async def socket():
+            for _ in range(options['lookups']):
+                started_at = time.perf_counter()
+                await lookup(patient_id)
+                latencies.append(time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*[socket() for _ in range(options['sockets'])])
+        elapsed = time.perf_counter() - started_at
+        return len(latencies) / elapsed, latencies
@@ -0,0 +1,58 @@
+import asyncio
+import statistics
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import Patient
+from chat.prefetch import GraphPrefetch, get_prefetched_context, snapshot_prefetch
+from chat.snapshot import PatientSnapshot
+
+
+class Command(BaseCommand):
+    help = "Compare the graph context lookup of a cold turn through Neo4j with one answered from the patient snapshot"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.PATIENT_SNAPSHOT_PATH, help="Snapshot file, written by export_patient_snapshot")
+        parser.add_argument('--patients', type=int, default=200, help="Patients to look up")
+
+    def handle(self, *args, **options):
+        try:
+            started_at = time.perf_counter()
+            snapshot = PatientSnapshot(options['path'])
+            mapped = time.perf_counter() - started_at
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Couldn't map {options['path']}: {e}, run export_patient_snapshot first")
+        patients = list(Patient.objects.order_by('id').values_list('id', 'context_version')[:options['patients']])
+        if not patients:
+            raise CommandError("No patients to look up")
+        self.stdout.write(f"Mapped {len(snapshot)} patients in {mapped * 1000:.2f} ms")
+        graph, from_snapshot, stale = asyncio.run(self.compare(snapshot, patients))
+        for label, durations in (('graph', graph), ('snapshot', from_snapshot)):
+            durations = sorted(duration * 1000 for duration in durations) or [0.0]
+            self.stdout.write(
+                f"{label:<9} median {statistics.median(durations):8.3f} ms, "
+                f"max {durations[-1]:8.3f} ms over {len(durations)} patients"
+            )
+        if stale:
+            self.stdout.write(f"{stale} patients changed since the export and would still go to the graph")
+        snapshot.close()
+
+    async def compare(self, snapshot, patients):
+        graph = []
+        from_snapshot = []
+        stale = 0
+        for patient_id, context_version in patients:
+            started_at = time.perf_counter()
+            prefetch = GraphPrefetch(patient_id)
+            prefetch.future = asyncio.get_running_loop().run_in_executor(None, prefetch.run)
+            await get_prefetched_context(prefetch)
+            graph.append(time.perf_counter() - started_at)
+
+            started_at = time.perf_counter()
+            context = snapshot.context(patient_id, context_version)
+            if context is None:
+                stale += 1
+                continue
+            await get_prefetched_context(snapshot_prefetch(patient_id, context))
+            from_snapshot.append(time.perf_counter() - started_at)
+        return graph, from_snapshot, stale
@@ -0,0 +1,150 @@
+import asyncio
+import re
+import statistics
+import time
+import aiohttp
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from chat.static_assets import PrecompressedStaticFiles
+
+# marked.min.js as the chat page loaded it before it was vendored
+CDN_URL = 'https://cdn.jsdelivr.net/npm/marked/marked.min.js'
+
+ASSET_PATTERN = re.compile(r'<(?:script[^>]+src|link[^>]+href)="([^"]+)"')
+
+# Answer requests that reach the wrapped application with a 404
+async def not_found(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+# Run one GET through an ASGI application, returning (status, headers, body)
+async def asgi_get(application, path, headers):
+    messages = []
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message):
+        messages.append(message)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+    }
+    await application(scope, receive, send)
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], dict(start['headers']), body
+
+async def timed(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = await function()
+        durations.append(time.perf_counter() - started_at)
+    return result, statistics.median(durations)
+
+
+class Command(BaseCommand):
+    help = "Compare page-load size and serving time of the chat page's static assets before and after self-hosting and precompression"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200, help="Requests per asset and variant")
+        parser.add_argument('--url', help="Also load the page from a running server, e.g. http://localhost:8000")
+        parser.add_argument('--cdn', action='store_true', help="Time fetching marked.min.js from the CDN the page used before")
+
+    def handle(self, *args, **options):
+        response = Client().get('/')
+        if response.status_code != 200:
+            raise CommandError(f"Chat page returned {response.status_code}")
+        html = response.content.decode()
+        assets = [url for url in ASSET_PATTERN.findall(html) if url.startswith('/' + settings.STATIC_URL.lstrip('/'))]
+        self.stdout.write(f"Chat page: {len(response.content)} bytes HTML, {len(assets)} static assets")
+        asyncio.run(self.compare_in_process(assets, options['repeat']))
+        if options['cdn']:
+            asyncio.run(self.time_cdn())
+        if options['url']:
+            asyncio.run(self.load_page(options['url'].rstrip('/'), assets))
+
+    # Serve every asset through the precompressed handler and through Django's static file
+    # handler (what runserver uses), comparing bytes on the wire and time per request
+    async def compare_in_process(self, assets, repeat):
+        handler = PrecompressedStaticFiles(not_found)
+        baseline = ASGIStaticFilesHandler(not_found)
+        self.stdout.write(
+            f"{'asset':<44} {'identity':>9} {'gzip':>8} {'br':>8} {'django ms':>9} {'asgi ms':>8} {'cache'}"
+        )
+        # Django's handler finds the source files, which have the unhashed names
+        prefix = '/' + settings.STATIC_URL.lstrip('/')
+        source_names = {hashed: name for name, hashed in getattr(staticfiles_storage, 'hashed_files', {}).items()}
+        totals = {'identity': 0, 'gzip': 0, 'br': 0}
+        baseline_total = served_total = 0.0
+        for path in assets:
+            status, _, _ = await asgi_get(handler, path, {})
+            if status != 200:
+                raise CommandError(f"{path} is not in STATIC_ROOT, run collectstatic first")
+            sizes = {}
+            for encoding in totals:
+                _, headers, body = await asgi_get(handler, path, {'Accept-Encoding': encoding})
+                sizes[encoding] = len(body)
+                totals[encoding] += len(body)
+            (_, headers, _), served = await timed(lambda: asgi_get(handler, path, {'Accept-Encoding': 'gzip, br'}), repeat)
+            source_path = prefix + source_names.get(path[len(prefix):], path[len(prefix):])
+            (status, _, _), django = await timed(lambda: asgi_get(baseline, source_path, {'Accept-Encoding': 'gzip, br'}), repeat)
+            if status != 200:
+                raise CommandError(f"Django's static file handler couldn't serve {source_path}")
+            baseline_total += django
+            served_total += served
+            cache = 'immutable' if b'immutable' in headers.get(b'cache-control', b'') else 'revalidate'
+            self.stdout.write(
+                f"{path[-44:]:<44} {sizes['identity']:>9} {sizes['gzip']:>8} {sizes['br']:>8} "
+                f"{django * 1000:>9.3f} {served * 1000:>8.3f} {cache}"
+            )
+        self.stdout.write(
+            f"{'total':<44} {totals['identity']:>9} {totals['gzip']:>8} {totals['br']:>8} "
+            f"{baseline_total * 1000:>9.3f} {served_total * 1000:>8.3f}"
+        )
+        if totals['identity']:
+            self.stdout.write(
+                f"Transferred with br: {totals['br'] / totals['identity']:.0%} of the uncompressed bytes; "
+                f"repeat visits with hashed names need no requests at all"
+            )
+
+    async def time_cdn(self):
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+                started_at = time.perf_counter()
+                async with session.get(CDN_URL, headers={'Accept-Encoding': 'gzip, br'}) as response:
+                    body = await response.read()
+                    elapsed = time.perf_counter() - started_at
+                    wire = response.headers.get('Content-Length', '?')
+            self.stdout.write(
+                f"CDN marked.min.js (DNS, TLS and fetch): {elapsed * 1000:.1f} ms, {wire} bytes on the wire, {len(body)} decoded"
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.stdout.write(f"CDN marked.min.js unreachable ({e.__class__.__name__}), the old page couldn't render markdown here")
+
+    # Cold and warm load of the page's assets from a running server
+    async def load_page(self, url, assets):
+        async with aiohttp.ClientSession(auto_decompress=False) as session:
+            for label, encoding in (('identity', 'identity'), ('compressed', 'gzip, br')):
+                started_at = time.perf_counter()
+                wire = 0
+                etags = {}
+                for path in assets:
+                    async with session.get(url + path, headers={'Accept-Encoding': encoding}) as response:
+                        wire += len(await response.read())
+                        etags[path] = response.headers.get('ETag')
+                cold = time.perf_counter() - started_at
+                started_at = time.perf_counter()
+                revalidated = 0
+                for path in assets:
+                    async with session.get(url + path, headers={'Accept-Encoding': encoding, 'If-None-Match': etags[path] or ''}) as response:
+                        revalidated += response.status == 304
+                warm = time.perf_counter() - started_at
+                self.stdout.write(
+                    f"{url} {label}: {wire} bytes, cold {cold * 1000:.1f} ms, "
+                    f"revalidation {warm * 1000:.1f} ms ({revalidated}/{len(assets)} not modified)"
+                )
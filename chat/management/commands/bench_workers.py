@@ -0,0 +1,82 @@
+import asyncio
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from chat.management.commands.replay_traffic import Command as ReplayCommand, percentile, synthetic_scripts
+from chat.models import Patient
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+class Command(BaseCommand):
+    help = "Benchmark chat turn throughput against runworkers with an increasing number of workers, using the stub backends"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,2,4', help="Comma separated worker counts")
+        parser.add_argument('--clients', type=int, default=200, help="Concurrent WebSocket clients")
+        parser.add_argument('--duration', type=float, default=20.0, help="Seconds per worker count")
+        parser.add_argument('--port', type=int, default=8890)
+        parser.add_argument('--model-latency-ms', type=int, default=20, help="Stub model time per request")
+        parser.add_argument('--reuse-port', action='store_true', help="Pass --reuse-port to runworkers")
+
+    def handle(self, *args, **options):
+        patient_ids = list(Patient.objects.order_by('id').values_list('id', flat=True))
+        if not patient_ids:
+            raise CommandError("No patients to chat as")
+        # Distinct prompts, so the semantic cache doesn't answer most turns
+        scripts = synthetic_scripts(options['clients'], 50, 0, patient_ids, random.Random(0))
+        for index, script in enumerate(scripts):
+            for number, turn in enumerate(script['turns']):
+                turn['message'] = f"{turn['message']} ({index}-{number})"
+
+        environment = dict(
+            os.environ,
+            CHAT_STUB_BACKENDS='True',
+            CHAT_STUB_MODEL_LATENCY_MS=str(options['model_latency_ms']),
+            CHAT_STUB_MODEL_CONCURRENCY='1000',
+            QUOTA_ENABLED='False',
+        )
+        replay = ReplayCommand()
+        replay_options = {
+            'url': f"ws://127.0.0.1:{options['port']}", 'speed': 1.0, 'duration': options['duration'],
+            'ramp_up': 2.0, 'timeout': 30.0, 'msgpack': False,
+        }
+        self.stdout.write(f"{'workers':>7} {'turns/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'speedup':>7}")
+        baseline = None
+        for workers in [int(count) for count in options['workers'].split(',')]:
+            command = [sys.executable, sys.argv[0], 'runworkers', '--workers', str(workers), '-p', str(options['port'])]
+            if options['reuse_port']:
+                command.append('--reuse-port')
+            supervisor = subprocess.Popen(command, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not wait_for_port(options['port'], 60):
+                    raise CommandError("runworkers didn't start listening")
+                # Let every worker come up before measuring
+                time.sleep(2 + workers)
+                result, elapsed = asyncio.run(replay.run_step(scripts, options['clients'], replay_options))
+            finally:
+                supervisor.send_signal(signal.SIGTERM)
+                try:
+                    supervisor.wait(timeout=60)
+                except subprocess.TimeoutExpired:
+                    supervisor.kill()
+            throughput = len(result.latencies) / elapsed
+            baseline = baseline or throughput
+            latencies = [latency * 1000 for latency in result.latencies] or [0.0]
+            self.stdout.write(
+                f"{workers:>7} {throughput:>8.1f} {percentile(latencies, 0.5):>8.1f} {percentile(latencies, 0.95):>8.1f} "
+                f"{percentile(latencies, 0.99):>8.1f} {result.errors:>7} {throughput / baseline if baseline else 0:>6.2f}x"
+            )
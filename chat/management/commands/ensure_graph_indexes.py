@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from chat.graph_utils import GRAPH_INDEXES, ensure_graph_indexes
+
+
+class Command(BaseCommand):
+    help = "Create the Neo4j indexes used by patient sync, the dashboard API and availability lookups"
+
+    def handle(self, *args, **options):
+        ensure_graph_indexes()
+        self.stdout.write(self.style.SUCCESS(f"Ensured {len(GRAPH_INDEXES)} graph indexes"))
@@ -0,0 +1,53 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import Patient
+from chat.snapshot import PatientSnapshot, write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Export every patient's graph neighbourhood to the memory-mapped snapshot workers answer cold turns from"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.PATIENT_SNAPSHOT_PATH, help="Snapshot file to write")
+        parser.add_argument('--check', action='store_true', help="Don't export, report how many records of the existing snapshot are stale")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if options['check']:
+            return self.check_snapshot(path)
+
+        # context_version is bumped after the fields are saved, so a record exported mid-save
+        # carries the older version and is rejected rather than served
+        patients = Patient.objects.order_by('id').only(
+            'id', 'first_name', 'last_name', 'date_of_birth', 'phone_number', 'email', 'medical_condition',
+            'medication_regime', 'last_appointment', 'next_appointment', 'doctor_name', 'context_version',
+        )
+        started_at = time.perf_counter()
+        count = write_snapshot(path, patients.iterator(chunk_size=2000))
+        elapsed = time.perf_counter() - started_at
+        self.stdout.write(
+            f"Exported {count} patients to {path} ({os.path.getsize(path)} bytes) in {elapsed:.2f}s; "
+            f"running workers map it on their next restart or SIGHUP reload"
+        )
+
+    def check_snapshot(self, path):
+        try:
+            snapshot = PatientSnapshot(path)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Couldn't map {path}: {e}")
+        current = stale = missing = 0
+        for patient_id, context_version in Patient.objects.order_by('id').values_list('id', 'context_version').iterator():
+            entry = snapshot.entry(patient_id)
+            if entry is None:
+                missing += 1
+            elif entry[2] != context_version:
+                stale += 1
+            else:
+                current += 1
+        self.stdout.write(
+            f"{path}: {len(snapshot)} patients, taken {snapshot.created_at.isoformat()}; "
+            f"{current} current, {stale} stale, {missing} patients not in it"
+        )
+        snapshot.close()
@@ -0,0 +1,241 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import defaultdict
+from pathlib import Path
+import aiohttp
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat import turnlog
+from chat.models import Patient
+from chat.wire import MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL, encode_frame, decode_frame
+
+# Messages used for synthetic scripts and for turns replayed from the turn log,
+# picked by the information intent the recorded turn had
+INTENT_MESSAGES = {
+    "get_next_appointment": "When is my next appointment?",
+    "get_last_appointment": "When was my last appointment?",
+    "get_medications": "What medications am I taking?",
+    "get_medical_conditions": "What conditions do I have?",
+    "get_doctor_info": "Who is my doctor?",
+    "unknown_intent": "Can you help me with something?",
+}
+ACTION_MESSAGE = "Please move my appointment to next Tuesday at 10am."
+
+# A gap longer than this in the turn log starts a new conversation
+CONVERSATION_GAP = 30 * 60
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+# Scripts from a JSONL file, one conversation per line:
+# {"patient_id": 1, "turns": [{"message": "...", "delay": 2.5}, ...]}, delay in seconds before the turn
+def load_scripts(path):
+    scripts = []
+    with open(path) as lines:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                script = json.loads(line)
+                script["turns"] = [{"message": turn["message"], "delay": float(turn.get("delay", 0))} for turn in script["turns"]]
+            except (ValueError, KeyError, TypeError) as e:
+                raise CommandError(f"{path}:{number}: invalid script ({e})")
+            scripts.append(script)
+    return scripts
+
+# Synthetic conversations with exponentially distributed think times
+def synthetic_scripts(count, turns, think_time, patient_ids, rng):
+    messages = list(INTENT_MESSAGES.values()) + [ACTION_MESSAGE]
+    return [
+        {
+            "patient_id": patient_ids[index % len(patient_ids)],
+            "turns": [
+                {"message": rng.choice(messages), "delay": rng.expovariate(1 / think_time) if think_time else 0}
+                for _ in range(turns)
+            ],
+        }
+        for index in range(count)
+    ]
+
+# Conversations rebuilt from turn log segments: the recorded patients and inter-arrival
+# times, with a stand-in message for the recorded intent (the log keeps no text)
+def turnlog_scripts(paths):
+    turns_by_patient = defaultdict(list)
+    for record in turnlog.read_records(paths):
+        turns_by_patient[record.patient_id].append(record)
+
+    scripts = []
+    for patient_id, records in turns_by_patient.items():
+        records.sort(key=lambda record: record.started_at)
+        script, previous = None, None
+        for record in records:
+            gap = (record.started_at - previous) / 1_000_000 if previous is not None else None
+            if script is None or gap > CONVERSATION_GAP:
+                script = {"patient_id": patient_id, "turns": []}
+                scripts.append(script)
+                gap = 0
+            script["turns"].append({"message": turnlog_message(record), "delay": gap})
+            previous = record.started_at
+    return scripts
+
+def turnlog_message(record):
+    if record.prompt_intents & (1 << turnlog.PROMPT_INTENTS.index("do some action")):
+        return ACTION_MESSAGE
+    for index, intent in enumerate(turnlog.INFORMATION_INTENTS):
+        if record.information_intents & (1 << index):
+            return INTENT_MESSAGES[intent]
+    return INTENT_MESSAGES["unknown_intent"]
+
+
+# Next bot reply or error frame on a socket, None when it closed
+async def receive_reply(socket):
+    while True:
+        reply = await socket.receive()
+        if reply.type == aiohttp.WSMsgType.BINARY:
+            data = decode_frame(bytes_data=reply.data)
+        elif reply.type == aiohttp.WSMsgType.TEXT:
+            data = decode_frame(text_data=reply.data)
+        else:
+            return None
+        if data.get('sender') == 'bot' or 'sender' not in data and 'message' in data:
+            return data
+
+
+# Results of one concurrency step
+class StepResult:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.connect_errors = 0
+
+
+class Command(BaseCommand):
+    help = "Replay recorded or synthetic conversations over many concurrent WebSocket clients and report throughput per concurrency step"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://localhost:8000', help="Server base URL")
+        parser.add_argument('--scripts', help="JSONL file of conversation scripts")
+        parser.add_argument('--turnlog', nargs='*', help="Replay the turn log (segment files, defaults to TURNLOG_DIR)")
+        parser.add_argument('--synthetic', type=int, default=100, help="Synthetic conversations when no scripts are given")
+        parser.add_argument('--turns', type=int, default=5, help="Turns per synthetic conversation")
+        parser.add_argument('--think-time', type=float, default=5.0, help="Mean seconds between synthetic turns")
+        parser.add_argument('--patients', help="Comma separated patient ids to replay against (defaults to the script ids, or all patients)")
+        parser.add_argument('--speed', type=float, default=1.0, help="Divide recorded inter-arrival times by this factor")
+        parser.add_argument('--concurrency', default='10,50,100', help="Comma separated numbers of concurrent clients")
+        parser.add_argument('--duration', type=float, default=60.0, help="Seconds per concurrency step")
+        parser.add_argument('--ramp-up', type=float, default=5.0, help="Seconds over which a step's clients connect")
+        parser.add_argument('--timeout', type=float, default=30.0, help="Seconds to wait for a reply before counting an error")
+        parser.add_argument('--msgpack', action='store_true', help="Use the chat.msgpack.v1 subprotocol")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['speed'] <= 0:
+            raise CommandError("--speed must be positive")
+        scripts = self.build_scripts(options)
+        if not scripts:
+            raise CommandError("No conversations to replay")
+        if not settings.CHAT_STUB_BACKENDS:
+            self.stdout.write("Note: CHAT_STUB_BACKENDS is not set here; start the server with it to replay offline")
+        self.stdout.write(
+            f"Replaying {len(scripts)} conversations ({sum(len(script['turns']) for script in scripts)} turns) "
+            f"against {options['url']} at {options['speed']}x"
+        )
+        self.stdout.write(
+            f"{'clients':>7} {'turns':>7} {'turns/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'error %':>7}"
+        )
+        for concurrency in [int(count) for count in options['concurrency'].split(',')]:
+            result, elapsed = asyncio.run(self.run_step(scripts, concurrency, options))
+            turns = len(result.latencies)
+            attempts = turns + result.errors
+            latencies = [latency * 1000 for latency in result.latencies] or [0.0]
+            self.stdout.write(
+                f"{concurrency:>7} {turns:>7} {turns / elapsed:>8.1f} {percentile(latencies, 0.5):>8.1f} "
+                f"{percentile(latencies, 0.95):>8.1f} {percentile(latencies, 0.99):>8.1f} "
+                f"{result.errors:>7} {result.errors / attempts if attempts else 0:>7.1%}"
+            )
+            if result.connect_errors:
+                self.stdout.write(f"        {result.connect_errors} of the errors were failed connections")
+
+    def build_scripts(self, options):
+        rng = random.Random(options['seed'])
+        patient_ids = [int(patient_id) for patient_id in options['patients'].split(',')] if options['patients'] else None
+        if options['scripts']:
+            scripts = load_scripts(options['scripts'])
+        elif options['turnlog'] is not None:
+            paths = options['turnlog'] or sorted(Path(settings.TURNLOG_DIR).glob("turns-*.seg"))
+            scripts = turnlog_scripts(paths)
+        else:
+            if patient_ids is None:
+                patient_ids = list(Patient.objects.order_by('id').values_list('id', flat=True))
+                if not patient_ids:
+                    raise CommandError("No patients to replay against, pass --patients")
+            return synthetic_scripts(options['synthetic'], options['turns'], options['think_time'], patient_ids, rng)
+        # Recorded patients may not exist on the target server, map them onto the given ones
+        if patient_ids:
+            for index, script in enumerate(scripts):
+                script["patient_id"] = patient_ids[index % len(patient_ids)]
+        rng.shuffle(scripts)
+        return scripts
+
+    async def run_step(self, scripts, concurrency, options):
+        result = StepResult()
+        conversations = itertools.cycle(scripts)
+        started_at = time.monotonic()
+        deadline = started_at + options['duration']
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=options['timeout'])
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*[
+                self.run_client(session, conversations, index * options['ramp_up'] / concurrency, deadline, result, options)
+                for index in range(concurrency)
+            ])
+        return result, time.monotonic() - started_at
+
+    # One client: replay conversations back to back, each over its own socket, until the step ends
+    async def run_client(self, session, conversations, start_delay, deadline, result, options):
+        await asyncio.sleep(start_delay)
+        protocols = (MSGPACK_SUBPROTOCOL,) if options['msgpack'] else (JSON_SUBPROTOCOL,)
+        while time.monotonic() < deadline:
+            script = next(conversations)
+            url = f"{options['url'].rstrip('/')}/ws/chat/{script['patient_id']}/?echo=0"
+            try:
+                socket = await session.ws_connect(url, protocols=protocols)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                result.errors += 1
+                result.connect_errors += 1
+                await asyncio.sleep(1)
+                continue
+            binary = socket.protocol == MSGPACK_SUBPROTOCOL
+            try:
+                for turn in script["turns"]:
+                    delay = turn["delay"] / options['speed']
+                    if time.monotonic() + delay >= deadline:
+                        return
+                    await asyncio.sleep(delay)
+                    if not await self.run_turn(socket, binary, turn["message"], result, options['timeout']):
+                        break
+            finally:
+                await socket.close()
+
+    # Send a message and wait for the bot's reply; False when the socket can't be used any more
+    async def run_turn(self, socket, binary, message, result, timeout):
+        sent_at = time.perf_counter()
+        try:
+            frame = encode_frame({'message': message}, binary)
+            await (socket.send_bytes(frame) if binary else socket.send_str(frame))
+            data = await asyncio.wait_for(receive_reply(socket), timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError):
+            result.errors += 1
+            return False
+        if data is None:
+            result.errors += 1
+            return False
+        if data.get('sender') != 'bot':
+            # Error frames, like an unknown patient
+            result.errors += 1
+            return True
+        result.latencies.append(time.perf_counter() - sent_at)
+        return True
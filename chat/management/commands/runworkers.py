@@ -0,0 +1,39 @@
+import os
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.supervisor import Supervisor
+
+
+class Command(BaseCommand):
+    help = "Serve the ASGI application from several Daphne worker processes on one port, with restarts and graceful reloads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('application', nargs='?', default='patient_chatbot.asgi:application')
+        parser.add_argument('--workers', type=int, default=settings.CHAT_WORKERS, help="Worker processes (0 for one per CPU)")
+        parser.add_argument('-b', '--bind', default='127.0.0.1', help="Address to listen on")
+        parser.add_argument('-p', '--port', type=int, default=8000, help="Port to listen on")
+        parser.add_argument('--reuse-port', action='store_true', default=settings.CHAT_WORKER_REUSE_PORT,
+                            help="Give each worker its own SO_REUSEPORT socket instead of sharing one")
+        parser.add_argument('--proxy-headers', action='store_true', help="Use X-Forwarded-For for the client address")
+        parser.add_argument('--ready-timeout', type=int, default=60, help="Seconds a new worker has to start serving")
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or os.cpu_count()
+        if workers > 1 and settings.CHANNEL_LAYER_BACKEND != 'redis':
+            self.stderr.write("Warning: the in-memory channel layer doesn't reach sockets on other workers, set CHANNEL_LAYER_BACKEND=redis")
+        if workers > 1 and settings.QUOTA_ENABLED and settings.QUOTA_STORE != 'redis':
+            self.stderr.write("Warning: in-memory quotas are per worker, set QUOTA_STORE=redis to share them")
+
+        command = [sys.executable, '-m', 'chat.server']
+        if options['proxy_headers']:
+            command.append('--proxy-headers')
+        command.append(options['application'])
+        self.stdout.write(
+            f"Starting {workers} workers on {options['bind']}:{options['port']}; "
+            f"SIGHUP reloads them one by one, SIGTERM drains and stops"
+        )
+        Supervisor(
+            workers, options['bind'], options['port'], command,
+            reuse_port=options['reuse_port'], ready_timeout=options['ready_timeout'],
+        ).run()
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from chat.graph_utils import sync_patient_graph, sync_stats
+from chat.models import Patient
+
+
+class Command(BaseCommand):
+    help = "Sync patients to the graph, writing only what changed and removing stale relationships"
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="Patient ids (defaults to all patients)")
+        parser.add_argument('--force', action='store_true', help="Compare with the graph even if the content hash is unchanged")
+
+    def handle(self, *args, **options):
+        patients = Patient.objects.order_by('id')
+        if options['ids']:
+            patients = patients.filter(id__in=options['ids'])
+        for patient in patients.iterator():
+            sync_patient_graph(patient, force=options['force'])
+
+        saved = 1 - sync_stats["statements"] / sync_stats["full_statements"] if sync_stats["full_statements"] else 0.0
+        self.stdout.write(
+            f"Synced {sync_stats['saves']} patients ({sync_stats['skipped']} unchanged): "
+            f"{sync_stats['statements']} write statements instead of {sync_stats['full_statements']} ({saved:.0%} saved), "
+            f"+{sync_stats['relationships_added']}/-{sync_stats['relationships_removed']} relationships"
+        )
@@ -0,0 +1,103 @@
+import datetime
+import math
+from collections import Counter
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat import turnlog
+
+# Latencies go into log-spaced buckets (8 per doubling, ~9% wide) so percentiles of any
+# number of turns are computed in constant memory
+BUCKETS_PER_DOUBLING = 8
+
+def bucket(microseconds):
+    return int(math.log2(microseconds) * BUCKETS_PER_DOUBLING) if microseconds > 0 else -1
+
+def bucket_value(index):
+    return 0 if index < 0 else 2 ** ((index + 0.5) / BUCKETS_PER_DOUBLING)
+
+def percentile(histogram, count, fraction):
+    rank = fraction * count
+    seen = 0
+    for index in sorted(histogram):
+        seen += histogram[index]
+        if seen >= rank:
+            return bucket_value(index)
+    return 0
+
+def parse_since(value):
+    try:
+        since = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid --since {value!r}, expected an ISO date or datetime")
+    if since.tzinfo is None:
+        since = since.astimezone()
+    return int(since.timestamp() * 1_000_000)
+
+
+class Command(BaseCommand):
+    help = "Aggregate the turn log: per-stage latency percentiles, intent mix, cache hit rate and token usage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('segments', nargs='*', help="Segment files (defaults to every segment in TURNLOG_DIR)")
+        parser.add_argument('--since', help="Only turns started at or after this ISO date or datetime")
+        parser.add_argument('--patient', type=int, help="Only turns of this patient id")
+
+    def handle(self, *args, **options):
+        paths = options['segments'] or sorted(Path(settings.TURNLOG_DIR).glob("turns-*.seg"))
+        if not paths:
+            raise CommandError(f"No turn log segments in {settings.TURNLOG_DIR}")
+        since = parse_since(options['since']) if options['since'] else None
+
+        turns = 0
+        histograms = [Counter() for _ in turnlog.STAGES]
+        stage_counts = [0] * len(turnlog.STAGES)
+        prompt_intents = Counter()
+        information_intents = Counter()
+        flags = Counter()
+        input_tokens = output_tokens = 0
+        stats = {}
+        for record in turnlog.read_records(paths, stats):
+            if since is not None and record.started_at < since:
+                continue
+            if options['patient'] is not None and record.patient_id != options['patient']:
+                continue
+            turns += 1
+            for index, duration in enumerate(record.stages):
+                # Stages a turn didn't run are left out of that stage's percentiles
+                if duration:
+                    histograms[index][bucket(duration)] += 1
+                    stage_counts[index] += 1
+            for index, intent in enumerate(turnlog.PROMPT_INTENTS):
+                if record.prompt_intents & (1 << index):
+                    prompt_intents[intent] += 1
+            for index, intent in enumerate(turnlog.INFORMATION_INTENTS):
+                if record.information_intents & (1 << index):
+                    information_intents[intent] += 1
+            for name, flag in turnlog.FLAGS.items():
+                if record.flags & flag:
+                    flags[name] += 1
+            input_tokens += record.input_tokens
+            output_tokens += record.output_tokens
+
+        self.stdout.write(f"{turns} turns in {len(paths)} segments, {stats['corrupt']} corrupt records skipped")
+        if not turns:
+            return
+        self.stdout.write(f"{'stage':<12} {'turns':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for index, name in enumerate(turnlog.STAGES):
+            count = stage_counts[index]
+            if not count:
+                continue
+            p50, p95, p99 = (percentile(histograms[index], count, fraction) / 1000 for fraction in (0.5, 0.95, 0.99))
+            self.stdout.write(f"{name:<12} {count:>7} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+        self.stdout.write("Prompt intents: " + ", ".join(
+            f"{intent} {count / turns:.0%}" for intent, count in prompt_intents.most_common()
+        ))
+        self.stdout.write("Information intents: " + ", ".join(
+            f"{intent} {count}" for intent, count in information_intents.most_common()
+        ))
+        self.stdout.write("Flags: " + ", ".join(f"{name} {flags[name] / turns:.0%}" for name in turnlog.FLAGS))
+        self.stdout.write(
+            f"Tokens: {input_tokens} in, {output_tokens} out "
+            f"({(input_tokens + output_tokens) / turns:.0f} per turn)"
+        )
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.16 on 2026-10-19 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='context_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='context_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
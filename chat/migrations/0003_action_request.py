@@ -0,0 +1,28 @@
+# Generated by Django 4.2.16 on 2026-10-19 13:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_patient_context_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActionRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=64, unique=True)),
+                ('kind', models.CharField(choices=[('schedule_appointment', 'Schedule appointment'), ('update_medication', 'Update medication')], max_length=32)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('approved', 'Approved'), ('applied', 'Applied'), ('rejected', 'Rejected')], db_index=True, default='pending', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='action_requests', to='chat.patient')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.16 on 2026-10-19 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_action_request'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['doctor_name', 'id'], name='patient_doctor_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['doctor_name', 'next_appointment', 'id'], name='patient_doctor_next_idx'),
+        ),
+    ]
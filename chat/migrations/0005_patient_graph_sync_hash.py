@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-19 13:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_patient_doctor_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='graph_sync_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
@@ -1,7 +1,9 @@
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from .graph_utils import populate_patient_data
+from .graph_utils import sync_patient_graph
+from . import semantic_cache
+from .context import refresh_patient_context
 
 # Create your models here.
 class Patient(models.Model):
@@ -15,10 +17,56 @@ class Patient(models.Model):
     last_appointment = models.DateTimeField()
     next_appointment = models.DateTimeField()
     doctor_name = models.CharField(max_length=100)
+    context_document = models.TextField(blank=True, default='', editable=False) # Materialised prompt context
+    context_version = models.PositiveIntegerField(default=0, editable=False)
+    graph_sync_hash = models.CharField(max_length=64, blank=True, default='', editable=False) # Hash of the fields last synced to the graph
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a doctor's roster and upcoming appointments
+            models.Index(fields=['doctor_name', 'id'], name='patient_doctor_id_idx'),
+            models.Index(fields=['doctor_name', 'next_appointment', 'id'], name='patient_doctor_next_idx'),
+        ]
 
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
+
+# A patient request that needs the doctor's approval before it is written back.
+# The idempotency key is derived from the request and the record it changes, so a
+# repeated request or a retried approval maps onto the same row.
+class ActionRequest(models.Model):
+    SCHEDULE_APPOINTMENT = 'schedule_appointment'
+    UPDATE_MEDICATION = 'update_medication'
+    KIND_CHOICES = [
+        (SCHEDULE_APPOINTMENT, 'Schedule appointment'),
+        (UPDATE_MEDICATION, 'Update medication'),
+    ]
+
+    PENDING = 'pending'
+    APPROVED = 'approved'
+    APPLIED = 'applied'
+    REJECTED = 'rejected'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (APPROVED, 'Approved'),
+        (APPLIED, 'Applied'),
+        (REJECTED, 'Rejected'),
+    ]
+
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='action_requests')
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    payload = models.JSONField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    applied_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.patient} ({self.status})"
     
 @receiver(post_save, sender=Patient)
 def update_patient_in_graph(sender, instance, **kwargs):
-    populate_patient_data(instance)
\ No newline at end of file
+    semantic_cache.invalidate(instance.id)
+    refresh_patient_context(instance)
+    sync_patient_graph(instance)
\ No newline at end of file
@@ -41,3 +41,11 @@ class Neo4jDriver:
             result = session.write_transaction(lambda tx: tx.run(query, parameters).data())
             logger.info(f"Write query result: {result}")
             return result
+
+    # Execute several write queries in a single transaction
+    def execute_write_transaction(self, statements):
+        logger.info(f"Executing write transaction with {len(statements)} queries")
+        def work(tx):
+            return [tx.run(query, parameters).data() for query, parameters in statements]
+        with self.driver.session() as session:
+            return session.write_transaction(work)
@@ -1,28 +1,70 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, RoutingControl
 from langchain_community.graphs import Neo4jGraph
 import os
 import logging
+import threading
 from django.conf import settings
+from .stubs import StubGraph
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize the Neo4j driver
-neo4j_helper = Neo4jGraph(
-    url=settings.NEO4J_URI,
-    username=settings.NEO4J_USER,
-    password=settings.NEO4J_PASSWORD,
-)
-logger.info("Neo4j driver connected successfully.")
+neo4j_helper = None
+_neo4j_helper_lock = threading.Lock()
+
+# Initialize the Neo4j driver on first use, so the chat can start and answer
+# from SQL data while Neo4j is unavailable
+def get_neo4j_helper():
+    global neo4j_helper
+    with _neo4j_helper_lock:
+        if neo4j_helper is None and settings.CHAT_STUB_BACKENDS:
+            neo4j_helper = StubGraph(latency=settings.CHAT_STUB_GRAPH_LATENCY_MS / 1000)
+            logger.info("Using the stub graph, CHAT_STUB_BACKENDS is set.")
+        elif neo4j_helper is None:
+            neo4j_helper = Neo4jGraph(
+                url=settings.NEO4J_URI,
+                username=settings.NEO4J_USER,
+                password=settings.NEO4J_PASSWORD,
+            )
+            logger.info("Neo4j driver connected successfully.")
+    return neo4j_helper
+
+read_driver = None
+
+# Driver for read-only transactions, created on first use like the helper. The stub graph
+# answers driver queries too.
+def get_read_driver():
+    global read_driver
+    if settings.CHAT_STUB_BACKENDS:
+        return get_neo4j_helper()
+    with _neo4j_helper_lock:
+        if read_driver is None:
+            read_driver = GraphDatabase.driver(settings.NEO4J_URI, auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD))
+    return read_driver
 
 def execute_cypher_query_helper(query, params=None):
     try:
         logger.info(f"Executing cypher query: {query} with parameters: {params}")
-        results = neo4j_helper.query(query, params)
+        results = get_neo4j_helper().query(query, params)
         logger.info(f"Query results: {results}")
         return results
     except Exception as e:
         logger.error(f"Failed to execute read query: {e}")
         return None
 
+# Execute a query in a read-only transaction, Neo4j rejects any write inside it
+def execute_read_only_query_helper(query, params=None):
+    try:
+        logger.info(f"Executing read-only cypher query: {query} with parameters: {params}")
+        records, _, _ = get_read_driver().execute_query(
+            query,
+            parameters_=params,
+            routing_=RoutingControl.READ,
+        )
+        results = [record.data() for record in records]
+        logger.info(f"Query results: {results}")
+        return results
+    except Exception as e:
+        logger.error(f"Failed to execute read-only query: {e}")
+        return None
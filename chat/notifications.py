@@ -0,0 +1,22 @@
+import logging
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+# Name of the channel layer group every socket of a patient joins
+def patient_group_name(patient_id):
+    return f"patient_{patient_id}"
+
+# Push a server-initiated message to every open socket of a patient, on any worker
+async def notify_patient(patient_id, message, sender='bot', format='markdown'):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        logger.warning(f"No channel layer configured, dropping notification for patient_id: {patient_id}")
+        return
+    logger.info(f"Sending notification to patient_id: {patient_id}")
+    await channel_layer.group_send(patient_group_name(patient_id), {
+        'type': 'patient.message',
+        'sender': sender,
+        'message': message,
+        'format': format,
+    })
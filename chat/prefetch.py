@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import threading
+import time
+from cachetools import LRUCache
+from django.conf import settings
+from .neo4j_helper import execute_cypher_query_helper
+from .snapshot import get_snapshot
+from . import turnlog
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# The whole graph neighbourhood of a patient in a single round trip
+NEIGHBOURHOOD_QUERY = """
+    MATCH (p:Patient {id: $patient_id})
+    RETURN [(p)-[:ASSIGNED_TO]->(d:Doctor) | d.name] AS doctors,
+           [(p)-[:HAS_CONDITION]->(c:MedicalCondition) | c.name] AS conditions,
+           [(p)-[:TAKES_MEDICATION]->(m:MedicationRegime) | m.name] AS medications,
+           [(p)-[:HAD_APPOINTMENT]->(a:Appointment {type: 'last'}) | a.date] AS last_appointments,
+           [(p)-[:HAS_APPOINTMENT]->(a:Appointment {type: 'next'}) | a.date] AS next_appointments
+"""
+
+# A graph lookup running in a worker thread, started before anyone asked for it
+class GraphPrefetch:
+    def __init__(self, patient_id):
+        self.patient_id = patient_id
+        self.future = None
+        self.started_at = None
+        self.finished_at = None
+        self.from_snapshot = False
+
+    def run(self):
+        self.started_at = time.perf_counter()
+        try:
+            results = execute_cypher_query_helper(NEIGHBOURHOOD_QUERY, {"patient_id": self.patient_id})
+            return results[0] if results else None
+        finally:
+            self.finished_at = time.perf_counter()
+
+    @property
+    def duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+
+_prefetches = LRUCache(maxsize=settings.GRAPH_PREFETCH_MAX_PATIENTS)
+_lock = threading.Lock()
+
+# Running totals of the time saved by overlapping graph lookups with classification
+prefetch_stats = {
+    "turns": 0,
+    "saved_seconds": 0.0,
+}
+
+# A prefetch that is already done, holding a context read from the patient snapshot
+def snapshot_prefetch(patient_id, context):
+    prefetch = GraphPrefetch(patient_id)
+    prefetch.from_snapshot = True
+    prefetch.future = asyncio.get_running_loop().create_future()
+    prefetch.future.set_result(context)
+    return prefetch
+
+# Start warming the graph context of a patient, reusing a lookup that is still in flight.
+# Patients in the mapped snapshot are answered from it while their record is current.
+def start_prefetch(patient_id, context_version):
+    snapshot = get_snapshot()
+    if snapshot is not None and patient_id in snapshot:
+        context = snapshot.context(patient_id, context_version)
+        if context is not None:
+            return snapshot_prefetch(patient_id, context)
+    if not settings.GRAPH_PREFETCH_ENABLED:
+        return None
+    with _lock:
+        prefetch = _prefetches.get(patient_id)
+        if prefetch is not None and not prefetch.future.done():
+            return prefetch
+        prefetch = GraphPrefetch(patient_id)
+        # run_in_executor submits right away, so the lookup proceeds even while
+        # the event loop is blocked by a synchronous model call
+        prefetch.future = asyncio.get_running_loop().run_in_executor(None, prefetch.run)
+        _prefetches[patient_id] = prefetch
+    logger.info(f"Started graph prefetch for patient_id: {patient_id}")
+    return prefetch
+
+# Wait for a prefetched context and record how much wall-clock time the overlap saved
+async def get_prefetched_context(prefetch):
+    if prefetch is None:
+        return None
+    needed_at = time.perf_counter()
+    try:
+        context = await prefetch.future
+    except Exception as e:
+        logger.error(f"Graph prefetch failed for patient_id: {prefetch.patient_id}: {e}")
+        return None
+    if prefetch.from_snapshot:
+        turnlog.mark("snapshot")
+        return context
+    waited = time.perf_counter() - needed_at
+    saved = max(prefetch.duration - waited, 0.0)
+    prefetch_stats["turns"] += 1
+    prefetch_stats["saved_seconds"] += saved
+    average = prefetch_stats["saved_seconds"] / prefetch_stats["turns"]
+    logger.info(
+        f"Graph prefetch for patient_id: {prefetch.patient_id} saved {saved * 1000:.1f} ms "
+        f"(waited {waited * 1000:.1f} ms, average saved {average * 1000:.1f} ms/turn)"
+    )
+    return context
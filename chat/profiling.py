@@ -0,0 +1,93 @@
+import asyncio
+import cProfile
+import datetime
+import logging
+import os
+import random
+import tracemalloc
+from pathlib import Path
+from django.conf import settings
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Whether any turn can be profiled at all; checked before anything else so that
+# with profiling off a turn runs exactly as it would without this module
+profiling_enabled = settings.PROFILE_SAMPLE_RATE > 0 or settings.PROFILE_ALLOW_CLIENT_REQUESTS
+
+# Only one turn is profiled at a time, tracemalloc is process-wide
+_active = False
+
+# Decide whether to profile a turn: sampled, or asked for by the client when allowed
+def should_profile(data):
+    if _active:
+        return False
+    if data.get('profile') and settings.PROFILE_ALLOW_CLIENT_REQUESTS:
+        return True
+    return random.random() < settings.PROFILE_SAMPLE_RATE
+
+# Awaitable driving a coroutine step by step with the profiler enabled only while the
+# coroutine itself runs, so other sockets' turns on the same event loop stay out of the profile
+class ProfiledCoroutine:
+    def __init__(self, coroutine, profiler):
+        self.coroutine = coroutine
+        self.profiler = profiler
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self.profiler.enable()
+            try:
+                if error is not None:
+                    future = self.coroutine.throw(error)
+                else:
+                    future = self.coroutine.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.profiler.disable()
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+# Run a turn under cProfile and tracemalloc and write the dumps to PROFILE_DIR:
+# <name>.prof for pstats/snakeviz, <name>.tracemalloc for tracemalloc.Snapshot.load,
+# and <name>.txt with the top allocations made during the turn
+async def profile_turn(coroutine, patient_id):
+    global _active
+    _active = True
+    profiler = cProfile.Profile()
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(settings.PROFILE_TRACEMALLOC_FRAMES)
+    before = tracemalloc.take_snapshot()
+    try:
+        return await ProfiledCoroutine(coroutine, profiler)
+    finally:
+        after = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+        _active = False
+        name = f"turn-{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-patient-{patient_id}"
+        await asyncio.get_running_loop().run_in_executor(None, write_dumps, name, profiler, before, after)
+
+def write_dumps(name, profiler, before, after):
+    directory = Path(settings.PROFILE_DIR)
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(directory / f"{name}.prof")
+        after.dump(str(directory / f"{name}.tracemalloc"))
+        top = after.compare_to(before, 'lineno')[:25]
+        (directory / f"{name}.txt").write_text("\n".join(str(stat) for stat in top) + "\n")
+        logger.info(f"Wrote profile of turn to {directory / name}.*")
+        rotate(directory)
+    except OSError as e:
+        logger.error(f"Failed to write profile {name}: {e}")
+
+# Keep the newest PROFILE_MAX_FILES turns in the directory
+def rotate(directory):
+    turns = sorted({path.stem for path in directory.glob("turn-*")}, reverse=True)
+    for stem in turns[settings.PROFILE_MAX_FILES:]:
+        for path in directory.glob(f"{stem}.*"):
+            os.remove(path)
@@ -0,0 +1,202 @@
+import contextvars
+import logging
+import math
+import threading
+import time
+from cachetools import LRUCache
+from django.conf import settings
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Rough token count of a text sent to the model, before the model reports the real usage
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+# A token bucket refilled at `rate` per second up to `capacity`, charged `amount` by this turn
+class Bucket:
+    __slots__ = ("key", "rate", "capacity", "amount")
+
+    def __init__(self, key, per_minute, capacity, amount):
+        self.key = key
+        self.rate = per_minute / 60
+        self.capacity = capacity
+        self.amount = amount
+
+
+# Buckets in process memory, for a single worker or development
+class MemoryQuotaStore:
+    def __init__(self, max_keys=100000):
+        self.levels = LRUCache(maxsize=max_keys)
+        self.lock = threading.Lock()
+
+    # Refill and charge the buckets. With require=True nothing is charged unless every bucket
+    # holds its amount; returns (allowed, seconds until the short bucket would hold it)
+    async def take(self, buckets, require=True):
+        now = time.time()
+        with self.lock:
+            levels = []
+            for bucket in buckets:
+                level, updated = self.levels.get(bucket.key, (bucket.capacity, now))
+                level = min(bucket.capacity, level + max(0.0, now - updated) * bucket.rate)
+                if require and level < bucket.amount:
+                    return False, (bucket.amount - level) / bucket.rate
+                levels.append(level)
+            for bucket, level in zip(buckets, levels):
+                # Charges settled after the turn may overdraw, but never by more than a full bucket
+                self.levels[bucket.key] = (max(-bucket.capacity, min(bucket.capacity, level - bucket.amount)), now)
+        return True, 0.0
+
+
+# Same refill and charge as MemoryQuotaStore, run atomically in Redis so every worker shares the buckets
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local require = ARGV[2] == '1'
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate, capacity, amount = tonumber(ARGV[i * 3]), tonumber(ARGV[i * 3 + 1]), tonumber(ARGV[i * 3 + 2])
+    local state = redis.call('HMGET', key, 'level', 'updated')
+    local level = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    level = math.min(capacity, level + math.max(0, now - updated) * rate)
+    if require and level < amount then
+        return {0, tostring((amount - level) / rate)}
+    end
+    levels[i] = level
+end
+for i, key in ipairs(KEYS) do
+    local rate, capacity, amount = tonumber(ARGV[i * 3]), tonumber(ARGV[i * 3 + 1]), tonumber(ARGV[i * 3 + 2])
+    local level = math.max(-capacity, math.min(capacity, levels[i] - amount))
+    redis.call('HSET', key, 'level', tostring(level), 'updated', tostring(now))
+    -- A bucket left alone for two refills is full again and needn't be kept
+    redis.call('PEXPIRE', key, math.ceil(2 * capacity / rate * 1000))
+end
+return {1, '0'}
+"""
+
+class RedisQuotaStore:
+    def __init__(self, url):
+        self.url = url
+        self.script = None
+
+    async def take(self, buckets, require=True):
+        if self.script is None:
+            import redis.asyncio
+            self.script = redis.asyncio.from_url(self.url).register_script(TAKE_SCRIPT)
+        args = [time.time(), 1 if require else 0]
+        for bucket in buckets:
+            args += [bucket.rate, bucket.capacity, bucket.amount]
+        allowed, retry_after = await self.script(keys=[f"quota:{bucket.key}" for bucket in buckets], args=args)
+        return bool(allowed), float(retry_after)
+
+
+stores = {
+    "memory": MemoryQuotaStore,
+    "redis": lambda: RedisQuotaStore(settings.REDIS_URL),
+}
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = stores[settings.QUOTA_STORE]()
+    return _store
+
+
+# Model calls and tokens used by the turn being answered, carried in a contextvar
+# so every helper calling the model can add to it
+class TurnUsage:
+    __slots__ = ("calls", "tokens")
+
+    def __init__(self):
+        self.calls = 0
+        self.tokens = 0
+
+current_usage = contextvars.ContextVar("turn_usage", default=None)
+
+# Add a model response to the current turn; streamed chunks pass calls=0 after the first one
+def record_usage(message, calls=1):
+    usage = current_usage.get()
+    if usage is None:
+        return
+    usage.calls += calls
+    metadata = getattr(message, "usage_metadata", None)
+    if metadata:
+        usage.tokens += metadata.get("input_tokens", 0) + metadata.get("output_tokens", 0)
+
+
+# Outcome of admitting a turn; settle() charges what the turn really used
+class Admission:
+    def __init__(self, allowed, retry_after=0.0, buckets=None, estimated_tokens=0):
+        self.allowed = allowed
+        self.retry_after = retry_after
+        self.buckets = buckets or []
+        self.estimated_tokens = estimated_tokens
+        self.usage = TurnUsage()
+        self.token = None
+
+    @property
+    def retry_after_seconds(self):
+        return max(1, math.ceil(self.retry_after))
+
+
+def turn_buckets(patient_id, client_ip, estimated_tokens):
+    limits = [
+        (f"patient:{patient_id}", settings.QUOTA_PATIENT_CALLS_PER_MINUTE, settings.QUOTA_PATIENT_CALL_BURST,
+         settings.QUOTA_PATIENT_TOKENS_PER_MINUTE, settings.QUOTA_PATIENT_TOKEN_BURST),
+    ]
+    if client_ip:
+        limits.append((f"ip:{client_ip}", settings.QUOTA_IP_CALLS_PER_MINUTE, settings.QUOTA_IP_CALL_BURST,
+                       settings.QUOTA_IP_TOKENS_PER_MINUTE, settings.QUOTA_IP_TOKEN_BURST))
+    buckets = []
+    # A limit of 0 turns that bucket off
+    for key, calls_per_minute, call_burst, tokens_per_minute, token_burst in limits:
+        if calls_per_minute:
+            buckets.append(Bucket(f"{key}:calls", calls_per_minute, call_burst, 1))
+        if tokens_per_minute:
+            buckets.append(Bucket(f"{key}:tokens", tokens_per_minute, token_burst, estimated_tokens))
+    return buckets
+
+# Charge one model call and the estimated tokens of a turn up front, so concurrent turns
+# can't all pass on the same remaining budget. When the store can't be reached the turn
+# is let through: quotas bound cost, they shouldn't take the chat down.
+async def admit(patient_id, client_ip, estimated_tokens):
+    if not settings.QUOTA_ENABLED:
+        return Admission(True)
+    buckets = turn_buckets(patient_id, client_ip, estimated_tokens)
+    try:
+        allowed, retry_after = await get_store().take(buckets)
+    except Exception as e:
+        logger.error(f"Quota store unavailable, admitting turn: {e}")
+        return Admission(True)
+    if not allowed:
+        logger.warning(f"Model quota exhausted for patient {patient_id} from {client_ip}, retry in {retry_after:.0f}s")
+        return Admission(False, retry_after)
+    admission = Admission(True, buckets=buckets, estimated_tokens=estimated_tokens)
+    admission.token = current_usage.set(admission.usage)
+    return admission
+
+# Charge the difference between what the turn used and what admit() charged.
+# Tokens are only corrected when the model reported usage.
+async def settle(admission):
+    if admission.token is not None:
+        current_usage.reset(admission.token)
+        admission.token = None
+    if not admission.buckets:
+        return
+    usage = admission.usage
+    for bucket in admission.buckets:
+        if bucket.key.endswith(":calls"):
+            bucket.amount = usage.calls - 1
+        else:
+            bucket.amount = usage.tokens - admission.estimated_tokens if usage.tokens else 0
+    buckets = [bucket for bucket in admission.buckets if bucket.amount]
+    if not buckets:
+        return
+    try:
+        await get_store().take(buckets, require=False)
+    except Exception as e:
+        logger.error(f"Failed to settle model quota: {e}")
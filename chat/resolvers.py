@@ -0,0 +1,27 @@
+import logging
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Split a comma separated Patient field the same way graph_utils does
+def split_patient_field(value):
+    if not value:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+# Intents answered straight from the Patient row. Each resolver returns rows in the
+# shape of the matching intent_query_map query, so its process_result can be reused.
+sql_resolvers = {
+    "get_next_appointment": lambda patient: [{"next_appointment": patient.next_appointment}] if patient.next_appointment else [],
+    "get_last_appointment": lambda patient: [{"last_appointment": patient.last_appointment}] if patient.last_appointment else [],
+    "get_medications": lambda patient: [{"medication": medication} for medication in split_patient_field(patient.medication_regime)],
+    "get_doctor_info": lambda patient: [{"doctor_name": patient.doctor_name}] if patient.doctor_name else [],
+}
+
+# Resolve an intent from the already loaded Patient, or return None if it needs the graph
+def resolve_from_patient(patient, intent):
+    resolver = sql_resolvers.get(intent)
+    if resolver is None:
+        return None
+    logger.info(f"Resolving intent: {intent} from the Patient row for patient_id: {patient.id}")
+    return resolver(patient)
@@ -0,0 +1,195 @@
+import difflib
+import functools
+import logging
+import re
+import threading
+import time
+import zlib
+import numpy as np
+from cachetools import LRUCache
+from django.conf import settings
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+# Normalise a prompt so trivial differences (case, punctuation, spacing) don't matter
+def normalize_prompt(prompt):
+    return ' '.join(TOKEN_PATTERN.findall(prompt.lower()))
+
+# Words that carry no meaning of their own in a question
+FILLER_WORDS = frozenset("""
+    a about am an any are at be can could currently do does for get give got have has i i'm in
+    is it know let me my of on please show tell that the there to you your
+""".split())
+
+# Words of the questions patients ask, mapped to one spelling, so "pills" and "medications"
+# or "upcoming visit" and "next appointment" give the same key and vector
+SYNONYMS = {
+    word: canonical
+    for canonical, words in {
+        "medication": "medication medications medicine medicines meds pill pills drug drugs prescription prescriptions",
+        "appointment": "appointment appointments visit visits checkup checkups consultation",
+        "condition": "condition conditions diagnosis diagnoses illness illnesses disease diseases",
+        "doctor": "doctor doctors physician physicians gp",
+        "next": "next upcoming",
+        "last": "last previous",
+        "what": "what which",
+        "who": "who whom",
+    }.items()
+    for word in words.split()
+}
+
+# Misspelt words are matched to the longer words of SYNONYMS only: a typo there ("apointment")
+# still hits, while any other unknown word, a drug name included, is kept exactly as written
+TYPO_CANDIDATES = [word for word in SYNONYMS if len(word) >= 5]
+
+@functools.lru_cache(maxsize=4096)
+def canonical_word(token):
+    if token in SYNONYMS:
+        return SYNONYMS[token]
+    if token in FILLER_WORDS or len(token) < 5:
+        return token
+    match = difflib.get_close_matches(token, TYPO_CANDIDATES, n=1, cutoff=0.8)
+    return SYNONYMS[match[0]] if match else token
+
+def canonical_prompt(prompt):
+    return ' '.join(canonical_word(token) for token in normalize_prompt(prompt).split())
+
+# Every word of a prompt but the filler, after canonical_word: what is asked about, question
+# words, drug and condition names, dates, numbers and negations. Two prompts only share
+# answers if these match; the similarity threshold then decides how far the rest of the
+# phrasing (auxiliaries and tense, word order, politeness) may differ.
+def key_words(prompt):
+    return frozenset(token for token in canonical_prompt(prompt).split() if token not in FILLER_WORDS)
+
+# Messages before the prompt a cached answer is tied to, so a follow-up like
+# "and what about tomorrow?" is only answered from a turn that followed the same exchange
+CONTEXT_MESSAGES = 2
+
+def conversation_key(conversation):
+    turns = (conversation.turns or [])[-CONTEXT_MESSAGES:]
+    return hash(tuple(normalize_prompt(turn.text) for turn in turns))
+
+# Hash features of the normalised prompt into a fixed size, L2 normalised vector.
+# Word unigrams and bigrams capture phrasing. Character trigrams bring inflections and
+# typos close for match_information_intent; in the cache, key_words already settled those.
+def embed_prompt(prompt, dim):
+    tokens = normalize_prompt(prompt).split()
+    features = list(tokens)
+    features += [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    for token in tokens:
+        padded = f"#{token}#"
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+    vector = np.zeros(dim, dtype=np.float32)
+    if not features:
+        return vector
+    hashes = np.fromiter((zlib.crc32(f.encode()) for f in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, hashes % dim, signs)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+# Fingerprint of the patient fields answers depend on, so a changed record never serves stale answers
+def patient_fingerprint(patient):
+    return hash((
+        patient.first_name, patient.last_name, patient.date_of_birth, patient.phone_number, patient.email,
+        patient.medical_condition, patient.medication_regime, patient.doctor_name,
+        patient.last_appointment, patient.next_appointment,
+    ))
+
+# Cached answers of one patient, stored as rows of a matrix so a lookup is a single matrix-vector product
+class PatientAnswerIndex:
+    def __init__(self, dim, capacity, fingerprint):
+        self.dim = dim
+        self.capacity = capacity
+        self.fingerprint = fingerprint
+        self.vectors = np.zeros((min(8, capacity), dim), dtype=np.float32)
+        self.answers = []
+        self.keys = []
+        self.created_at = []
+        self.next_slot = 0
+
+    # Only entries stored under the same key words and conversation are candidates
+    def lookup(self, vector, key, threshold, ttl):
+        size = len(self.answers)
+        if not size:
+            return None, 0.0
+        matching = np.fromiter((stored == key for stored in self.keys), dtype=bool, count=size)
+        if not matching.any():
+            return None, 0.0
+        scores = np.where(matching, self.vectors[:size] @ vector, -1.0)
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        if score < threshold or time.monotonic() - self.created_at[best] > ttl:
+            return None, score
+        return self.answers[best], score
+
+    def add(self, vector, key, answer):
+        size = len(self.answers)
+        if size < self.capacity:
+            # Grow the matrix geometrically up to the configured capacity
+            if size == len(self.vectors):
+                grown = np.zeros((min(size * 2, self.capacity), self.dim), dtype=np.float32)
+                grown[:size] = self.vectors
+                self.vectors = grown
+            slot = size
+            self.answers.append(answer)
+            self.keys.append(key)
+            self.created_at.append(time.monotonic())
+        else:
+            # Full: overwrite the oldest entry
+            slot = self.next_slot
+            self.next_slot = (self.next_slot + 1) % self.capacity
+            self.answers[slot] = answer
+            self.keys[slot] = key
+            self.created_at[slot] = time.monotonic()
+        self.vectors[slot] = vector
+
+
+_indexes = LRUCache(maxsize=settings.SEMANTIC_CACHE_MAX_PATIENTS)
+_lock = threading.Lock()
+
+# Return a cached answer for a rephrasing of a prompt of this patient asked after the same
+# messages (conversation_key), or None
+def lookup(patient, prompt, context_key):
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return None
+    vector = embed_prompt(canonical_prompt(prompt), settings.SEMANTIC_CACHE_DIM)
+    key = (key_words(prompt), context_key)
+    with _lock:
+        index = _indexes.get(patient.id)
+        if index is None:
+            return None
+        if index.fingerprint != patient_fingerprint(patient):
+            del _indexes[patient.id]
+            return None
+        answer, score = index.lookup(vector, key, settings.SEMANTIC_CACHE_THRESHOLD, settings.SEMANTIC_CACHE_TTL)
+    if answer is not None:
+        logger.info(f"Semantic cache hit for patient_id: {patient.id} with similarity {score:.3f}")
+    return answer
+
+# Store the answer to a prompt of this patient, asked after the messages of context_key
+def store(patient, prompt, context_key, answer):
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return
+    vector = embed_prompt(canonical_prompt(prompt), settings.SEMANTIC_CACHE_DIM)
+    if not vector.any():
+        return
+    fingerprint = patient_fingerprint(patient)
+    with _lock:
+        index = _indexes.get(patient.id)
+        if index is None or index.fingerprint != fingerprint:
+            index = PatientAnswerIndex(settings.SEMANTIC_CACHE_DIM, settings.SEMANTIC_CACHE_ENTRIES, fingerprint)
+            _indexes[patient.id] = index
+        index.add(vector, (key_words(prompt), context_key), answer)
+
+# Drop every cached answer of a patient
+def invalidate(patient_id):
+    with _lock:
+        _indexes.pop(patient_id, None)
+    logger.info(f"Invalidated semantic cache for patient_id: {patient_id}")
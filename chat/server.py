@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from django.conf import settings
+from twisted.internet import defer, reactor
+from .connections import connection_registry
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Accept a permessage-deflate offer from the client, if it made one.
+# Without context takeover the compressor is reset after every message, which costs
+# some ratio but doesn't keep a compression window per idle socket.
+def accept_deflate(offers):
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(
+                offer, no_context_takeover=settings.CHAT_WEBSOCKET_DEFLATE_NO_CONTEXT_TAKEOVER or None
+            )
+    return None
+
+# Daphne server negotiating permessage-deflate on WebSocket connections.
+# Daphne builds its WebSocket factory inside run(), so the option is set once the reactor is running,
+# before any connection is handled.
+# Run as a runworkers worker it also reports when it is serving and drains its sockets on SIGUSR1.
+class CompressingServer(Server):
+    def run(self):
+        self.ports = []
+        self.draining = False
+        if settings.CHAT_WEBSOCKET_DEFLATE:
+            reactor.callWhenRunning(self.enable_deflate)
+        reactor.callWhenRunning(self.worker_started)
+        super().run()
+
+    def enable_deflate(self):
+        self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+        logger.info("WebSocket permessage-deflate enabled")
+
+    def listen_success(self, port):
+        self.ports.append(port)
+        super().listen_success(port)
+
+    def worker_started(self):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: reactor.callFromThread(self.drain))
+        ready_fd = os.environ.pop('CHAT_WORKER_READY_FD', None)
+        if ready_fd:
+            os.write(int(ready_fd), b'1')
+            os.close(int(ready_fd))
+
+    # Stop accepting connections, ask connected clients to reconnect elsewhere, then exit
+    def drain(self):
+        if self.draining:
+            return
+        self.draining = True
+        logger.info(f"Worker {os.getpid()} draining")
+        for port in self.ports:
+            port.stopListening()
+        drained = defer.Deferred.fromFuture(
+            asyncio.ensure_future(connection_registry.drain(settings.CHAT_DRAIN_TIMEOUT))
+        )
+        drained.addBoth(lambda _: self.stop_when_closed(time.monotonic() + 5))
+
+    # Give the close handshakes a moment to finish, so clients see the restart close code
+    def stop_when_closed(self, deadline):
+        if time.monotonic() < deadline and any(not details.get('disconnected') for details in self.connections.values()):
+            reactor.callLater(0.05, self.stop_when_closed, deadline)
+            return
+        reactor.stop()
+
+
+class CompressingCommandLineInterface(CommandLineInterface):
+    server_class = CompressingServer
+
+
+# Same arguments as the daphne command, e.g.
+# python -m chat.server -b 0.0.0.0 -p 8000 patient_chatbot.asgi:application
+if __name__ == '__main__':
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'patient_chatbot.settings')
+    CompressingCommandLineInterface.entrypoint()
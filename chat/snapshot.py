@@ -0,0 +1,162 @@
+import datetime
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import msgpack
+import numpy as np
+from .graph_utils import patient_graph_state
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Snapshot file layout, all little-endian:
+#   header   magic, format, patient count, created at (unix microseconds)
+#   ids      int64 patient ids, sorted, binary searched in place
+#   entries  (offset, length, context_version) of each patient's record
+#   records  msgpack maps in the shape of graph_utils.patient_graph_state
+MAGIC = b"PCSNAP01"
+FORMAT = 1
+HEADER = struct.Struct("<8sIIq")
+ENTRY = np.dtype([("offset", "<u8"), ("length", "<u4"), ("context_version", "<u4")])
+
+# Keys of a record handed to the intents, as NEIGHBOURHOOD_QUERY returns them
+CONTEXT_KEYS = ["doctors", "conditions", "medications", "last_appointments", "next_appointments"]
+
+# Running totals of the graph lookups answered from the snapshot
+snapshot_stats = {
+    "hits": 0,
+    "stale": 0,
+    "misses": 0,
+}
+
+# Write the snapshot of the given patients to path. The records are staged in a temporary
+# file next to it and moved into place, so workers mapping the old file keep reading it.
+def write_snapshot(path, patients):
+    ids = []
+    entries = []
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryFile(dir=directory) as records:
+        for patient in patients:
+            record = msgpack.packb(patient_graph_state(patient))
+            ids.append(patient.id)
+            entries.append((records.tell(), len(record), patient.context_version))
+            records.write(record)
+        order = np.argsort(np.array(ids, dtype="<i8"), kind="stable")
+        ids = np.array(ids, dtype="<i8")[order]
+        entries = np.array(entries, dtype=ENTRY)[order]
+        if len(ids) and (np.diff(ids) == 0).any():
+            raise ValueError("Duplicate patient ids in snapshot")
+
+        handle, temporary_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+        try:
+            with os.fdopen(handle, "wb") as snapshot:
+                snapshot.write(HEADER.pack(MAGIC, FORMAT, len(ids), int(time.time() * 1_000_000)))
+                snapshot.write(ids.tobytes())
+                snapshot.write(entries.tobytes())
+                records.seek(0)
+                while chunk := records.read(1024 * 1024):
+                    snapshot.write(chunk)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+    return len(ids)
+
+
+# A snapshot mapped read-only. Lookups read the id and entry arrays and the record in
+# place, so workers mapping the same file share its pages through the page cache.
+class PatientSnapshot:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count, created_at = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or version != FORMAT:
+                raise ValueError(f"{path} is not a version {FORMAT} patient snapshot")
+            ids_at = HEADER.size
+            entries_at = ids_at + count * 8
+            self.records_at = entries_at + count * ENTRY.itemsize
+            if self.records_at > len(self.map):
+                raise ValueError(f"{path} is truncated")
+            self.ids = np.frombuffer(self.map, dtype="<i8", count=count, offset=ids_at)
+            self.entries = np.frombuffer(self.map, dtype=ENTRY, count=count, offset=entries_at)
+        except Exception:
+            self.map.close()
+            raise
+        self.created_at = datetime.datetime.fromtimestamp(created_at / 1_000_000, tz=datetime.timezone.utc)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # (offset, length, context_version) of a patient's record, copied out of the map
+    def entry(self, patient_id):
+        index = int(np.searchsorted(self.ids, patient_id))
+        if index < len(self.ids) and self.ids[index] == patient_id:
+            return self.entries[index].item()
+        return None
+
+    def __contains__(self, patient_id):
+        return self.entry(patient_id) is not None
+
+    # The record of a patient as exported, or None if the patient isn't in the snapshot
+    def record(self, patient_id):
+        entry = self.entry(patient_id)
+        if entry is None:
+            return None
+        offset, length, context_version = entry
+        start = self.records_at + offset
+        return context_version, msgpack.unpackb(self.map[start:start + length])
+
+    # The graph context of a patient in the shape of NEIGHBOURHOOD_QUERY, if the snapshot
+    # was taken at the patient's current context version. Every post_save that changes
+    # graph-relevant fields bumps context_version, so older records are stale.
+    def context(self, patient_id, context_version):
+        record = self.record(patient_id)
+        if record is None:
+            snapshot_stats["misses"] += 1
+            return None
+        version, state = record
+        if version != context_version:
+            snapshot_stats["stale"] += 1
+            logger.info(f"Snapshot record of patient_id: {patient_id} is at version {version}, the patient at {context_version}")
+            return None
+        snapshot_stats["hits"] += 1
+        context = {key: state[key] for key in CONTEXT_KEYS}
+        for key in ("last_appointments", "next_appointments"):
+            context[key] = [datetime.datetime.fromisoformat(value) for value in context[key]]
+        return context
+
+    def close(self):
+        # The numpy views must go before the map can be closed
+        self.ids = self.entries = None
+        self.map.close()
+
+
+_snapshot = None
+
+# Map the snapshot at path, replacing one mapped before; a missing or unreadable
+# file leaves workers on the graph
+def load_snapshot(path):
+    global _snapshot
+    try:
+        snapshot = PatientSnapshot(path)
+    except FileNotFoundError:
+        logger.info(f"No patient snapshot at {path}")
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(f"Couldn't map patient snapshot {path}: {e}")
+        return None
+    _snapshot = snapshot
+    logger.info(f"Mapped patient snapshot {path}: {len(snapshot)} patients, taken {snapshot.created_at.isoformat()}")
+    return snapshot
+
+def get_snapshot():
+    return _snapshot
@@ -3,10 +3,43 @@
 // Patient ID to be included with each message
 const patientId = document.getElementById('patient-id').value; //
 
-// WebSocket connection
-var chatSocket = new WebSocket(
-    'ws://' + window.location.host + '/ws/chat/' + patientId + '/'
-);
+// Close codes the server uses
+const CLOSE_IDLE = 4001;
+const CLOSE_SERVICE_RESTART = 4012;
+
+var chatSocket = null;
+var reconnectAttempts = 0;
+var reconnectRequested = false;
+var pendingFrames = []; // Messages typed while disconnected, sent once connected again
+
+// WebSocket connection. Offer the binary msgpack subprotocol, falling back to JSON,
+// and render our own messages locally instead of waiting for the server's echo.
+function connect() {
+    chatSocket = new WebSocket(
+        'ws://' + window.location.host + '/ws/chat/' + patientId + '/?echo=0',
+        ['chat.msgpack.v1', 'chat.json.v1']
+    );
+    chatSocket.binaryType = 'arraybuffer';
+    chatSocket.onopen = onOpen;
+    chatSocket.onmessage = onMessage;
+    chatSocket.onerror = onError;
+    chatSocket.onclose = onClose;
+}
+
+// Encode and decode frames in the subprotocol the server accepted
+function encodeFrame(payload) {
+    if (chatSocket.protocol === 'chat.msgpack.v1') {
+        return MessagePack.encode(payload);
+    }
+    return JSON.stringify(payload);
+}
+
+function decodeFrame(data) {
+    if (typeof data === 'string') {
+        return JSON.parse(data);
+    }
+    return MessagePack.decode(data);
+}
 
 // Function to display a message in the chat history
 function addMessage(sender, text, timestamp) {
@@ -46,6 +79,7 @@ document.getElementById('chat-form').addEventListener('submit', function(e) {
     if (message !== '') {
         const timestamp = getFormattedTimestamp(); // Get the current timestamp
         inputField.value = ''; // Clear the input field
+        addMessage('user', message, timestamp); // The server doesn't echo it back
 
         // Send the message to the server or WebSocket
         sendMessageToServer(message, patientId);
@@ -58,32 +92,77 @@ function getFormattedTimestamp() {
     return now.toLocaleString(); // Adjust options as needed for your locale
 }
 
-// Send a message to the server or WebSocket
+// Send a message to the server or WebSocket, or keep it until the socket is open again
 function sendMessageToServer(message, patientId) {
-    chatSocket.send(JSON.stringify({
+    const payload = {
         'message': message,
         'patient_id': patientId
-    }));
+    };
+    if (chatSocket.readyState === WebSocket.OPEN) {
+        chatSocket.send(encodeFrame(payload));
+        return;
+    }
+    pendingFrames.push(payload);
+    if (chatSocket.readyState === WebSocket.CLOSED && reconnectAttempts === 0) {
+        connect(); // Closed for being idle, reconnect now that there is something to send
+    }
+}
+
+// Send heartbeats so the server can tell a live but quiet tab from a dead connection
+const HEARTBEAT_INTERVAL = 25000;
+setInterval(function() {
+    if (chatSocket.readyState === WebSocket.OPEN) {
+        chatSocket.send(encodeFrame({'type': 'ping'}));
+    }
+}, HEARTBEAT_INTERVAL);
+
+function onOpen() {
+    reconnectAttempts = 0;
+    reconnectRequested = false;
+    const frames = pendingFrames;
+    pendingFrames = [];
+    frames.forEach(function(payload) {
+        chatSocket.send(encodeFrame(payload));
+    });
 }
 
 // Receive messages from the server or WebSocket
-chatSocket.onmessage = function(e) {
-    const data = JSON.parse(e.data);
+function onMessage(e) {
+    const data = decodeFrame(e.data);
+    if (data['type'] === 'pong') {
+        return; // Heartbeat reply
+    }
+    if (data['type'] === 'reconnect') {
+        reconnectRequested = true; // The server is restarting this worker and closes the socket next
+        return;
+    }
     const message = data['message'];
     const sender = data['sender'];
     const timestamp = getFormattedTimestamp(); // Or use a timestamp from the server
     addMessage(sender, message, timestamp);
-};
+}
 
 // Handle WebSocket errors
-chatSocket.onerror = function(e) {
+function onError(e) {
     console.error('WebSocket error observed:', e);
-};
-
-chatSocket.onclose = function(e) {
-    console.error('Chat socket closed unexpectedly. Code:', e.code, 'Reason:', e.reason);
-    // Optionally, you can attempt to reconnect here
-    // setTimeout(function() {
-    //     chatSocket = new WebSocket('ws://' + window.location.host + '/ws/chat/' + patientId + '/');
-    // }, 1000);
-};
\ No newline at end of file
+}
+
+// Reconnect after the server restarted or the connection dropped: soon, with jitter so a drained
+// worker's clients don't all arrive at once, backing off while the server stays unreachable.
+// A socket closed for being idle is reopened when the patient sends the next message.
+function onClose(e) {
+    if (e.code === CLOSE_IDLE) {
+        return;
+    }
+    let delay;
+    if (reconnectRequested || e.code === CLOSE_SERVICE_RESTART) {
+        delay = Math.random() * 2000;
+    } else {
+        console.error('Chat socket closed unexpectedly. Code:', e.code, 'Reason:', e.reason);
+        delay = Math.min(30000, 1000 * Math.pow(2, reconnectAttempts)) * (0.5 + Math.random() / 2);
+    }
+    reconnectAttempts++;
+    setTimeout(connect, delay);
+}
+
+connect();
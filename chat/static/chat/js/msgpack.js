@@ -0,0 +1,163 @@
+// chat/static/chat/js/msgpack.js
+
+// Minimal MessagePack encoder/decoder for the chat.msgpack.v1 subprotocol.
+// Supports nil, booleans, integers, floats, strings, binary, arrays and maps,
+// which covers every frame the chat server sends.
+const MessagePack = (function() {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function encode(value) {
+        const bytes = [];
+        write(value, bytes);
+        return new Uint8Array(bytes);
+    }
+
+    function writeUint(bytes, value, size) {
+        for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+            bytes.push(Math.floor(value / Math.pow(2, shift)) & 0xff);
+        }
+    }
+
+    function writeHeader(bytes, length, fix, fixLimit, codes) {
+        if (fix !== null && length < fixLimit) {
+            bytes.push(fix | length);
+        } else if (codes[0] !== null && length < 0x100) {
+            bytes.push(codes[0], length);
+        } else if (length < 0x10000) {
+            bytes.push(codes[1]);
+            writeUint(bytes, length, 2);
+        } else {
+            bytes.push(codes[2]);
+            writeUint(bytes, length, 4);
+        }
+    }
+
+    function write(value, bytes) {
+        if (value === null || value === undefined) {
+            bytes.push(0xc0);
+        } else if (value === false) {
+            bytes.push(0xc2);
+        } else if (value === true) {
+            bytes.push(0xc3);
+        } else if (typeof value === 'number') {
+            if (Number.isInteger(value) && value >= 0 && value < 0x80) {
+                bytes.push(value);
+            } else if (Number.isInteger(value) && value < 0 && value >= -32) {
+                bytes.push(value & 0xff);
+            } else if (Number.isInteger(value) && value >= 0 && value < 0x100000000) {
+                bytes.push(0xce);
+                writeUint(bytes, value, 4);
+            } else {
+                const view = new DataView(new ArrayBuffer(8));
+                view.setFloat64(0, value);
+                bytes.push(0xcb, ...new Uint8Array(view.buffer));
+            }
+        } else if (typeof value === 'string') {
+            const encoded = textEncoder.encode(value);
+            writeHeader(bytes, encoded.length, 0xa0, 32, [0xd9, 0xda, 0xdb]);
+            for (let i = 0; i < encoded.length; i++) {
+                bytes.push(encoded[i]);
+            }
+        } else if (value instanceof Uint8Array) {
+            writeHeader(bytes, value.length, null, 0, [0xc4, 0xc5, 0xc6]);
+            for (let i = 0; i < value.length; i++) {
+                bytes.push(value[i]);
+            }
+        } else if (Array.isArray(value)) {
+            writeHeader(bytes, value.length, 0x90, 16, [null, 0xdc, 0xdd]);
+            value.forEach(function(item) { write(item, bytes); });
+        } else {
+            const keys = Object.keys(value);
+            writeHeader(bytes, keys.length, 0x80, 16, [null, 0xde, 0xdf]);
+            keys.forEach(function(key) {
+                write(key, bytes);
+                write(value[key], bytes);
+            });
+        }
+    }
+
+    function decode(buffer) {
+        const bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function str(length) {
+            const value = textDecoder.decode(bytes.subarray(offset, offset + length));
+            offset += length;
+            return value;
+        }
+        function bin(length) {
+            const value = bytes.slice(offset, offset + length);
+            offset += length;
+            return value;
+        }
+        function array(length) {
+            const value = [];
+            for (let i = 0; i < length; i++) {
+                value.push(read());
+            }
+            return value;
+        }
+        function map(length) {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            }
+            return value;
+        }
+        function uint(size) {
+            let value = 0;
+            for (let i = 0; i < size; i++) {
+                value = value * 256 + bytes[offset + i];
+            }
+            offset += size;
+            return value;
+        }
+        function int(size) {
+            const value = uint(size);
+            const limit = Math.pow(2, size * 8);
+            return value >= limit / 2 ? value - limit : value;
+        }
+
+        function read() {
+            const code = bytes[offset++];
+            if (code < 0x80) return code;
+            if (code < 0x90) return map(code & 0x0f);
+            if (code < 0xa0) return array(code & 0x0f);
+            if (code < 0xc0) return str(code & 0x1f);
+            if (code >= 0xe0) return code - 0x100;
+            switch (code) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(uint(1));
+                case 0xc5: return bin(uint(2));
+                case 0xc6: return bin(uint(4));
+                case 0xca: offset += 4; return view.getFloat32(offset - 4);
+                case 0xcb: offset += 8; return view.getFloat64(offset - 8);
+                case 0xcc: return uint(1);
+                case 0xcd: return uint(2);
+                case 0xce: return uint(4);
+                case 0xcf: return uint(8);
+                case 0xd0: return int(1);
+                case 0xd1: return int(2);
+                case 0xd2: return int(4);
+                case 0xd3: return int(8);
+                case 0xd9: return str(uint(1));
+                case 0xda: return str(uint(2));
+                case 0xdb: return str(uint(4));
+                case 0xdc: return array(uint(2));
+                case 0xdd: return array(uint(4));
+                case 0xde: return map(uint(2));
+                case 0xdf: return map(uint(4));
+            }
+            throw new Error('Unsupported MessagePack type 0x' + code.toString(16));
+        }
+
+        return read();
+    }
+
+    return {encode: encode, decode: decode};
+})();
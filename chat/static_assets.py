@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import mimetypes
+import os
+import posixpath
+from cachetools import LRUCache
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Hashed names never change content, unhashed ones (like in DEBUG) must be revalidated
+IMMUTABLE_CACHE_CONTROL = b"public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = b"public, max-age=0, must-revalidate"
+
+# Precompressed variants written by CompressedManifestStaticFilesStorage, in order of preference
+ENCODING_SUFFIXES = [("br", ".br"), ("gzip", ".gz")]
+
+# Encodings the client accepts, from its Accept-Encoding header
+def accepted_encodings(header):
+    encodings = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+# ASGI application serving STATIC_ROOT in front of the Django application: the precompressed
+# variant the client accepts, immutable cache headers for hashed names, ETags for revalidation,
+# and small files kept in memory. Requests for anything else go to the wrapped application.
+class PrecompressedStaticFiles:
+    def __init__(self, application, root=None, prefix=None):
+        self.application = application
+        self.root = os.path.realpath(root or settings.STATIC_ROOT)
+        self.prefix = prefix or "/" + settings.STATIC_URL.lstrip("/")
+        self.bodies = LRUCache(maxsize=settings.STATIC_MEMORY_CACHE_BYTES, getsizeof=len)
+        self.immutable_names = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            return await self.application(scope, receive, send)
+        name = self.clean_name(scope["path"][len(self.prefix):])
+        variants = self.find(name) if name else None
+        if variants is None:
+            return await self.application(scope, receive, send)
+        if scope["method"] not in ("GET", "HEAD"):
+            return await self.respond(send, 405, [(b"allow", b"GET, HEAD")])
+
+        headers = dict(scope["headers"])
+        encodings = accepted_encodings(headers.get(b"accept-encoding", b"").decode("latin1"))
+        encoding, path, stat = next(
+            (variant for variant in variants if variant[0] is None or variant[0] in encodings), variants[-1]
+        )
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'.encode()
+        response_headers = [
+            (b"cache-control", IMMUTABLE_CACHE_CONTROL if self.is_immutable(name) else REVALIDATE_CACHE_CONTROL),
+            (b"etag", etag),
+        ]
+        if len(variants) > 1:
+            response_headers.append((b"vary", b"Accept-Encoding"))
+        if etag in [tag.strip() for tag in headers.get(b"if-none-match", b"").split(b",")]:
+            return await self.respond(send, 304, response_headers)
+
+        content_type, _ = mimetypes.guess_type(name)
+        if content_type and (content_type.startswith("text/") or content_type in ("application/javascript", "image/svg+xml")):
+            content_type += "; charset=utf-8"
+        response_headers += [
+            (b"content-type", (content_type or "application/octet-stream").encode()),
+            (b"content-length", str(stat.st_size).encode()),
+        ]
+        if encoding:
+            response_headers.append((b"content-encoding", encoding.encode()))
+        body = b"" if scope["method"] == "HEAD" else await self.read(path, stat)
+        await self.respond(send, 200, response_headers, body)
+
+    # Relative name inside STATIC_ROOT, or None for anything that would leave it
+    def clean_name(self, name):
+        name = posixpath.normpath(name).lstrip("/")
+        if name in ("", ".") or name.startswith("..") or "\x00" in name:
+            return None
+        return name
+
+    # The file and its precompressed variants as (encoding, path, stat), identity last
+    def find(self, name):
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        variants = []
+        for encoding, suffix in ENCODING_SUFFIXES:
+            try:
+                variant_stat = os.stat(path + suffix)
+            except OSError:
+                continue
+            # A variant older than the file was compressed from a previous version
+            if variant_stat.st_mtime_ns >= stat.st_mtime_ns:
+                variants.append((encoding, path + suffix, variant_stat))
+        variants.append((None, path, stat))
+        return variants
+
+    # Names the manifest maps to; empty without a manifest storage or before collectstatic
+    def is_immutable(self, name):
+        if self.immutable_names is None:
+            hashed_files = getattr(staticfiles_storage, "hashed_files", {})
+            self.immutable_names = set(hashed_files.values())
+        return name in self.immutable_names
+
+    async def read(self, path, stat):
+        key = (path, stat.st_mtime_ns)
+        body = self.bodies.get(key)
+        if body is None:
+            body = await asyncio.get_running_loop().run_in_executor(None, read_file, path)
+            if len(body) <= settings.STATIC_MEMORY_CACHE_BYTES // 16:
+                self.bodies[key] = body
+        return body
+
+    async def respond(self, send, status, headers, body=b""):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+def read_file(path):
+    with open(path, "rb") as file:
+        return file.read()
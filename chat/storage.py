@@ -0,0 +1,66 @@
+import gzip
+import logging
+import brotli
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Text assets worth compressing; images and fonts are compressed already
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.json', '.map', '.svg', '.txt', '.html', '.xml')
+
+# Encodings written next to each asset, with the suffix the ASGI static handler looks for
+ENCODINGS = {
+    'br': ('.br', lambda content: brotli.compress(content, quality=11)),
+    'gzip': ('.gz', lambda content: gzip.compress(content, compresslevel=9, mtime=0)),
+}
+
+# Manifest storage that also writes <name>.gz and <name>.br for the hashed copies of text assets
+# at collectstatic time, so serving a compressed asset costs nothing per request
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    warned_missing_manifest = False
+
+    # Without a manifest (collectstatic hasn't run) every {% static %} would raise ValueError.
+    # Serve the unhashed names instead, which the static handler revalidates on every load;
+    # the chat.W001 check reports the missing manifest at startup.
+    def stored_name(self, name):
+        if self.hashed_files:
+            return super().stored_name(name)
+        if not CompressedManifestStaticFilesStorage.warned_missing_manifest:
+            CompressedManifestStaticFilesStorage.warned_missing_manifest = True
+            logger.warning(f"No staticfiles manifest in {self.location}, serving unhashed static names; run collectstatic")
+        return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = []
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names.append(hashed_name)
+            yield name, hashed_name, processed
+        if dry_run or not settings.STATIC_PRECOMPRESS:
+            return
+        compressed = sum(len(self.compress(hashed_name)) for hashed_name in hashed_names)
+        logger.info(f"Precompressed {compressed} static files")
+
+    def compress(self, name):
+        if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+            return []
+        with self.open(name) as original:
+            content = original.read()
+        if len(content) < settings.STATIC_PRECOMPRESS_MIN_BYTES:
+            return []
+        written = []
+        for suffix, compress in ENCODINGS.values():
+            compressed = compress(content)
+            # Keep the encoding only if it saves enough to be worth a lookup
+            if len(compressed) > len(content) * 0.95:
+                continue
+            compressed_name = name + suffix
+            if self.exists(compressed_name):
+                self.delete(compressed_name)
+            self._save(compressed_name, ContentFile(compressed))
+            written.append(compressed_name)
+        logger.debug(f"Precompressed {name} as {written}")
+        return written
@@ -0,0 +1,149 @@
+import logging
+import re
+from typing import Annotated, Literal, Optional, Union
+import orjson
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from . import quotas, turnlog
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+CODE_FENCE = re.compile(r'^```(?:json)?\s*([\s\S]*?)\s*```$', re.MULTILINE)
+
+# Intents classify_prompt can return
+PromptIntent = Literal["get information", "do some action"]
+
+# Intents classify_intent can return, matching intent_query_map plus the fallback
+InformationIntent = Literal[
+    "get_next_appointment",
+    "get_last_appointment",
+    "get_medications",
+    "get_medical_conditions",
+    "get_doctor_info",
+    "unknown_intent",
+]
+
+class ScheduleAppointmentAction(BaseModel):
+    action: Literal["schedule appointment"]
+    new_date: Optional[str] = None
+    new_time: Optional[str] = None
+
+class UpdateMedicationAction(BaseModel):
+    action: Literal["update medication"]
+    medication: Optional[str] = None
+    dosage: Optional[str] = None
+
+Action = Annotated[Union[ScheduleAppointmentAction, UpdateMedicationAction], Field(discriminator="action")]
+
+prompt_intent_adapter = TypeAdapter(PromptIntent)
+information_intent_adapter = TypeAdapter(InformationIntent)
+action_adapter = TypeAdapter(Action)
+
+# Remove ```json ... ``` or ``` ... ``` fences the model sometimes adds despite the prompt
+def strip_code_fences(text):
+    return CODE_FENCE.sub(r'\1', text.strip()).strip()
+
+# Validate one array element, returning None and logging when it doesn't match the schema
+def validate_item(item, adapter):
+    try:
+        return adapter.validate_python(item)
+    except ValidationError as e:
+        logger.warning(f"Discarding model output element {item!r}: {e.errors()[0]['msg']}")
+        return None
+
+# Parse a JSON array answer and validate each element.
+# Returns None when the answer is not JSON at all; a bare element is treated as a one element array.
+def parse_json_array(text, adapter):
+    content = strip_code_fences(text)
+    try:
+        data = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        logger.error(f"Failed to parse JSON array from model output: {content}")
+        return None
+    if isinstance(data, (str, dict)):
+        data = [data]
+    elif not isinstance(data, list):
+        logger.error(f"Expected a JSON array from model output: {content}")
+        return None
+    items = [validate_item(item, adapter) for item in data]
+    return [item for item in items if item is not None]
+
+# Incremental parser for a streamed JSON array. feed() takes the next chunk of text and
+# returns the elements completed by it, so callers can act on each element before the
+# model has finished the rest of the array. Text before the opening bracket (code fences)
+# and after the closing bracket is ignored.
+class JsonArrayStreamParser:
+    def __init__(self):
+        self.started = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.current = []
+
+    def feed(self, chunk):
+        items = []
+        for char in chunk:
+            if self.done:
+                break
+            if not self.started:
+                if char == '[':
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                self.current.append(char)
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.emit(items)
+                continue
+            if char == '"':
+                self.in_string = True
+                self.current.append(char)
+            elif char in '{[':
+                self.depth += 1
+                self.current.append(char)
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    # Closing bracket of the array ends any pending number or literal
+                    self.emit(items)
+                    self.done = True
+                    continue
+                self.current.append(char)
+                if self.depth == 1:
+                    self.emit(items)
+            elif self.depth == 1 and (char == ',' or char.isspace()):
+                self.emit(items)
+            else:
+                self.current.append(char)
+        return items
+
+    def emit(self, items):
+        if not self.current:
+            return
+        text, self.current = ''.join(self.current), []
+        try:
+            items.append(orjson.loads(text))
+        except orjson.JSONDecodeError:
+            logger.warning(f"Discarding malformed model output element: {text}")
+
+# Stream a prompt through the model and yield each validated array element as soon as it is complete
+async def astream_json_array(llm, prompt, adapter):
+    parser = JsonArrayStreamParser()
+    calls = 1
+    async for chunk in llm.astream(prompt):
+        turnlog.record_usage(chunk)
+        quotas.record_usage(chunk, calls)
+        calls = 0
+        for item in parser.feed(chunk.content):
+            item = validate_item(item, adapter)
+            if item is not None:
+                yield item
+    if not parser.started:
+        logger.error("Model output did not contain a JSON array")
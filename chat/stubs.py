@@ -0,0 +1,67 @@
+import asyncio
+import json
+import time
+from langchain.schema import AIMessage
+from langchain_core.messages import AIMessageChunk
+
+# Offline stand-in for the chat model, for benchmarks and load tests.
+# Each request takes `latency` seconds and at most `concurrency` requests are
+# in flight, like an upstream quota would allow.
+class StubChatModel:
+    def __init__(self, latency=0.2, concurrency=8):
+        self.latency = latency
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.requests = 0
+
+    # Deterministic answer in the format the prompt asks for
+    def respond(self, prompt):
+        if "1. get information" in prompt:
+            return json.dumps(["get information"])
+        if "1. get_next_appointment" in prompt:
+            return json.dumps(["get_next_appointment"])
+        if "extracts action intents" in prompt:
+            return json.dumps([])
+        return "This is a stubbed response."
+
+    def prompt_text(self, prompt):
+        if isinstance(prompt, str):
+            return prompt
+        return "\n".join(message.content for message in prompt)
+
+    def invoke(self, prompt, **kwargs):
+        text = self.prompt_text(prompt)
+        self.requests += 1
+        time.sleep(self.latency)
+        return AIMessage(content=self.respond(text))
+
+    async def ainvoke(self, prompt, **kwargs):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        text = self.prompt_text(prompt)
+        async with self.semaphore:
+            self.requests += 1
+            await asyncio.sleep(self.latency)
+        return AIMessage(content=self.respond(text))
+
+    # Stream the answer a few characters at a time, like a model emitting tokens
+    async def astream(self, prompt, chunk_size=4, **kwargs):
+        message = await self.ainvoke(prompt)
+        for start in range(0, len(message.content), chunk_size):
+            yield AIMessageChunk(content=message.content[start:start + chunk_size])
+
+# Offline stand-in for the Neo4j graph, for load tests. Every query takes `latency`
+# seconds and returns no rows, so answers come from the SQL resolvers.
+# Mirrors the parts of Neo4jGraph and of the neo4j driver that neo4j_helper uses.
+class StubGraph:
+    def __init__(self, latency=0.005):
+        self.latency = latency
+        self.queries = 0
+
+    def query(self, query, params=None):
+        self.queries += 1
+        time.sleep(self.latency)
+        return []
+
+    def execute_query(self, query, **kwargs):
+        return self.query(query), None, None
@@ -0,0 +1,246 @@
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import time
+from django.conf import settings
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# A worker that exits sooner than this after starting counts as crashing, and is restarted with backoff
+MIN_UPTIME = 5
+MAX_BACKOFF = 30
+
+def listening_socket(host, port, reuse_port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    return sock
+
+
+# One worker process: chat.server (Daphne) serving the application on an inherited socket.
+# Workers are fresh interpreters rather than forks, so each builds its own model client,
+# Neo4j driver, database connections and event loop.
+class Worker:
+    def __init__(self, slot, sock, command):
+        self.slot = slot
+        self.sock = sock
+        self.command = command
+        self.process = None
+        self.started_at = None
+        self.ready = None
+        self.ready_read = None
+        self.retiring_since = None
+
+    # Spawn the worker; check_ready reports when it is serving, so the supervisor keeps
+    # restarting, reloading and handling signals while workers start
+    def start(self):
+        self.ready_read, ready_write = os.pipe()
+        environment = dict(os.environ, CHAT_WORKER_READY_FD=str(ready_write))
+        self.process = subprocess.Popen(
+            self.command + ['--fd', str(self.sock.fileno())],
+            env=environment,
+            pass_fds=(self.sock.fileno(), ready_write),
+        )
+        os.close(ready_write)
+        self.started_at = time.monotonic()
+        self.ready = None
+
+    # True once the worker reported it is serving, False if it died or ran out of time
+    # trying, None while it is still starting
+    def check_ready(self, ready_timeout):
+        if self.ready is not None:
+            return self.ready
+        readable, _, _ = select.select([self.ready_read], [], [], 0)
+        if readable:
+            self.ready = os.read(self.ready_read, 1) == b'1'
+        elif self.process.poll() is not None or time.monotonic() - self.started_at > ready_timeout:
+            self.ready = False
+        else:
+            return None
+        self.close_ready_pipe()
+        if self.ready:
+            logger.info(f"Worker {self.slot} (pid {self.process.pid}) ready")
+        else:
+            logger.error(f"Worker {self.slot} (pid {self.process.pid}) didn't become ready")
+        return self.ready
+
+    def close_ready_pipe(self):
+        if self.ready_read is not None:
+            os.close(self.ready_read)
+            self.ready_read = None
+
+    def drain(self):
+        if self.process.poll() is None:
+            self.retiring_since = time.monotonic()
+            self.process.send_signal(signal.SIGUSR1)
+
+    def kill(self):
+        self.close_ready_pipe()
+        if self.process.poll() is None:
+            self.process.kill()
+
+
+# Pre-fork style supervisor: keeps `workers` processes serving one port, restarts crashed
+# ones, replaces them one by one on SIGHUP and drains them all on SIGTERM/SIGINT
+class Supervisor:
+    def __init__(self, workers, host, port, command, reuse_port=False, ready_timeout=60):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.command = command
+        self.reuse_port = reuse_port
+        self.ready_timeout = ready_timeout
+        self.slots = []
+        self.retiring = []
+        self.crashes = {}
+        self.restart_at = {}
+        self.reload_requested = False
+        self.reload_pending = []
+        self.reload_skipped = []
+        self.reload_attempts = None
+        self.reload_retry_at = 0
+        self.replacing = None
+        self.stop_requested = 0
+
+    # With SO_REUSEPORT each worker gets its own socket and the kernel spreads connections
+    # evenly; otherwise all workers accept from one shared socket
+    def socket_for(self, slot):
+        if self.reuse_port or not self.slots:
+            return listening_socket(self.host, self.port, self.reuse_port)
+        return self.slots[0].sock
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        for slot in range(self.workers):
+            worker = Worker(slot, self.socket_for(slot), self.command)
+            self.slots.append(worker)
+            worker.start()
+        logger.info(f"Serving on {self.host}:{self.port} with {self.workers} workers (supervisor pid {os.getpid()})")
+
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                logger.info("Reloading workers")
+                self.reload_pending = list(range(len(self.slots)))
+                self.reload_skipped = []
+                self.reload_attempts = 0
+                self.reload_retry_at = 0
+            self.check_starting()
+            self.reload()
+            self.restart_crashed()
+            self.reap_retiring()
+            time.sleep(0.2)
+        self.shutdown()
+
+    # Only flags the stop, run() drains the workers and closes the sockets; a second
+    # signal makes shutdown() kill them instead of waiting for them to drain
+    def request_stop(self, signum, frame):
+        self.stop_requested += 1
+
+    # Kill workers that died or timed out before becoming ready, restart_crashed replaces them
+    def check_starting(self):
+        for worker in self.slots:
+            if worker.check_ready(self.ready_timeout) is False and worker.process.poll() is None:
+                worker.kill()
+
+    # Replace workers one at a time: start the new one, then drain the old one once the new
+    # one is ready, so the port is served throughout. A slot whose new worker doesn't become
+    # ready keeps its old worker and is retried after the other slots, with backoff.
+    def reload(self):
+        if self.replacing is not None:
+            index, new = self.replacing
+            ready = new.check_ready(self.ready_timeout)
+            if ready is None:
+                return
+            self.replacing = None
+            old = self.slots[index]
+            if ready:
+                self.slots[index] = new
+                old.drain()
+                self.retiring.append(old)
+            else:
+                logger.error(f"Keeping worker {old.slot} (pid {old.process.pid}), its replacement didn't start")
+                new.kill()
+                new.process.wait()
+                self.reload_skipped.append(index)
+
+        if self.reload_pending:
+            if time.monotonic() < self.reload_retry_at:
+                return
+            index = self.reload_pending.pop(0)
+            new = Worker(self.slots[index].slot, self.slots[index].sock, self.command)
+            new.start()
+            self.replacing = (index, new)
+        elif self.reload_skipped:
+            self.reload_attempts += 1
+            delay = min(MAX_BACKOFF, 2 ** self.reload_attempts)
+            logger.error(f"Reload skipped workers {sorted(self.reload_skipped)}, retrying them in {delay}s")
+            self.reload_pending = self.reload_skipped
+            self.reload_skipped = []
+            self.reload_retry_at = time.monotonic() + delay
+        elif self.reload_attempts is not None:
+            logger.info("Reload finished")
+            self.reload_attempts = None
+
+    def restart_crashed(self):
+        now = time.monotonic()
+        for index, worker in enumerate(self.slots):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            if worker.slot not in self.restart_at:
+                uptime = now - worker.started_at
+                # Exiting soon after starting, or before ever becoming ready, counts as a crash
+                crashes = self.crashes.get(worker.slot, 0) + 1 if uptime < MIN_UPTIME or not worker.ready else 0
+                self.crashes[worker.slot] = crashes
+                delay = min(MAX_BACKOFF, 2 ** crashes - 1)
+                logger.error(f"Worker {worker.slot} (pid {worker.process.pid}) exited with {code}, restarting in {delay}s")
+                self.restart_at[worker.slot] = now + delay
+            if now >= self.restart_at[worker.slot]:
+                del self.restart_at[worker.slot]
+                worker.close_ready_pipe()
+                replacement = Worker(worker.slot, worker.sock, self.command)
+                self.slots[index] = replacement
+                replacement.start()
+
+    def reap_retiring(self):
+        for worker in list(self.retiring):
+            if worker.process.poll() is not None:
+                self.retiring.remove(worker)
+            elif time.monotonic() - worker.retiring_since > settings.CHAT_DRAIN_TIMEOUT + 10:
+                logger.error(f"Worker pid {worker.process.pid} didn't drain in time, killing it")
+                worker.kill()
+
+    def shutdown(self):
+        logger.info("Draining all workers")
+        if self.replacing is not None:
+            self.slots.append(self.replacing[1])
+            self.replacing = None
+        for worker in self.slots:
+            worker.close_ready_pipe()
+            worker.drain()
+        self.retiring += self.slots
+        sockets = {worker.sock for worker in self.slots}
+        self.slots = []
+        while self.retiring:
+            if self.stop_requested > 1:
+                logger.info("Stopping again, killing the workers")
+                for worker in self.retiring:
+                    worker.kill()
+                    worker.process.wait()
+            self.reap_retiring()
+            time.sleep(0.2)
+        for sock in sockets:
+            sock.close()
+        logger.info("All workers stopped")
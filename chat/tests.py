@@ -1,3 +1,717 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import orjson
+import os
+import tempfile
+from pathlib import Path
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from . import profiling, quotas, semantic_cache, turnlog
+from . import ai
+from .ai import schema
+from .action_executor import apply_batch, approve_actions, idempotency_key, request_action
+from .availability import DoctorSchedule, availability_index, to_timestamp
+from .connections import connection_registry
+from .consumers import ChatConsumer
+from .conversation import ConversationState
+from .cypher_fallback import CypherFallback
+from .dashboard import decode_cursor, ndjson_stream, sql_appointments_page, sql_patients_page
+from .graph_utils import graph_state_hash, graph_sync_statements, patient_graph_state, sync_patient_graph
+from .models import ActionRequest, Patient
+from .routing import websocket_urlpatterns
+from .snapshot import PatientSnapshot, snapshot_stats, write_snapshot
+from .structured_output import JsonArrayStreamParser, action_adapter, astream_json_array
+from .stubs import StubChatModel
+from .wire import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, decode_frame, echo_requested, encode_frame, select_subprotocol
 
-# Create your tests here.
+def make_patient(**fields):
+    values = {
+        "id": 1, "first_name": "Ann", "last_name": "Lee", "date_of_birth": datetime.date(1980, 1, 1),
+        "phone_number": "555-0100", "email": "ann@example.com", "medical_condition": "Asthma, Diabetes",
+        "medication_regime": "Aspirin, Metformin", "doctor_name": "Smith",
+        "last_appointment": datetime.datetime(2024, 1, 5, 9, 0, tzinfo=datetime.timezone.utc),
+        "next_appointment": datetime.datetime(2030, 1, 7, 10, 0, tzinfo=datetime.timezone.utc),
+    }
+    values.update(fields)
+    return Patient(**values)
+
+
+@override_settings(SEMANTIC_CACHE_ENABLED=True, SEMANTIC_CACHE_THRESHOLD=0.85)
+class SemanticCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.patient = make_patient()
+        self.empty = semantic_cache.conversation_key(ConversationState())
+        semantic_cache.invalidate(self.patient.id)
+
+    def tearDown(self):
+        semantic_cache.invalidate(self.patient.id)
+
+    def test_rephrased_question_hits(self):
+        semantic_cache.store(self.patient, "What medications am I taking?", self.empty, "Aspirin, Metformin")
+        self.assertEqual(semantic_cache.lookup(self.patient, "what medications am i taking", self.empty), "Aspirin, Metformin")
+        self.assertEqual(semantic_cache.lookup(self.patient, "What medications am I taking, please?", self.empty), "Aspirin, Metformin")
+
+    def test_synonyms_and_typos_of_the_question_hit(self):
+        semantic_cache.store(self.patient, "What medications am I taking?", self.empty, "Aspirin, Metformin")
+        semantic_cache.store(self.patient, "When is my next appointment?", self.empty, "On Monday")
+        asked = {
+            "Which medicines am I taking?": "Aspirin, Metformin",
+            "what medicatoins am i taking": "Aspirin, Metformin",
+            "When is my upcoming visit?": "On Monday",
+            "when is my next apointment": "On Monday",
+        }
+        for prompt, answer in asked.items():
+            with self.subTest(prompt=prompt):
+                self.assertEqual(semantic_cache.lookup(self.patient, prompt, self.empty), answer)
+
+    def test_drug_names_are_never_corrected(self):
+        for name in ["lisinopril", "metformin", "insulin", "warfarin", "ibuprofen", "alcohol"]:
+            with self.subTest(name=name):
+                self.assertEqual(semantic_cache.canonical_word(name), name)
+
+    def test_medically_different_questions_miss(self):
+        pairs = [
+            ("Can I double my dose of lisinopril if I missed one?", "Can I double my dose of metformin if I missed one?"),
+            ("Is it safe to drink alcohol with my medication?", "Is it safe to drink coffee with my medication?"),
+            ("What medications am I taking?", "What medications am I not taking?"),
+            ("When is my appointment on Monday?", "When is my appointment on Tuesday?"),
+            ("When is my next appointment?", "When was my last appointment?"),
+            ("When is my next appointment?", "Where is my next appointment?"),
+            ("What are my medications?", "What are my conditions?"),
+            ("What medications am I taking?", "What medications should I be taking?"),
+        ]
+        for stored, asked in pairs:
+            with self.subTest(asked=asked):
+                semantic_cache.invalidate(self.patient.id)
+                semantic_cache.store(self.patient, stored, self.empty, "cached")
+                self.assertIsNone(semantic_cache.lookup(self.patient, asked, self.empty))
+
+    def test_follow_up_only_hits_after_the_same_messages(self):
+        appointments = ConversationState()
+        appointments.add('user', "When is my next appointment?")
+        appointments.add('bot', "On Monday at 10:00.")
+        medications = ConversationState()
+        medications.add('user', "Can I refill my aspirin?")
+        medications.add('bot', "Yes, at any pharmacy.")
+        semantic_cache.store(self.patient, "And what about tomorrow?", semantic_cache.conversation_key(appointments), "cached")
+        self.assertIsNone(semantic_cache.lookup(self.patient, "And what about tomorrow?", semantic_cache.conversation_key(medications)))
+        self.assertIsNone(semantic_cache.lookup(self.patient, "And what about tomorrow?", self.empty))
+        self.assertEqual(semantic_cache.lookup(self.patient, "and what about tomorrow", semantic_cache.conversation_key(appointments)), "cached")
+
+    def test_changed_patient_record_misses(self):
+        semantic_cache.store(self.patient, "Who is my doctor?", self.empty, "Dr. Smith")
+        changed = make_patient(doctor_name="Jones")
+        self.assertIsNone(semantic_cache.lookup(changed, "Who is my doctor?", self.empty))
+
+
+@override_settings(SEMANTIC_CACHE_ENABLED=True, STRUCTURED_OUTPUT_EARLY_DISPATCH=False)
+class CachedAnswerTests(SimpleTestCase):
+    def setUp(self):
+        self.patient = make_patient()
+        semantic_cache.invalidate(self.patient.id)
+        self.addCleanup(semantic_cache.invalidate, self.patient.id)
+        stubs = [("llm", StubChatModel(latency=0)), ("classify_intent", self.classify_intent), ("start_prefetch", lambda *args: None)]
+        for name, value in stubs:
+            patcher = mock.patch.object(ai, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # Conditions aren't on the Patient row, so they need the graph
+    async def classify_intent(self, patient, prompt):
+        return ["get_medical_conditions"]
+
+    def ask(self, prompt):
+        conversation = ConversationState()
+        with mock.patch.object(ai, "classify_prompt", return_value=["get information"]):
+            return async_to_sync(ai.answer_with_model)(self.patient.id, self.patient, prompt, conversation)
+
+    def test_failed_lookup_is_not_cached(self):
+        with mock.patch.object(ai, "execute_cypher_query_helper", side_effect=ConnectionError("Neo4j unavailable")):
+            self.ask("What conditions do I have?")
+        self.assertIsNone(semantic_cache.lookup(self.patient, "What conditions do I have?", semantic_cache.conversation_key(ConversationState())))
+
+    def test_resolved_lookup_is_cached(self):
+        with mock.patch.object(ai, "execute_cypher_query_helper", return_value=[{"condition": "Asthma"}]):
+            answer = self.ask("What conditions do I have?")
+        self.assertEqual(semantic_cache.lookup(self.patient, "What conditions do I have?", semantic_cache.conversation_key(ConversationState())), answer)
+
+
+
+class GraphPrefetchTests(SimpleTestCase):
+    def test_only_prompts_that_may_need_the_graph_prefetch(self):
+        for prompt in ["When is my next appointment?", "What medications am I taking?", "Who is my doctor?"]:
+            with self.subTest(prompt=prompt):
+                self.assertFalse(ai.may_need_graph(prompt))
+        for prompt in ["What conditions do I have?", "When is my next appointment and what conditions do I have?", "What is my blood type?"]:
+            with self.subTest(prompt=prompt):
+                self.assertTrue(ai.may_need_graph(prompt))
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create skips post_save, so nothing reaches the graph
+        now = timezone.now().replace(microsecond=0)
+        cls.tomorrow = now + datetime.timedelta(days=1)
+        patients = [
+            make_patient(id=None, first_name=f"P{i}", doctor_name="Keyset", next_appointment=cls.tomorrow + datetime.timedelta(hours=i // 2))
+            for i in range(10)
+        ]
+        patients.append(make_patient(id=None, first_name="Past", doctor_name="Keyset", next_appointment=now - datetime.timedelta(days=1)))
+        patients.append(make_patient(id=None, first_name="Other", doctor_name="Other"))
+        Patient.objects.bulk_create(patients)
+        cls.ids = list(Patient.objects.filter(doctor_name="Keyset").order_by('id').values_list('id', flat=True))
+
+    def pages(self, page_function, limit):
+        pages, cursor = [], None
+        while True:
+            rows, next_cursor = page_function("Keyset", decode_cursor(cursor), limit)
+            pages.append(rows)
+            if next_cursor is None:
+                return pages
+            cursor = next_cursor
+
+    def test_patient_pages_cover_every_row_once(self):
+        for limit in (1, 3, 11, 12, 50):
+            with self.subTest(limit=limit):
+                pages = self.pages(sql_patients_page, limit)
+                self.assertEqual([row['id'] for page in pages for row in page], self.ids)
+                self.assertTrue(all(len(page) == limit for page in pages[:-1]))
+
+    def test_full_last_page_is_followed_by_an_empty_one(self):
+        pages = self.pages(sql_patients_page, 11)
+        self.assertEqual([len(page) for page in pages], [11, 0])
+
+    def test_appointment_pages_break_date_ties_by_id(self):
+        for limit in (1, 2, 3, 7):
+            with self.subTest(limit=limit):
+                rows = [row for page in self.pages(sql_appointments_page, limit) for row in page]
+                keys = [(row['next_appointment'], row['patient_id']) for row in rows]
+                self.assertEqual(len(rows), 10)
+                self.assertEqual(keys, sorted(keys))
+                self.assertEqual(len(set(keys)), 10)
+                self.assertNotIn("Past", [row['first_name'] for row in rows])
+
+    def test_invalid_cursor_is_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_cursor("not a cursor")
+
+    def test_ndjson_stream_yields_every_row(self):
+        async def collect():
+            return [line async for line in ndjson_stream(sql_patients_page, "Keyset", 4)]
+        lines = async_to_sync(collect)()
+        self.assertEqual([orjson.loads(line)['id'] for line in lines], self.ids)
+
+
+# Records the statements of each graph transaction instead of writing them
+class RecordingDriver:
+    def __init__(self):
+        self.transactions = []
+
+    def execute_write_transaction(self, statements):
+        self.transactions.append(statements)
+
+
+
+def at(day, hour, minute=0):
+    return datetime.datetime(2030, 1, day, hour, minute, tzinfo=datetime.timezone.utc)
+
+
+@override_settings(
+    TIME_ZONE='UTC', APPOINTMENT_SLOT_MINUTES=30, APPOINTMENT_SEARCH_DAYS=14,
+    CLINIC_OPENING_HOUR=9, CLINIC_CLOSING_HOUR=17, CLINIC_WORKING_DAYS=[0, 1, 2, 3, 4],
+)
+class DoctorScheduleTests(SimpleTestCase):
+    # 2030-01-07 is a Monday
+    def test_is_free(self):
+        schedule = DoctorSchedule("Smith", [to_timestamp(at(7, 10))])
+        self.assertTrue(schedule.is_free(at(7, 9)))
+        self.assertFalse(schedule.is_free(at(7, 10)))
+        self.assertFalse(schedule.is_free(at(7, 9, 45)))
+        self.assertTrue(schedule.is_free(at(7, 10), exclude=at(7, 10)))
+        self.assertTrue(schedule.is_free(at(7, 16, 30)))
+        self.assertFalse(schedule.is_free(at(7, 16, 45)))
+        self.assertFalse(schedule.is_free(at(7, 8, 30)))
+        self.assertFalse(schedule.is_free(at(5, 10)))
+        self.assertFalse(schedule.is_free(datetime.datetime(2020, 1, 6, 10, tzinfo=datetime.timezone.utc)))
+
+    def test_next_free_slots_skip_booked_runs_and_closed_hours(self):
+        # Monday is booked solid, Tuesday until 11:00 with one unaligned booking at 9:45
+        booked = [at(7, 9) + datetime.timedelta(minutes=30 * slot) for slot in range(16)]
+        booked += [at(8, 9), at(8, 9, 45), at(8, 10, 30)]
+        schedule = DoctorSchedule("Smith", map(to_timestamp, booked))
+        with mock.patch.object(schedule, "first_conflict", wraps=schedule.first_conflict) as first_conflict:
+            slots = schedule.next_free_slots(at(7, 8), 2)
+        self.assertEqual(slots, [at(8, 11), at(8, 11, 30)])
+        # One lookup per run of bookings and per free slot, not one per taken slot
+        self.assertEqual(first_conflict.call_count, 4)
+
+        self.assertEqual(schedule.next_free_slots(at(11, 16, 30), 2), [at(11, 16, 30), at(14, 9)])
+
+    def test_next_free_slots_offer_the_excluded_booking(self):
+        schedule = DoctorSchedule("Smith", map(to_timestamp, [at(7, 9), at(7, 9, 30), at(7, 10)]))
+        self.assertEqual(schedule.next_free_slots(at(7, 9), 1, exclude=at(7, 9, 30)), [at(7, 9, 30)])
+        schedule.cancel(at(7, 9, 30))
+        self.assertEqual(schedule.next_free_slots(at(7, 9), 1), [at(7, 9, 30)])
+        schedule.book(at(7, 9, 30))
+        self.assertEqual(schedule.next_free_slots(at(7, 9), 1), [at(7, 10, 30)])
+
+
+@override_settings(AVAILABILITY_CHECK_ENABLED=True)
+class ActionExecutorTests(TestCase):
+    def setUp(self):
+        # bulk_create skips post_save, so nothing reaches the graph
+        self.ann, self.bob = Patient.objects.bulk_create([
+            make_patient(id=None, first_name="Ann", doctor_name="Actions"),
+            make_patient(id=None, first_name="Bob", doctor_name="Actions"),
+        ])
+        # An empty, freshly loaded schedule, so the availability check doesn't go to the graph
+        availability_index.schedules["Actions"] = DoctorSchedule("Actions")
+        self.slot = (timezone.now() + datetime.timedelta(days=3)).replace(microsecond=0)
+
+    def tearDown(self):
+        availability_index.schedules.pop("Actions", None)
+
+    def request(self, patient, kind, payload):
+        return async_to_sync(request_action)(Patient.objects.get(pk=patient.pk), kind, payload)
+
+    def apply(self, ids):
+        approve_actions(ids)
+        driver = RecordingDriver()
+        return apply_batch(driver), driver
+
+    def test_repeated_request_reuses_the_pending_one(self):
+        payload = {'medication': 'Lisinopril', 'dosage': '10mg'}
+        first, created = self.request(self.ann, ActionRequest.UPDATE_MEDICATION, payload)
+        again, created_again = self.request(self.ann, ActionRequest.UPDATE_MEDICATION, {'medication': 'lisinopril ', 'dosage': '10MG'})
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(first.pk, again.pk)
+
+    def test_key_depends_on_dosage_and_patient(self):
+        keys = {
+            idempotency_key(self.ann, ActionRequest.UPDATE_MEDICATION, {'medication': 'Lisinopril', 'dosage': '10mg'}),
+            idempotency_key(self.ann, ActionRequest.UPDATE_MEDICATION, {'medication': 'Lisinopril', 'dosage': '20mg'}),
+            idempotency_key(self.bob, ActionRequest.UPDATE_MEDICATION, {'medication': 'Lisinopril', 'dosage': '10mg'}),
+            idempotency_key(self.ann, ActionRequest.UPDATE_MEDICATION, {'medication': 'Lisinopril', 'dosage': '10mg'}, last_applied_id=1),
+        }
+        self.assertEqual(len(keys), 4)
+
+    def test_returning_to_an_earlier_dosage_is_a_new_request(self):
+        ids = []
+        for dosage in ('10mg', '20mg', '10mg'):
+            action_request, created = self.request(self.ann, ActionRequest.UPDATE_MEDICATION, {'medication': 'Lisinopril', 'dosage': dosage})
+            self.assertTrue(created, dosage)
+            self.apply([action_request.pk])
+            ids.append(action_request.pk)
+        statuses = ActionRequest.objects.filter(pk__in=ids).values_list('status', flat=True)
+        self.assertEqual(set(statuses), {ActionRequest.APPLIED})
+
+    def test_one_request_per_patient_and_kind_per_batch(self):
+        first, _ = self.request(self.ann, ActionRequest.UPDATE_MEDICATION, {'medication': 'Lisinopril', 'dosage': '10mg'})
+        second, _ = self.request(self.ann, ActionRequest.UPDATE_MEDICATION, {'medication': 'Ibuprofen', 'dosage': '200mg'})
+        other, _ = self.request(self.bob, ActionRequest.UPDATE_MEDICATION, {'medication': 'Lisinopril', 'dosage': '10mg'})
+        batch, driver = self.apply([first.pk, second.pk, other.pk])
+        self.assertEqual([action_request.pk for action_request in batch], [first.pk, other.pk])
+        self.assertEqual(len(driver.transactions), 1)
+        (_, parameters), = driver.transactions[0]
+        self.assertEqual([row['patient_id'] for row in parameters['rows']], [self.ann.pk, self.bob.pk])
+        batch, _ = self.apply([])
+        self.assertEqual([action_request.pk for action_request in batch], [second.pk])
+
+    def test_second_request_for_a_slot_is_rejected(self):
+        payload = {'start': self.slot.isoformat()}
+        first, _ = self.request(self.ann, ActionRequest.SCHEDULE_APPOINTMENT, payload)
+        second, _ = self.request(self.bob, ActionRequest.SCHEDULE_APPOINTMENT, payload)
+        batch, _ = self.apply([first.pk, second.pk])
+        self.assertEqual([action_request.status for action_request in batch], [ActionRequest.APPLIED, ActionRequest.REJECTED])
+        self.assertEqual(Patient.objects.get(pk=self.ann.pk).next_appointment, self.slot)
+        self.assertNotEqual(Patient.objects.get(pk=self.bob.pk).next_appointment, self.slot)
+        self.assertEqual(ActionRequest.objects.get(pk=second.pk).status, ActionRequest.REJECTED)
+
+    def test_slot_booked_since_the_request_is_rejected(self):
+        action_request, _ = self.request(self.ann, ActionRequest.SCHEDULE_APPOINTMENT, {'start': self.slot.isoformat()})
+        availability_index.book("Actions", self.slot + datetime.timedelta(minutes=10))
+        batch, driver = self.apply([action_request.pk])
+        self.assertEqual(batch[0].status, ActionRequest.REJECTED)
+        self.assertEqual(driver.transactions, [])
+
+
+class CypherFallbackTests(SimpleTestCase):
+    def setUp(self):
+        self.fallback = CypherFallback(StubChatModel(latency=0.05), schema)
+
+    def test_validate_accepts_patient_anchored_reads(self):
+        queries = [
+            "MATCH (p:Patient {id: $patient_id})-[:TAKES_MEDICATION]->(m:MedicationRegime) RETURN m.name AS medication LIMIT 20",
+            "MATCH (p:Patient {id: $patient_id})-[:HAS_APPOINTMENT]->(a:Appointment) WHERE a.date > datetime($p0) RETURN a.date AS date",
+            "MATCH (p:Patient {id: $patient_id}) OPTIONAL MATCH (p)-[:ASSIGNED_TO]->(d:Doctor) RETURN d.name AS doctor",
+            "MATCH (p:Patient {id: $patient_id})-[:HAS_CONDITION]->(c:MedicalCondition) WHERE c.name = 'Set up' RETURN c.name",
+        ]
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertIsNone(self.fallback.validate(query, {"p0": "2030-01-01"}))
+
+    def test_validate_rejects_writes_and_other_patients(self):
+        queries = {
+            "MATCH (p:Patient {id: $patient_id}) SET p.email = 'x' RETURN p": "read-only",
+            "MATCH (p:Patient {id: $patient_id}) DETACH DELETE p": "read-only",
+            "MATCH (p:Patient {id: $patient_id}) CALL db.labels() YIELD label RETURN label": "read-only",
+            "MATCH (p:Patient) RETURN p.email": "anchored",
+            "MATCH (p:Patient {id: $patient_id}), (q:Patient) RETURN q.email": "other than the current one",
+            "MATCH (p:Patient {id: $patient_id})-[:ASSIGNED_TO]->(d:Doctor)<-[:ASSIGNED_TO]-(o) RETURN o": "backwards",
+            "MATCH (p:Patient {id: $patient_id}), (d:Doctor) RETURN d.name": "does not start at the patient",
+            "MATCH (p:Patient {id: $patient_id})-[:KNOWS]->(x) RETURN x": "unknown relationship type",
+            "MATCH (p:Patient {id: $patient_id})-[:ASSIGNED_TO]->(d:Secret) RETURN d": "unknown label",
+            "MATCH (p:Patient {id: $patient_id}) WHERE p.id = $other RETURN p": "unknown parameters",
+        }
+        for query, reason in queries.items():
+            with self.subTest(query=query):
+                self.assertIn(reason, self.fallback.validate(query, {}))
+
+    def test_concurrent_questions_share_one_generation_despite_cancellation(self):
+        async def ask():
+            first = asyncio.ensure_future(self.fallback.get_template("shape", {}))
+            second = asyncio.ensure_future(self.fallback.get_template("shape", {}))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            third = asyncio.ensure_future(self.fallback.get_template("shape", {}))
+            return await asyncio.gather(second, third)
+        # The stub model's answer isn't Cypher, so the shape is cached as unanswerable
+        self.assertEqual(async_to_sync(ask)(), [None, None])
+        self.assertEqual(self.fallback.llm.requests, 1)
+        self.assertIn("shape", self.fallback.templates)
+        self.assertEqual(self.fallback.pending, {})
+
+
+class ChatConsumerTests(SimpleTestCase):
+    def test_disconnect_before_connect_finished(self):
+        consumer = ChatConsumer()
+        consumer.channel_name = "test.channel"
+        connection_registry.connections[consumer.channel_name] = consumer
+        async_to_sync(consumer.disconnect)(1006)
+        self.assertNotIn(consumer.channel_name, connection_registry.connections)
+
+
+class WireFormatTests(SimpleTestCase):
+    @override_settings(CHAT_MSGPACK_ENABLED=True)
+    def test_select_subprotocol(self):
+        self.assertEqual(select_subprotocol([MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL]), MSGPACK_SUBPROTOCOL)
+        self.assertEqual(select_subprotocol([JSON_SUBPROTOCOL]), JSON_SUBPROTOCOL)
+        self.assertIsNone(select_subprotocol([]))
+        self.assertIsNone(select_subprotocol(["other"]))
+
+    @override_settings(CHAT_MSGPACK_ENABLED=False)
+    def test_msgpack_disabled_falls_back_to_json(self):
+        self.assertEqual(select_subprotocol([MSGPACK_SUBPROTOCOL]), JSON_SUBPROTOCOL)
+
+    @override_settings(CHAT_ECHO_USER_MESSAGES=True)
+    def test_echo_requested(self):
+        self.assertTrue(echo_requested({'query_string': b''}))
+        self.assertTrue(echo_requested({}))
+        self.assertFalse(echo_requested({'query_string': b'echo=0'}))
+        self.assertFalse(echo_requested({'query_string': b'echo=false'}))
+        self.assertTrue(echo_requested({'query_string': b'echo=1'}))
+
+    def test_frames_round_trip(self):
+        payload = {'type': 'chat_message', 'message': "Your next appointment is on Monday", 'sender': 'bot'}
+        text = encode_frame(payload, False)
+        self.assertIsInstance(text, str)
+        self.assertEqual(decode_frame(text_data=text), payload)
+        data = encode_frame(payload, True)
+        self.assertIsInstance(data, bytes)
+        self.assertLess(len(data), len(text))
+        self.assertEqual(decode_frame(bytes_data=data), payload)
+
+    def ping(self, subprotocols, binary):
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), "/ws/chat/1/", subprotocols=subprotocols
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            if binary:
+                await communicator.send_to(bytes_data=encode_frame({'type': 'ping'}, True))
+            else:
+                await communicator.send_to(text_data=encode_frame({'type': 'ping'}, False))
+            response = await communicator.receive_output()
+            await communicator.disconnect()
+            return subprotocol, response
+        return async_to_sync(run)()
+
+    @override_settings(CHAT_MSGPACK_ENABLED=True)
+    def test_consumer_negotiates_msgpack(self):
+        subprotocol, response = self.ping([MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL], True)
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        self.assertEqual(decode_frame(bytes_data=response['bytes']), {'type': 'pong'})
+
+    def test_consumer_without_subprotocol_sends_json_text(self):
+        subprotocol, response = self.ping([], False)
+        self.assertIsNone(subprotocol)
+        self.assertEqual(decode_frame(text_data=response['text']), {'type': 'pong'})
+
+
+class ProfilingTests(SimpleTestCase):
+    @override_settings(PROFILE_ALLOW_CLIENT_REQUESTS=False, PROFILE_SAMPLE_RATE=0.0)
+    def test_client_request_ignored_when_not_allowed(self):
+        self.assertFalse(profiling.should_profile({'message': "hi", 'profile': True}))
+
+    @override_settings(PROFILE_ALLOW_CLIENT_REQUESTS=True, PROFILE_SAMPLE_RATE=0.0)
+    def test_client_request_profiled_when_allowed(self):
+        self.assertTrue(profiling.should_profile({'message': "hi", 'profile': True}))
+        self.assertFalse(profiling.should_profile({'message': "hi"}))
+
+
+class TurnLogTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def write_segment(self, name, *records):
+        path = self.directory / name
+        path.write_bytes(b"".join(records))
+        return path
+
+    def test_corrupt_records_are_skipped_and_a_torn_one_ends_the_segment(self):
+        first = turnlog.TurnTrace(1, "When is my next appointment?").encode("On Monday")
+        second = turnlog.TurnTrace(2, "What do I take?").encode("Aspirin")
+        corrupt = bytearray(first)
+        corrupt[-1] ^= 0xFF
+        path = self.write_segment("turns-a.seg", first, bytes(corrupt), second, second[:-5])
+        stats = {}
+        records = list(turnlog.read_records([path, self.write_segment("turns-b.seg", first)], stats))
+        self.assertEqual([record.patient_id for record in records], [1, 2, 1])
+        self.assertEqual(records[1].prompt_length, len("What do I take?"))
+        self.assertEqual(stats["corrupt"], 2)
+
+    @override_settings(TURNLOG_MAX_SEGMENTS=1)
+    def test_prune_leaves_segments_of_running_workers(self):
+        own = f"turns-20240101-000000-{os.getpid()}-0001.seg"
+        running = f"turns-20240101-000000-{os.getppid()}-0001.seg"
+        exited = "turns-20240101-000000-4194305-0001.seg"
+        newest = f"turns-20240101-000001-{os.getpid()}-0002.seg"
+        for age, name in enumerate([own, running, exited, newest]):
+            os.utime(self.write_segment(name), (1_000_000 + age, 1_000_000 + age))
+        turnlog.TurnLogWriter(self.directory).prune()
+        self.assertEqual(sorted(path.name for path in self.directory.iterdir()), sorted([running, newest]))
+
+
+class StreamedChunk:
+    def __init__(self, content):
+        self.content = content
+
+
+class ChunkedModel:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def astream(self, prompt):
+        for chunk in self.chunks:
+            yield StreamedChunk(chunk)
+
+
+class JsonArrayStreamParserTests(SimpleTestCase):
+    answer = '```json\n[{"action": "update medication", "medication": "Aspirin [81 mg]", "dosage": "say \\"daily\\", {not} ]"}, "x", 12, true]\n```'
+
+    def test_elements_are_the_same_however_the_stream_is_split(self):
+        expected = [
+            {"action": "update medication", "medication": "Aspirin [81 mg]", "dosage": 'say "daily", {not} ]'},
+            "x", 12, True,
+        ]
+        for size in (1, 2, 7, len(self.answer)):
+            with self.subTest(size=size):
+                parser = JsonArrayStreamParser()
+                items = []
+                for start in range(0, len(self.answer), size):
+                    items += parser.feed(self.answer[start:start + size])
+                self.assertEqual(items, expected)
+                self.assertTrue(parser.done)
+
+    def test_elements_are_emitted_as_soon_as_they_complete(self):
+        parser = JsonArrayStreamParser()
+        self.assertEqual(parser.feed('Sure:\n```json\n[{"a": 1}, {"b"'), [{"a": 1}])
+        self.assertEqual(parser.feed(': 2}]\n``` trailing [3]'), [{"b": 2}])
+
+    def test_malformed_and_invalid_elements_are_dropped(self):
+        chunks = ['[{"action": "schedule appointment", "new_date": "2030-01-07"}, {"action": ', '}, ',
+                  '{"action": "cancel everything"}, nul', 'l, {"action": "update medication", "dosage": "5 mg"}]']
+
+        async def collect():
+            return [item async for item in astream_json_array(ChunkedModel(chunks), "prompt", action_adapter)]
+        with self.assertLogs("chat.structured_output", "WARNING"):
+            items = async_to_sync(collect)()
+        self.assertEqual([(item.action, getattr(item, "new_date", None) or item.dosage) for item in items],
+                         [("schedule appointment", "2030-01-07"), ("update medication", "5 mg")])
+
+
+# A graph without the patient in it, recording what a sync writes
+class EmptyGraphDriver(RecordingDriver):
+    def execute_read_query(self, query, parameters):
+        return []
+
+    def close(self):
+        pass
+
+
+@override_settings(GRAPH_SYNC_MODE='diff')
+class GraphSyncTests(TestCase):
+    def test_statements_cover_only_the_difference(self):
+        current = patient_graph_state(make_patient())
+        self.assertEqual(graph_sync_statements(1, current, current), ([], 0, 0))
+
+        desired = patient_graph_state(make_patient(medication_regime="Aspirin, Insulin"))
+        statements, added, removed = graph_sync_statements(1, current, desired)
+        self.assertEqual((added, removed), (1, 1))
+        self.assertEqual([parameters["values"] for _, parameters in statements], [["Metformin"], ["Insulin"]])
+        self.assertIn("DELETE r", statements[0][0])
+
+    def test_save_without_graph_changes_skips_the_graph(self):
+        patient = make_patient()
+        patient.graph_sync_hash = graph_state_hash(patient_graph_state(patient))
+        Patient.objects.bulk_create([patient])
+        with mock.patch("chat.graph_utils.Neo4jDriver", side_effect=AssertionError("graph was queried")):
+            sync_patient_graph(patient)
+
+    def test_changed_save_writes_and_records_the_new_hash(self):
+        patient = make_patient()
+        patient.graph_sync_hash = graph_state_hash(patient_graph_state(patient))
+        Patient.objects.bulk_create([patient])
+        patient.medication_regime = "Aspirin"
+        driver = EmptyGraphDriver()
+        with mock.patch("chat.graph_utils.Neo4jDriver", return_value=driver):
+            sync_patient_graph(patient)
+        self.assertEqual(len(driver.transactions), 1)
+        self.assertEqual(Patient.objects.get(pk=patient.pk).graph_sync_hash, graph_state_hash(patient_graph_state(patient)))
+
+
+class ModelResponse:
+    def __init__(self, input_tokens, output_tokens):
+        self.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens}
+
+
+@override_settings(
+    QUOTA_ENABLED=True, QUOTA_PATIENT_CALLS_PER_MINUTE=60, QUOTA_PATIENT_CALL_BURST=10,
+    QUOTA_PATIENT_TOKENS_PER_MINUTE=600, QUOTA_PATIENT_TOKEN_BURST=1000,
+    QUOTA_IP_CALLS_PER_MINUTE=0, QUOTA_IP_TOKENS_PER_MINUTE=0,
+)
+class QuotaTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1_000_000.0
+        patcher = mock.patch("chat.quotas.time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = quotas.MemoryQuotaStore()
+        store_patcher = mock.patch("chat.quotas._store", self.store)
+        store_patcher.start()
+        self.addCleanup(store_patcher.stop)
+
+    def level(self, key):
+        return self.store.levels[key][0]
+
+    def test_bucket_refills_at_its_rate_up_to_capacity(self):
+        bucket = quotas.Bucket("patient:1:calls", 60, 2, 1)
+        take = async_to_sync(self.store.take)
+        self.assertEqual(take([bucket]), (True, 0.0))
+        self.assertEqual(take([bucket]), (True, 0.0))
+        self.assertEqual(take([bucket]), (False, 1.0))
+        self.now += 0.5
+        self.assertEqual(take([bucket]), (False, 0.5))
+        self.now += 0.5
+        self.assertEqual(take([bucket]), (True, 0.0))
+        self.now += 3600
+        self.assertEqual(take([bucket]), (True, 0.0))
+        self.assertEqual(self.level("patient:1:calls"), 1)
+
+    def test_refused_turn_charges_no_bucket(self):
+        calls = quotas.Bucket("calls", 60, 5, 1)
+        tokens = quotas.Bucket("tokens", 60, 5, 10)
+        self.assertFalse(async_to_sync(self.store.take)([calls, tokens])[0])
+        self.assertNotIn("calls", self.store.levels)
+
+    def test_settle_charges_what_the_turn_used(self):
+        async def turn(responses):
+            admission = await quotas.admit(1, None, 100)
+            for response in responses:
+                quotas.record_usage(response)
+            await quotas.settle(admission)
+            return admission
+
+        async_to_sync(turn)([ModelResponse(200, 50), ModelResponse(40, 10), ModelResponse(0, 0)])
+        self.assertEqual(self.level("patient:1:calls"), 7)
+        self.assertEqual(self.level("patient:1:tokens"), 700)
+
+        # Under the estimate the difference is refunded; without reported usage the estimate stands,
+        # and a turn answered without calling the model gets its call back
+        async_to_sync(turn)([ModelResponse(30, 10)])
+        self.assertEqual(self.level("patient:1:tokens"), 660)
+        async_to_sync(turn)([])
+        self.assertEqual(self.level("patient:1:calls"), 6)
+        self.assertEqual(self.level("patient:1:tokens"), 560)
+        self.assertIsNone(quotas.current_usage.get())
+
+    def test_exhausted_quota_refuses_with_retry_after(self):
+        admission = async_to_sync(quotas.admit)(1, None, 1100)
+        self.assertFalse(admission.allowed)
+        self.assertEqual(admission.retry_after_seconds, 10)
+
+
+class PatientSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "patients.snapshot")
+        stats = mock.patch.dict(snapshot_stats, {"hits": 0, "stale": 0, "misses": 0})
+        stats.start()
+        self.addCleanup(stats.stop)
+
+    def open_snapshot(self):
+        snapshot = PatientSnapshot(self.path)
+        self.addCleanup(snapshot.close)
+        return snapshot
+
+    def test_round_trip_serves_only_current_records(self):
+        patients = [
+            make_patient(id=7, context_version=3, doctor_name="Jones", medication_regime=""),
+            make_patient(id=2, context_version=1),
+            make_patient(id=40, context_version=0, next_appointment=None),
+        ]
+        self.assertEqual(write_snapshot(self.path, patients), 3)
+        snapshot = self.open_snapshot()
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(list(snapshot.ids), [2, 7, 40])
+
+        self.assertEqual(snapshot.context(2, 1), {
+            "doctors": ["Smith"], "conditions": ["Asthma", "Diabetes"], "medications": ["Aspirin", "Metformin"],
+            "last_appointments": [datetime.datetime(2024, 1, 5, 9, 0, tzinfo=datetime.timezone.utc)],
+            "next_appointments": [datetime.datetime(2030, 1, 7, 10, 0, tzinfo=datetime.timezone.utc)],
+        })
+        self.assertEqual(snapshot.context(7, 3)["doctors"], ["Jones"])
+        self.assertEqual(snapshot.context(7, 3)["medications"], [])
+        self.assertEqual(snapshot.context(40, 0)["next_appointments"], [])
+
+        # Saved since the export, and created since the export
+        self.assertIsNone(snapshot.context(7, 4))
+        self.assertIsNone(snapshot.context(5, 0))
+        self.assertIsNone(snapshot.context(41, 0))
+        self.assertEqual(snapshot_stats, {"hits": 4, "stale": 1, "misses": 2})
+
+    def test_rewrite_replaces_the_file_mapped_readers_keep_theirs(self):
+        write_snapshot(self.path, [make_patient(id=1, context_version=1)])
+        old = self.open_snapshot()
+        write_snapshot(self.path, [make_patient(id=1, context_version=2, doctor_name="Jones")])
+        self.assertEqual(old.context(1, 1)["doctors"], ["Smith"])
+        self.assertEqual(self.open_snapshot().context(1, 2)["doctors"], ["Jones"])
+
+    def test_duplicate_and_truncated_snapshots_are_rejected(self):
+        with self.assertRaises(ValueError):
+            write_snapshot(self.path, [make_patient(id=1), make_patient(id=1)])
+        write_snapshot(self.path, [make_patient(id=1), make_patient(id=2)])
+        with open(self.path, "r+b") as file:
+            file.truncate(40)
+        with self.assertRaisesRegex(ValueError, "truncated"):
+            PatientSnapshot(self.path)
@@ -0,0 +1,298 @@
+import atexit
+import contextvars
+import datetime
+import functools
+import hashlib
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from pathlib import Path
+from django.conf import settings
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Stages of a turn, timed in microseconds
+STAGES = ["patient", "cache", "summary", "classify", "information", "action", "general", "total"]
+
+PROMPT_INTENTS = ["get information", "do some action"]
+INFORMATION_INTENTS = [
+    "get_next_appointment",
+    "get_last_appointment",
+    "get_medications",
+    "get_medical_conditions",
+    "get_doctor_info",
+    "unknown_intent",
+]
+
+# Flags of a turn
+CACHE_HIT = 1 << 0
+SUMMARIZED = 1 << 1
+PREFETCHED = 1 << 2
+SQL_RESOLVED = 1 << 3
+CYPHER_FALLBACK = 1 << 4
+ERROR = 1 << 5
+DEGRADED = 1 << 6
+SNAPSHOT = 1 << 7
+FLAGS = {
+    "cache_hit": CACHE_HIT,
+    "summarized": SUMMARIZED,
+    "prefetched": PREFETCHED,
+    "sql_resolved": SQL_RESOLVED,
+    "cypher_fallback": CYPHER_FALLBACK,
+    "error": ERROR,
+    "degraded": DEGRADED,
+    "snapshot": SNAPSHOT,
+}
+
+# One record per turn. Frames are <payload length, crc32> followed by the payload,
+# so a reader can skip records of a newer, longer version and detect torn writes.
+RECORD_VERSION = 1
+RECORD = struct.Struct(f"<BqQ{len(STAGES)}IBHHIIII8s8s")
+FRAME = struct.Struct("<HI")
+
+# Queued to stop the writer thread
+STOP = object()
+
+TurnRecord = namedtuple("TurnRecord", [
+    "version", "started_at", "patient_id", "stages", "prompt_intents", "information_intents", "flags",
+    "input_tokens", "output_tokens", "prompt_length", "response_length", "prompt_hash", "response_hash",
+])
+
+# Keyed hash of a prompt or response, so equal texts can be counted without storing them.
+# The key is derived from SECRET_KEY, so the hashes can't be matched against guessed texts elsewhere.
+@functools.lru_cache(maxsize=1)
+def hash_key():
+    return hashlib.blake2b(settings.SECRET_KEY.encode(), digest_size=32, person=b"chat.turnlog").digest()
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=8, key=hash_key()).digest()
+
+
+# Measurements of the turn being answered, carried in a contextvar so helpers can add to it
+class TurnTrace:
+    __slots__ = ("started_at", "started", "patient_id", "stages", "prompt_intents", "information_intents",
+                 "flags", "input_tokens", "output_tokens", "prompt")
+
+    def __init__(self, patient_id, prompt):
+        self.started_at = time.time_ns() // 1000
+        self.started = time.perf_counter()
+        self.patient_id = patient_id
+        self.stages = [0] * len(STAGES)
+        self.prompt_intents = 0
+        self.information_intents = 0
+        self.flags = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.prompt = prompt
+
+    def encode(self, response):
+        self.stages[STAGES.index("total")] = int((time.perf_counter() - self.started) * 1_000_000)
+        payload = RECORD.pack(
+            RECORD_VERSION, self.started_at, self.patient_id,
+            *[min(duration, 0xFFFFFFFF) for duration in self.stages],
+            self.prompt_intents, self.information_intents, self.flags,
+            self.input_tokens, self.output_tokens, len(self.prompt), len(response or ""),
+            text_hash(self.prompt), text_hash(response or ""),
+        )
+        return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+current_trace = contextvars.ContextVar("turn_trace", default=None)
+
+# Time a stage of the current turn; does nothing outside a recorded turn
+class stage:
+    __slots__ = ("name", "trace", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current_trace.get()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.stages[STAGES.index(self.name)] += int((time.perf_counter() - self.started) * 1_000_000)
+
+def mark(flag):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.flags |= FLAGS[flag]
+
+def record_prompt_intents(intents):
+    trace = current_trace.get()
+    if trace is not None:
+        for intent in intents:
+            if intent in PROMPT_INTENTS:
+                trace.prompt_intents |= 1 << PROMPT_INTENTS.index(intent)
+
+def record_information_intent(intent):
+    trace = current_trace.get()
+    if trace is not None and intent in INFORMATION_INTENTS:
+        trace.information_intents |= 1 << INFORMATION_INTENTS.index(intent)
+
+# Add the token usage langchain reports on a model response
+def record_usage(message):
+    trace = current_trace.get()
+    usage = getattr(message, "usage_metadata", None)
+    if trace is not None and usage:
+        trace.input_tokens += usage.get("input_tokens", 0)
+        trace.output_tokens += usage.get("output_tokens", 0)
+
+
+# Pid of the process that wrote a segment, from its turns-<date>-<time>-<pid>-<sequence>.seg name
+def segment_pid(path):
+    parts = path.stem.split("-")
+    if len(parts) != 5 or not parts[3].isdigit():
+        return None
+    return int(parts[3])
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Appends encoded records to size-rotated segment files from a background thread.
+# Writes go through a buffered file and are fsynced at most every TURNLOG_FSYNC_INTERVAL seconds.
+class TurnLogWriter:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.sequence = 0
+        self.dropped = 0
+
+    def append(self, record):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="turnlog-writer", daemon=True)
+                    self.thread.start()
+                    atexit.register(self.close)
+        self.queue.put(record)
+
+    def open_segment(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sequence += 1
+        name = f"turns-{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{self.sequence:04d}.seg"
+        self.file = open(self.directory / name, "ab", buffering=settings.TURNLOG_BUFFER_BYTES)
+        self.size = 0
+        self.prune()
+
+    # Keep the newest TURNLOG_MAX_SEGMENTS segments of the directory. Workers share it, so only
+    # this process's segments and those of processes that have exited are removed; a running
+    # worker's segments, including the one it is appending to, are left for it to prune.
+    def prune(self):
+        segments = sorted(self.directory.glob("turns-*.seg"), key=lambda path: path.stat().st_mtime)
+        for path in segments[:-settings.TURNLOG_MAX_SEGMENTS]:
+            pid = segment_pid(path)
+            if pid == os.getpid() or (pid is not None and not process_running(pid)):
+                path.unlink(missing_ok=True)
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def run(self):
+        last_sync = time.monotonic()
+        pending = 0
+        while True:
+            try:
+                record = self.queue.get(timeout=settings.TURNLOG_FSYNC_INTERVAL)
+            except queue.Empty:
+                record = None
+            try:
+                if record is STOP:
+                    self.sync()
+                    return
+                if record is not None:
+                    if self.file is None or self.size + len(record) > settings.TURNLOG_SEGMENT_BYTES:
+                        if self.file is not None:
+                            self.sync()
+                            self.file.close()
+                        self.open_segment()
+                    self.file.write(record)
+                    self.size += len(record)
+                    pending += 1
+                if pending and time.monotonic() - last_sync >= settings.TURNLOG_FSYNC_INTERVAL:
+                    self.sync()
+                    last_sync = time.monotonic()
+                    pending = 0
+            except OSError as e:
+                self.dropped += 1
+                logger.error(f"Failed to write turn log record: {e}")
+                self.file = None
+
+    # Write out what is queued and make it durable, at exit
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(STOP)
+            self.thread.join(timeout=5)
+
+
+writer = TurnLogWriter(settings.TURNLOG_DIR)
+
+# Record every call of an async turn handler taking (patient_id, prompt, ...).
+# With the turn log disabled the handler is returned as it is.
+def record_turn(handler):
+    if not settings.TURNLOG_ENABLED:
+        return handler
+
+    @functools.wraps(handler)
+    async def wrapper(patient_id, prompt, *args, **kwargs):
+        trace = TurnTrace(patient_id, prompt)
+        token = current_trace.set(trace)
+        response = None
+        try:
+            response = await handler(patient_id, prompt, *args, **kwargs)
+            return response
+        except BaseException:
+            trace.flags |= ERROR
+            raise
+        finally:
+            current_trace.reset(token)
+            writer.append(trace.encode(response))
+    return wrapper
+
+
+# Stream the records of segment files in order, in constant memory.
+# Corrupt records are counted in stats['corrupt'] and a torn record at the end of a segment is skipped.
+def read_records(paths, stats=None):
+    stats = stats if stats is not None else {}
+    stats.setdefault("corrupt", 0)
+    for path in paths:
+        with open(path, "rb", buffering=1 << 20) as segment:
+            while True:
+                header = segment.read(FRAME.size)
+                if len(header) < FRAME.size:
+                    break
+                length, checksum = FRAME.unpack(header)
+                payload = segment.read(length)
+                if len(payload) < length:
+                    stats["corrupt"] += 1
+                    break
+                if zlib.crc32(payload) != checksum or length < RECORD.size:
+                    stats["corrupt"] += 1
+                    continue
+                fields = RECORD.unpack_from(payload)
+                stage_count = len(STAGES)
+                yield TurnRecord(
+                    fields[0], fields[1], fields[2], fields[3:3 + stage_count], *fields[3 + stage_count:]
+                )
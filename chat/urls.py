@@ -9,6 +9,8 @@ logger = logging.getLogger(__name__)
 # URL configuration for the chat application.
 urlpatterns = [
     path('', views.home, name='Chat'), # URL for the chat view
+    path('api/doctors/<str:doctor_name>/patients/', views.doctor_patients, name='doctor_patients'), # Doctor's patient roster
+    path('api/doctors/<str:doctor_name>/appointments/', views.doctor_appointments, name='doctor_appointments'), # Doctor's upcoming appointments
 ]
 
 # Log the URL patterns
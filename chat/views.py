@@ -1,6 +1,11 @@
 import logging
+from functools import wraps
+import orjson
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from .models import Patient
+from .dashboard import decode_cursor, ndjson_stream, page_functions
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -19,4 +24,56 @@ def home(request):
         # Redirect to error page if no patients are found
         return render(request, 'chat/error.html', {
             'error_message': 'No patients found. Please create sample data.'
-        })
\ No newline at end of file
+        })
+
+
+# Dashboard API for staff only; answers with 403 instead of a login redirect
+def staff_required(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not (request.user.is_authenticated and request.user.is_staff):
+            return HttpResponse(orjson.dumps({'error': 'Staff access required'}), status=403, content_type='application/json')
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+# List a doctor's patients or upcoming appointments, a keyset page at a time.
+# ?cursor= continues after the previous page; ?format=ndjson streams every row instead.
+def dashboard_response(request, doctor_name, listing):
+    source = request.GET.get('source', 'sql')
+    page_function = page_functions.get((listing, source))
+    if page_function is None:
+        return HttpResponse(orjson.dumps({'error': f'Unknown source: {source}'}), status=400, content_type='application/json')
+
+    if request.GET.get('format') == 'ndjson':
+        lines = ndjson_stream(page_function, doctor_name, settings.DASHBOARD_PAGE_SIZE)
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+    try:
+        limit = min(int(request.GET.get('limit', settings.DASHBOARD_PAGE_SIZE)), settings.DASHBOARD_MAX_PAGE_SIZE)
+        cursor = decode_cursor(request.GET.get('cursor'))
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except ValueError as e:
+        return HttpResponse(orjson.dumps({'error': str(e)}), status=400, content_type='application/json')
+    try:
+        rows, next_cursor = page_function(doctor_name, cursor, limit)
+    except ConnectionError as e:
+        logger.error(f"Failed to list {listing} of Dr. {doctor_name}: {e}")
+        return HttpResponse(orjson.dumps({'error': str(e)}), status=503, content_type='application/json')
+    except (ValueError, IndexError, TypeError):
+        return HttpResponse(orjson.dumps({'error': 'Invalid cursor'}), status=400, content_type='application/json')
+    return HttpResponse(
+        orjson.dumps({'results': rows, 'next_cursor': next_cursor}, default=str),
+        content_type='application/json',
+    )
+
+
+@staff_required
+def doctor_patients(request, doctor_name):
+    return dashboard_response(request, doctor_name, 'patients')
+
+
+@staff_required
+def doctor_appointments(request, doctor_name):
+    return dashboard_response(request, doctor_name, 'appointments')
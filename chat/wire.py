@@ -0,0 +1,35 @@
+import json
+from urllib.parse import parse_qs
+import msgpack
+from django.conf import settings
+
+# WebSocket subprotocols a client can offer, in order of preference
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v1'
+JSON_SUBPROTOCOL = 'chat.json.v1'
+
+# Pick the subprotocol to accept from the ones the client offered.
+# None (plain JSON text frames) for clients that offered none, like before.
+def select_subprotocol(offered):
+    if settings.CHAT_MSGPACK_ENABLED and MSGPACK_SUBPROTOCOL in offered:
+        return MSGPACK_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in offered or MSGPACK_SUBPROTOCOL in offered:
+        return JSON_SUBPROTOCOL
+    return None
+
+# Whether the client wants its own messages echoed back; clients that render them
+# locally connect with ?echo=0 to save a frame per turn
+def echo_requested(scope):
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    if 'echo' in query:
+        return query['echo'][-1] not in ('0', 'false')
+    return settings.CHAT_ECHO_USER_MESSAGES
+
+def encode_frame(payload, binary):
+    if binary:
+        return msgpack.packb(payload)
+    return json.dumps(payload)
+
+def decode_frame(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        return msgpack.unpackb(bytes_data)
+    return json.loads(text_data)
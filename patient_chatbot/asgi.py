@@ -15,12 +15,18 @@ django.setup()
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
+from django.conf import settings
 import chat.routing
+from chat.static_assets import PrecompressedStaticFiles
 
 
+# Serve collected static files from the ASGI app, ahead of Django
+http_application = get_asgi_application()
+if settings.STATIC_SERVE:
+    http_application = PrecompressedStaticFiles(http_application)
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": http_application,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
@@ -46,6 +46,76 @@ GEMINI_API_KEY = env('GEMINI_API_KEY')
 NEO4J_URI = env('NEO4J_URI')
 NEO4J_USER = env('NEO4J_USER')
 NEO4J_PASSWORD = env('NEO4J_PASSWORD')
+CHANNEL_LAYER_BACKEND = env('CHANNEL_LAYER_BACKEND', default='memory') # 'memory' or 'redis'
+REDIS_URL = env('REDIS_URL', default='redis://localhost:6379/0')
+SEMANTIC_CACHE_ENABLED = env.bool('SEMANTIC_CACHE_ENABLED', default=True)
+SEMANTIC_CACHE_THRESHOLD = env.float('SEMANTIC_CACHE_THRESHOLD', default=0.85) # Minimum cosine similarity for a hit
+SEMANTIC_CACHE_DIM = env.int('SEMANTIC_CACHE_DIM', default=1024)
+SEMANTIC_CACHE_ENTRIES = env.int('SEMANTIC_CACHE_ENTRIES', default=32) # Cached answers per patient
+SEMANTIC_CACHE_MAX_PATIENTS = env.int('SEMANTIC_CACHE_MAX_PATIENTS', default=10000)
+SEMANTIC_CACHE_TTL = env.int('SEMANTIC_CACHE_TTL', default=3600) # Seconds
+GRAPH_PREFETCH_ENABLED = env.bool('GRAPH_PREFETCH_ENABLED', default=True)
+GRAPH_PREFETCH_MAX_PATIENTS = env.int('GRAPH_PREFETCH_MAX_PATIENTS', default=10000)
+CYPHER_FALLBACK_ENABLED = env.bool('CYPHER_FALLBACK_ENABLED', default=True)
+CYPHER_TEMPLATE_CACHE_SIZE = env.int('CYPHER_TEMPLATE_CACHE_SIZE', default=1000) # Question shapes
+CYPHER_FALLBACK_ROW_LIMIT = env.int('CYPHER_FALLBACK_ROW_LIMIT', default=25)
+STRUCTURED_OUTPUT_EARLY_DISPATCH = env.bool('STRUCTURED_OUTPUT_EARLY_DISPATCH', default=False) # Stream intents/actions and start handling each one as it is parsed
+AVAILABILITY_CHECK_ENABLED = env.bool('AVAILABILITY_CHECK_ENABLED', default=True) # Check the doctor's booked slots before requesting an appointment
+AVAILABILITY_REFRESH_SECONDS = env.int('AVAILABILITY_REFRESH_SECONDS', default=300) # Reload a doctor's booked slots from the graph after this many seconds
+APPOINTMENT_SLOT_MINUTES = env.int('APPOINTMENT_SLOT_MINUTES', default=30) # Length of an appointment slot
+APPOINTMENT_ALTERNATIVES = env.int('APPOINTMENT_ALTERNATIVES', default=3) # Free slots proposed when the requested one is taken
+APPOINTMENT_SEARCH_DAYS = env.int('APPOINTMENT_SEARCH_DAYS', default=60) # How far ahead to look for free slots
+CLINIC_OPENING_HOUR = env.int('CLINIC_OPENING_HOUR', default=9) # First bookable hour, in TIME_ZONE
+CLINIC_CLOSING_HOUR = env.int('CLINIC_CLOSING_HOUR', default=17) # Appointments end by this hour, in TIME_ZONE
+CLINIC_WORKING_DAYS = env.list('CLINIC_WORKING_DAYS', cast=int, default=[0, 1, 2, 3, 4]) # Weekdays, Monday is 0
+ACTION_BATCH_SIZE = env.int('ACTION_BATCH_SIZE', default=100) # Approved actions written back per graph transaction
+PROFILE_SAMPLE_RATE = env.float('PROFILE_SAMPLE_RATE', default=0.0) # Fraction of chat turns profiled with cProfile and tracemalloc, 0 disables
+PROFILE_ALLOW_CLIENT_REQUESTS = env.bool('PROFILE_ALLOW_CLIENT_REQUESTS', default=False) # Profile turns sent with "profile": true
+PROFILE_DIR = env('PROFILE_DIR', default=str(BASE_DIR / 'profiles')) # Where profile dumps are written
+PROFILE_MAX_FILES = env.int('PROFILE_MAX_FILES', default=50) # Profiled turns kept, oldest are removed
+PROFILE_TRACEMALLOC_FRAMES = env.int('PROFILE_TRACEMALLOC_FRAMES', default=10) # Stack frames recorded per allocation
+CHAT_MSGPACK_ENABLED = env.bool('CHAT_MSGPACK_ENABLED', default=True) # Accept the binary chat.msgpack.v1 WebSocket subprotocol
+CHAT_ECHO_USER_MESSAGES = env.bool('CHAT_ECHO_USER_MESSAGES', default=True) # Echo messages back to clients that don't pass ?echo=0
+CHAT_WEBSOCKET_DEFLATE = env.bool('CHAT_WEBSOCKET_DEFLATE', default=True) # Negotiate permessage-deflate when served with python -m chat.server
+CHAT_WEBSOCKET_DEFLATE_NO_CONTEXT_TAKEOVER = env.bool('CHAT_WEBSOCKET_DEFLATE_NO_CONTEXT_TAKEOVER', default=False) # Reset the compressor after every message to save memory per socket
+DASHBOARD_PAGE_SIZE = env.int('DASHBOARD_PAGE_SIZE', default=100) # Rows per page of the doctor dashboard API
+DASHBOARD_MAX_PAGE_SIZE = env.int('DASHBOARD_MAX_PAGE_SIZE', default=1000) # Largest ?limit= accepted
+GRAPH_SYNC_MODE = env('GRAPH_SYNC_MODE', default='diff') # 'diff' writes only changes and removes stale relationships, 'full' re-MERGEs everything on save
+TURNLOG_ENABLED = env.bool('TURNLOG_ENABLED', default=False) # Append a binary record per chat turn to the turn log
+TURNLOG_DIR = env('TURNLOG_DIR', default=str(BASE_DIR / 'turnlog')) # Directory of turn log segments
+TURNLOG_SEGMENT_BYTES = env.int('TURNLOG_SEGMENT_BYTES', default=64 * 1024 * 1024) # Segment size before rotating
+TURNLOG_MAX_SEGMENTS = env.int('TURNLOG_MAX_SEGMENTS', default=100) # Segments kept, oldest are removed
+TURNLOG_BUFFER_BYTES = env.int('TURNLOG_BUFFER_BYTES', default=64 * 1024) # Write buffer of the current segment
+TURNLOG_FSYNC_INTERVAL = env.float('TURNLOG_FSYNC_INTERVAL', default=1.0) # Seconds between fsyncs of buffered records
+CHAT_STUB_BACKENDS = env.bool('CHAT_STUB_BACKENDS', default=False) # Answer with the stub model and an empty stub graph, for offline load tests
+CHAT_STUB_MODEL_LATENCY_MS = env.int('CHAT_STUB_MODEL_LATENCY_MS', default=200) # Stub model time per request
+CHAT_STUB_MODEL_CONCURRENCY = env.int('CHAT_STUB_MODEL_CONCURRENCY', default=32) # Stub model requests in flight, like an upstream quota
+CHAT_STUB_GRAPH_LATENCY_MS = env.int('CHAT_STUB_GRAPH_LATENCY_MS', default=5) # Stub graph time per query
+QUOTA_ENABLED = env.bool('QUOTA_ENABLED', default=True) # Limit model calls and tokens per patient and per client address
+QUOTA_STORE = env('QUOTA_STORE', default=CHANNEL_LAYER_BACKEND) # 'memory' (per worker) or 'redis' (shared by all workers)
+QUOTA_PATIENT_CALLS_PER_MINUTE = env.int('QUOTA_PATIENT_CALLS_PER_MINUTE', default=20) # 0 disables the limit
+QUOTA_PATIENT_CALL_BURST = env.int('QUOTA_PATIENT_CALL_BURST', default=40)
+QUOTA_PATIENT_TOKENS_PER_MINUTE = env.int('QUOTA_PATIENT_TOKENS_PER_MINUTE', default=60000) # 0 disables the limit
+QUOTA_PATIENT_TOKEN_BURST = env.int('QUOTA_PATIENT_TOKEN_BURST', default=120000)
+QUOTA_IP_CALLS_PER_MINUTE = env.int('QUOTA_IP_CALLS_PER_MINUTE', default=60) # 0 disables the limit
+QUOTA_IP_CALL_BURST = env.int('QUOTA_IP_CALL_BURST', default=120)
+QUOTA_IP_TOKENS_PER_MINUTE = env.int('QUOTA_IP_TOKENS_PER_MINUTE', default=200000) # 0 disables the limit
+QUOTA_IP_TOKEN_BURST = env.int('QUOTA_IP_TOKEN_BURST', default=400000)
+QUOTA_DEGRADED_MATCH_THRESHOLD = env.float('QUOTA_DEGRADED_MATCH_THRESHOLD', default=0.5) # Minimum similarity to a known question to answer it over quota
+STATIC_SERVE = env.bool('STATIC_SERVE', default=True) # Serve STATIC_ROOT from the ASGI app with precompressed variants and cache headers
+STATIC_PRECOMPRESS = env.bool('STATIC_PRECOMPRESS', default=True) # Write .gz and .br copies of text assets at collectstatic
+STATIC_PRECOMPRESS_MIN_BYTES = env.int('STATIC_PRECOMPRESS_MIN_BYTES', default=512) # Smaller files aren't worth compressing
+STATIC_MEMORY_CACHE_BYTES = env.int('STATIC_MEMORY_CACHE_BYTES', default=16 * 1024 * 1024) # Static file bodies kept in memory per worker
+CHAT_WORKERS = env.int('CHAT_WORKERS', default=0) # Worker processes started by runworkers, 0 for one per CPU
+CHAT_WORKER_REUSE_PORT = env.bool('CHAT_WORKER_REUSE_PORT', default=False) # One SO_REUSEPORT socket per worker instead of a shared one
+CHAT_DRAIN_TIMEOUT = env.int('CHAT_DRAIN_TIMEOUT', default=30) # Seconds a draining worker waits for turns being answered
+PATIENT_SNAPSHOT_ENABLED = env.bool('PATIENT_SNAPSHOT_ENABLED', default=True) # Map the patient snapshot at startup and answer graph lookups of unchanged patients from it
+PATIENT_SNAPSHOT_PATH = env('PATIENT_SNAPSHOT_PATH', default=str(BASE_DIR / 'patient_snapshot.bin')) # Written by export_patient_snapshot
+POSTGRES_CONN_MAX_AGE = env.int('POSTGRES_CONN_MAX_AGE', default=60) # Seconds, 0 closes after every request
+PATIENT_DB_POOL_SIZE = env.int('PATIENT_DB_POOL_SIZE', default=10) # Pooled connections for patient lookups
+CHAT_HEARTBEAT_TIMEOUT = env.int('CHAT_HEARTBEAT_TIMEOUT', default=90) # Seconds without a ping before a socket is closed
+CHAT_IDLE_TIMEOUT = env.int('CHAT_IDLE_TIMEOUT', default=1800) # Seconds without a chat message before a socket is closed
+CHAT_SWEEP_INTERVAL = env.int('CHAT_SWEEP_INTERVAL', default=15) # Seconds between checks for dead and idle sockets
 
 # Secure Cookies
 CSRF_COOKIE_SECURE = True
@@ -61,7 +131,7 @@ SECURE_HSTS_PRELOAD = True
 
 # Content Security Policy
 CSP_DEFAULT_SRC = ("'self'",)
-CSP_SCRIPT_SRC = ("'self'", "'unsafe-inline'", "https://cdn.jsdelivr.net", "cdns.cloudflare.com")
+CSP_SCRIPT_SRC = ("'self'",)
 
 # Application definition
 INSTALLED_APPS = [
@@ -109,6 +179,25 @@ TEMPLATES = [
 ASGI_APPLICATION = 'patient_chatbot.asgi.application'
 WSGI_APPLICATION = 'patient_chatbot.wsgi.application'
 
+# Channel layer used for per-patient groups. The in-memory layer only reaches
+# consumers in the same process (tests, single worker); use redis when running
+# more than one Daphne worker.
+if CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -121,6 +210,8 @@ DATABASES = {
         'PASSWORD': POSTGRES_PASSWORD,
         'HOST': POSTGRES_HOST,
         'PORT': POSTGRES_PORT,
+        'CONN_MAX_AGE': POSTGRES_CONN_MAX_AGE, # Persistent connections
+        'CONN_HEALTH_CHECKS': True, # Verify a persistent connection before reusing it
     }
 }
 
@@ -167,6 +258,16 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'chat', 'static'),
 ]
 
+# Hashed file names and precompressed .gz/.br copies, written by collectstatic
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'chat.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 